@@ -0,0 +1,167 @@
+import argparse
+import gc
+import json
+import os
+import time
+import tracemalloc
+
+from scraping.fast_parser import load_pages
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+CORPUS_DIR = os.path.join(FIXTURE_DIR, 'race_pages')
+BASELINE_PATH = os.path.join(FIXTURE_DIR, 'parser_baseline.json')
+
+# 計測するNetkeibaRaceScraperのメソッド（時間は呼び出し先を含む）
+TIMED_METHODS = (
+    '_parse_race_page',
+    '_get_race_info',
+    '_get_race_details',
+    '_get_race_results',
+    '_build_race_info',
+    '_build_race_results',
+    '_convert_time_to_seconds',
+)
+
+
+class _MethodTimer:
+    """スクレイパーのインスタンスのメソッドを包み、呼び出し回数と合計時間を数える"""
+
+    def __init__(self, scraper, names=TIMED_METHODS):
+        self.names = names
+        self.reset()
+        for name in names:
+            setattr(scraper, name, self._wrap(name, getattr(scraper, name)))
+
+    def reset(self):
+        self.calls = {name: 0 for name in self.names}
+        self.seconds = {name: 0.0 for name in self.names}
+
+    def _wrap(self, name, method):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.seconds[name] += time.perf_counter() - start
+                self.calls[name] += 1
+        return timed
+
+
+def run_benchmark(pages, parser='bs4', repeat=10):
+    """
+    保存済みページのパース速度とメモリ使用量を計測する（ネットワーク・GCSは使わない）
+    Args:
+        pages (dict): ページ名 → HTML文字列
+        parser (str): 'bs4' または 'lxml'
+        repeat (int): コーパス全体を何周パースするか（時間は各周のうち最も速いものを使う）
+    Returns:
+        dict: pages_per_second、関数ごとの1ページあたりの時間（ミリ秒）、1ページのパース中のピークメモリ（KiB）
+    """
+    from scraping.scraping_netkeiba import NetkeibaRaceScraper
+
+    scraper = NetkeibaRaceScraper(storage='memory', use_calendar=False, parser=parser)
+    htmls = list(pages.values())
+    scraper._parse_race_page(htmls[0])  # 初回だけのimport・コンパイルを計測から外す
+
+    timer = _MethodTimer(scraper)
+    best_elapsed = None
+    best_seconds = {}
+    for _ in range(repeat):
+        timer.reset()
+        start = time.perf_counter()
+        for html in htmls:
+            scraper._parse_race_page(html)
+        elapsed = time.perf_counter() - start
+        best_elapsed = elapsed if best_elapsed is None else min(best_elapsed, elapsed)
+        for name, seconds in timer.seconds.items():
+            if timer.calls[name]:
+                best_seconds[name] = min(best_seconds.get(name, seconds), seconds)
+
+    # tracemallocは処理が遅くなるので、時間の計測とは別に1周だけ回す
+    # （BeautifulSoupの木は循環参照なので、GCのタイミングに左右されないようページごとに回収してから測る）
+    peak = 0
+    tracemalloc.start()
+    for html in htmls:
+        gc.collect()
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        scraper._parse_race_page(html)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+
+    return {
+        'parser': parser,
+        'pages': len(htmls),
+        'pages_per_second': round(len(htmls) / best_elapsed, 2),
+        'functions_ms_per_page': {
+            name: round(seconds * 1000 / len(htmls), 4) for name, seconds in best_seconds.items()
+        },
+        'peak_memory_kib': round(peak / 1024, 1),
+    }
+
+
+def compare_with_baseline(result, baseline, tolerance=0.2, min_ms=0.1):
+    """
+    ベースラインと比べて遅く（重く）なった項目を返す
+    Args:
+        result (dict): run_benchmarkの結果
+        baseline (dict): 保存済みのrun_benchmarkの結果
+        tolerance (float): 許容する悪化の割合
+        min_ms (float): これ未満の関数ごとの差は計測誤差として無視する（ミリ秒）
+    Returns:
+        list: 悪化した項目の説明
+    """
+    regressions = []
+    if result['pages_per_second'] < baseline['pages_per_second'] * (1 - tolerance):
+        regressions.append(f"pages_per_second: {baseline['pages_per_second']} -> {result['pages_per_second']}")
+    for name, ms in result['functions_ms_per_page'].items():
+        base_ms = baseline['functions_ms_per_page'].get(name)
+        if base_ms and ms > base_ms * (1 + tolerance) and ms - base_ms >= min_ms:
+            regressions.append(f"{name}: {base_ms} ms -> {ms} ms")
+    if result['peak_memory_kib'] > baseline['peak_memory_kib'] * (1 + tolerance):
+        regressions.append(f"peak_memory_kib: {baseline['peak_memory_kib']} -> {result['peak_memory_kib']}")
+    return regressions
+
+
+def _print_result(result):
+    print(f"[{result['parser']}] {result['pages']} pages, {result['pages_per_second']} pages/sec, "
+          f"peak memory {result['peak_memory_kib']} KiB")
+    for name, ms in result['functions_ms_per_page'].items():
+        print(f"  {name:<28} {ms:>10.4f} ms/page")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='保存済みのレースページでパーサーのベンチマークを取る')
+    parser.add_argument('--corpus', default=CORPUS_DIR, help='race_idごとの*.html（EUC-JP）を置いたディレクトリ')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--parser', action='append', choices=['bs4', 'lxml'], help='計測するパーサー（複数指定可。省略時は両方）')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--tolerance', type=float, default=0.2, help='ベースラインから許容する悪化の割合')
+    parser.add_argument('--update-baseline', action='store_true', help='今回の結果をベースラインとして保存する')
+    args = parser.parse_args()
+
+    pages = load_pages(args.corpus)
+    results = {name: run_benchmark(pages, name, args.repeat) for name in (args.parser or ['bs4', 'lxml'])}
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baselines = json.load(f)
+
+    failed = False
+    for name, result in results.items():
+        _print_result(result)
+        if args.update_baseline or name not in baselines:
+            continue
+        regressions = compare_with_baseline(result, baselines[name], args.tolerance)
+        for regression in regressions:
+            print(f"  REGRESSION {regression}")
+        failed = failed or bool(regressions)
+
+    if args.update_baseline:
+        baselines.update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, ensure_ascii=False, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif failed:
+        raise SystemExit(1)
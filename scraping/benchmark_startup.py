@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+CORPUS_DIR = os.path.join(FIXTURE_DIR, 'race_pages')
+BASELINE_PATH = os.path.join(FIXTURE_DIR, 'startup_baseline.json')
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 新しいインタープリターで実行する計測（Cloud Functionsのコールドスタートと同じ順に処理する）
+# argv: レースページのURL（{race_id}を含む）、レースID、パーサー
+_CHILD_SCRIPT = """
+import json, sys, threading, time
+start = time.perf_counter()
+import scraping.scraping_netkeiba as netkeiba
+imported = time.perf_counter()
+loaded = [name for name in netkeiba.HEAVY_MODULES if name in sys.modules]
+threading.Thread(target=netkeiba._import_heavy_modules, daemon=True).start()
+netkeiba.NetkeibaRaceScraper.RACE_URL = sys.argv[1]
+scraper = netkeiba.NetkeibaRaceScraper(storage='memory', use_calendar=False, publish_parquet=False, parser=sys.argv[3])
+created = time.perf_counter()
+race_id = sys.argv[2]
+html = scraper._fetch_race_page(race_id)
+fetched = time.perf_counter()
+race_data = scraper._parse_race_page(html)
+race_data['race_info']['race_id'] = race_id
+from scraping.result_columns import attach_race_id
+scraper.save_consolidated_csv([race_data['race_info']], attach_race_id(race_data['race_results'], race_id))
+saved = time.perf_counter()
+print(json.dumps({
+    'import_seconds': imported - start,
+    'init_seconds': created - imported,
+    'first_request_seconds': fetched - start,
+    'first_save_seconds': saved - start,
+    'heavy_modules_at_import': loaded,
+}))
+"""
+
+TIMINGS = ('import_seconds', 'init_seconds', 'first_request_seconds', 'first_save_seconds')
+
+
+def _serve_pages(corpus_dir):
+    """コーパスのページを /race/{race_id} で返すローカルのHTTPサーバーを起動する"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            race_id = self.path.rstrip('/').rsplit('/', 1)[-1]
+            path = os.path.join(corpus_dir, f'{race_id}.html')
+            if not os.path.exists(path):
+                self.send_error(404)
+                return
+            with open(path, 'rb') as f:
+                body = f.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=EUC-JP')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_benchmark(corpus_dir=CORPUS_DIR, parser='lxml', runs=5):
+    """
+    コールドスタートの時間を計測する（毎回新しいプロセスで import → スクレイパー作成 → 最初の取得 → 保存）
+    レースページはローカルのHTTPサーバーから返し、保存先はメモリにする（ネットワーク・GCSは使わない）
+    Args:
+        corpus_dir (str): race_idごとの*.html（EUC-JP）を置いたディレクトリ
+        parser (str): 'bs4' または 'lxml'
+        runs (int): 計測する回数（時間は中央値を使う）
+    Returns:
+        dict: 各段階までの秒数（中央値）と、import時点で読み込まれていた重いモジュール
+    """
+    race_id = sorted(name[:-len('.html')] for name in os.listdir(corpus_dir) if name.endswith('.html'))[0]
+    server = _serve_pages(corpus_dir)
+    url = f'http://127.0.0.1:{server.server_address[1]}/race/{{race_id}}'
+    samples = []
+    try:
+        for _ in range(runs):
+            completed = subprocess.run([sys.executable, '-c', _CHILD_SCRIPT, url, race_id, parser],
+                                       cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+            samples.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+    finally:
+        server.shutdown()
+
+    result = {'parser': parser, 'runs': runs}
+    for name in TIMINGS:
+        result[name] = round(statistics.median(sample[name] for sample in samples), 4)
+    result['heavy_modules_at_import'] = sorted({name for sample in samples for name in sample['heavy_modules_at_import']})
+    return result
+
+
+def compare_with_baseline(result, baseline, tolerance=0.3, min_seconds=0.05):
+    """
+    ベースラインと比べて遅くなった項目を返す
+    Args:
+        result (dict): run_benchmarkの結果
+        baseline (dict): 保存済みのrun_benchmarkの結果
+        tolerance (float): 許容する悪化の割合
+        min_seconds (float): これ未満の差は計測誤差として無視する（秒）
+    Returns:
+        list: 悪化した項目の説明
+    """
+    regressions = []
+    for name in TIMINGS:
+        seconds, base_seconds = result[name], baseline.get(name)
+        if base_seconds and seconds > base_seconds * (1 + tolerance) and seconds - base_seconds >= min_seconds:
+            regressions.append(f"{name}: {base_seconds} s -> {seconds} s")
+    for name in result['heavy_modules_at_import']:
+        if name not in baseline.get('heavy_modules_at_import', []):
+            regressions.append(f"{name} is imported at module load")
+    return regressions
+
+
+def _print_result(result):
+    print(f"[{result['parser']}] median of {result['runs']} cold starts")
+    for name in TIMINGS:
+        print(f"  {name:<24} {result[name]:>8.4f} s")
+    print(f"  heavy modules at import: {', '.join(result['heavy_modules_at_import']) or 'none'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='scrape_racesのコールドスタート（import・最初のリクエストまで）の時間を計測する')
+    parser.add_argument('--corpus', default=CORPUS_DIR, help='race_idごとの*.html（EUC-JP）を置いたディレクトリ')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--parser', choices=['bs4', 'lxml'], default='lxml')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--tolerance', type=float, default=0.3, help='ベースラインから許容する悪化の割合')
+    parser.add_argument('--update-baseline', action='store_true', help='今回の結果をベースラインとして保存する')
+    args = parser.parse_args()
+
+    result = run_benchmark(args.corpus, args.parser, args.runs)
+    _print_result(result)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baselines = json.load(f)
+
+    if args.update_baseline:
+        baselines[args.parser] = result
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, ensure_ascii=False, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif args.parser in baselines:
+        regressions = compare_with_baseline(result, baselines[args.parser], args.tolerance)
+        for regression in regressions:
+            print(f"  REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
@@ -0,0 +1,245 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+from scraping.storage_backends import RACE_INFO_BUCKET
+
+# レースごとの処理状況
+PENDING = 'pending'    # 取得予定（開催カレンダーで見つかった・結果がまだ出ていない。再試行の上限は無い）
+FETCHED = 'fetched'    # ページを取得した
+PARSED = 'parsed'      # パースした（保存前）
+SAVED = 'saved'        # ストレージに保存した
+MISSING = 'missing'    # ページが無い（開催が無い日の1レース目など）
+FAILED = 'failed'      # 取得・パースに失敗した（次回の実行で再試行する）
+STATUSES = (PENDING, FETCHED, PARSED, SAVED, MISSING, FAILED)
+# 完了していない状況（途中で止まった実行の続きで処理する）
+UNFINISHED = (PENDING, FETCHED, PARSED, FAILED)
+
+
+def split_race_id(race_id):
+    """レースID → (年, 競馬場コード, 開催回, 開催日, レース番号)"""
+    race_id = str(race_id)
+    return int(race_id[:4]), race_id[4:6], int(race_id[6:8]), int(race_id[8:10]), int(race_id[10:12])
+
+
+class CrawlState:
+    """
+    レース（年・競馬場・開催回・開催日・レース番号）ごとの処理状況
+    - ローカルのSQLiteに記録し、状況の更新は1回の呼び出しを1トランザクションで行う
+    - checkpoint()でSQLiteのファイルをストレージに書き戻す（保存のたびに呼ぶので、
+      Cloud Functionsの実行がタイムアウトしても、次の実行は最後に保存したところから続けられる）
+    - 失敗したレースは試行回数を数え、max_attempts回までは次の実行で再試行する
+    """
+
+    STATE_NAME = '_state/crawl_state.sqlite3'
+
+    def __init__(self, storage, path=None, bucket=RACE_INFO_BUCKET, name=STATE_NAME, max_attempts=5):
+        """
+        Args:
+            storage (StorageBackend): 状況の保存先
+            path (str, optional): ローカルのSQLiteファイル（省略時は一時ディレクトリ）
+            bucket (str): 状況を置くバケット
+            name (str): 状況のオブジェクト名
+            max_attempts (int): 失敗したレースを再試行する回数の上限
+        """
+        self.storage = storage
+        self.bucket = bucket
+        self.name = name
+        self.max_attempts = max_attempts
+        self.path = path or os.path.join(tempfile.mkdtemp(prefix='crawl_state_'), 'crawl_state.sqlite3')
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._db = None
+
+    @classmethod
+    def load(cls, storage, path=None, bucket=RACE_INFO_BUCKET, name=STATE_NAME, max_attempts=5):
+        """ストレージの状況（無ければ空の状況）を読み込む"""
+        state = cls(storage, path, bucket, name, max_attempts)
+        try:
+            data = storage.read_bytes(bucket, name)
+        except FileNotFoundError:
+            data = None
+        if data is not None:
+            # 前回の実行が書き戻した状況を正とする（同じインスタンスに残ったファイルより新しい）
+            os.makedirs(os.path.dirname(state.path) or '.', exist_ok=True)
+            tmp_path = f'{state.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, state.path)
+        state._open()
+        return state
+
+    def _open(self):
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS units (
+                race_id TEXT PRIMARY KEY,
+                year INTEGER NOT NULL,
+                place TEXT NOT NULL,
+                kai INTEGER NOT NULL,
+                day INTEGER NOT NULL,
+                race INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS units_status ON units (status, year)")
+        # 状況のファイルごとのID（取り込んだ側で、どのファイルの失敗をどこまで足したかを記録する）
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._db.execute("INSERT OR IGNORE INTO meta VALUES ('state_id', ?)", (uuid.uuid4().hex,))
+        # merge()で取り込んだ状況のファイル・レースごとの試行回数
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS merged (
+                state_id TEXT NOT NULL,
+                race_id TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                PRIMARY KEY (state_id, race_id)
+            )
+        """)
+        self._db.commit()
+
+    @property
+    def state_id(self):
+        """状況のファイルのID（ファイルを作ったときに決まり、書き戻し・読み込みで変わらない）"""
+        with self._lock:
+            return self._db.execute("SELECT value FROM meta WHERE key = 'state_id'").fetchone()[0]
+
+    def plan(self, race_ids):
+        """まだ記録の無いレースを取得予定として記録する"""
+        now = time.time()
+        rows = [(str(race_id), *split_race_id(race_id), PENDING, now) for race_id in race_ids]
+        if not rows:
+            return
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO units (race_id, year, place, kai, day, race, status, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self._dirty = True
+
+    def mark(self, race_ids, status, error=None):
+        """
+        レースの処理状況を更新する（まとめて1トランザクションで）
+        Args:
+            race_ids (iterable): レースID
+            status (str): STATUSESのいずれか
+            error (str, optional): 失敗の内容（FAILEDの場合）
+        """
+        if status not in STATUSES:
+            raise ValueError(f"Unknown crawl status: {status}")
+        now = time.time()
+        failed = int(status == FAILED)
+        rows = [(str(race_id), *split_race_id(race_id), status, failed, error, now) for race_id in race_ids]
+        if not rows:
+            return
+        with self._lock, self._db:
+            self._db.executemany("""
+                INSERT INTO units (race_id, year, place, kai, day, race, status, attempts, error, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (race_id) DO UPDATE SET
+                    status = excluded.status,
+                    attempts = units.attempts + excluded.attempts,
+                    error = excluded.error,
+                    updated_at = excluded.updated_at
+            """, rows)
+        self._dirty = True
+
+    def status(self, race_id):
+        """レースの処理状況（記録が無ければNone）"""
+        with self._lock:
+            row = self._db.execute("SELECT status FROM units WHERE race_id = ?", (str(race_id),)).fetchone()
+        return row[0] if row else None
+
+    def statuses(self, year=None):
+        """
+        レースID → 処理状況
+        Args:
+            year (int, optional): 指定された年のレースのみ
+        """
+        query, params = "SELECT race_id, status FROM units", ()
+        if year is not None:
+            query, params = query + " WHERE year = ?", (int(year),)
+        with self._lock:
+            return dict(self._db.execute(query, params).fetchall())
+
+    def gave_up(self, race_id):
+        """失敗の回数が上限に達したレースか"""
+        with self._lock:
+            row = self._db.execute("SELECT status, attempts FROM units WHERE race_id = ?", (str(race_id),)).fetchone()
+        return row is not None and row[0] == FAILED and row[1] >= self.max_attempts
+
+    def unfinished(self, year=None):
+        """
+        途中で止まった・失敗したレース（再試行の上限に達したものを除く）
+        Returns:
+            list: レースID（年・競馬場・開催回・開催日・レース番号の順）
+        """
+        query = (f"SELECT race_id FROM units WHERE status IN ({','.join('?' * len(UNFINISHED))})"
+                 " AND NOT (status = ? AND attempts >= ?)")
+        params = [*UNFINISHED, FAILED, self.max_attempts]
+        if year is not None:
+            query += " AND year = ?"
+            params.append(int(year))
+        query += " ORDER BY year, place, kai, day, race"
+        with self._lock:
+            return [row[0] for row in self._db.execute(query, params).fetchall()]
+
+    def summary(self, year=None):
+        """処理状況ごとのレース数"""
+        query, params = "SELECT status, COUNT(*) FROM units", ()
+        if year is not None:
+            query, params = query + " WHERE year = ?", (int(year),)
+        with self._lock:
+            counts = dict(self._db.execute(query + " GROUP BY status", params).fetchall())
+        return {status: counts.get(status, 0) for status in STATUSES}
+
+    def merge(self, other):
+        """
+        別の処理状況（シャードごとの状況など）を取り込む
+        同じレースは更新日時の新しい方の状況にし、失敗の回数は足し合わせる
+        同じ状況を取り込み直しても（まとめた後、シャードの状況を消す前に失敗した場合など）、
+        前回取り込んだ分の失敗の回数は足さない
+        Args:
+            other (CrawlState): 取り込む処理状況
+        """
+        state_id = other.state_id
+        with other._lock:
+            rows = other._db.execute(
+                "SELECT race_id, year, place, kai, day, race, status, attempts, error, updated_at FROM units"
+            ).fetchall()
+        if not rows:
+            return
+        with self._lock, self._db:
+            merged = dict(self._db.execute(
+                "SELECT race_id, attempts FROM merged WHERE state_id = ?", (state_id,)).fetchall())
+            self._db.executemany(
+                "INSERT OR REPLACE INTO merged (state_id, race_id, attempts) VALUES (?, ?, ?)",
+                [(state_id, row[0], row[7]) for row in rows])
+            # 前回取り込んだ後に増えた分だけを足す
+            rows = [(*row[:7], max(row[7] - merged.get(row[0], 0), 0), *row[8:]) for row in rows]
+            self._db.executemany("""
+                INSERT INTO units (race_id, year, place, kai, day, race, status, attempts, error, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (race_id) DO UPDATE SET
+                    status = excluded.status,
+                    attempts = units.attempts + excluded.attempts,
+                    error = excluded.error,
+                    updated_at = excluded.updated_at
+                WHERE excluded.updated_at >= units.updated_at
+            """, rows)
+        self._dirty = True
+
+    def checkpoint(self):
+        """変更があればSQLiteのファイルをストレージに書き戻す"""
+        if not self._dirty:
+            return
+        with self._lock:
+            # コミット済みの状態のファイルを読む（書き込みはロックの中でしか行わない）
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            self._dirty = False
+        self.storage.write_bytes(self.bucket, self.name, data, content_type='application/vnd.sqlite3')
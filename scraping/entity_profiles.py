@@ -0,0 +1,237 @@
+import argparse
+import os
+import re
+import time
+from datetime import datetime
+
+import pandas as pd
+import requests
+
+from scraping.metrics import log_event
+from scraping.partitioned_store import PartitionedStore
+from scraping.storage_backends import RACE_RESULT_BUCKET
+
+# 馬のプロフィール（レース結果とはhorse_idで結合する）
+HORSE_PROFILE_COLUMNS = [
+    'horse_id', 'horse_name', 'birth_date', 'sex', 'coat', 'trainer_id', 'owner', 'breeder',
+    'sire', 'sire_id', 'dam', 'dam_id', 'broodmare_sire', 'broodmare_sire_id',
+    'career_starts', 'career_wins', 'total_prize', 'fetched_at',
+]
+HORSE_PROFILE_KEY = ['horse_id']
+# 先頭の0を残すID列
+PROFILE_ID_COLUMNS = ('horse_id', 'trainer_id', 'sire_id', 'dam_id', 'broodmare_sire_id')
+
+HORSE_LINK_PATTERN = re.compile(r'/horse/(?:ped/)?([0-9A-Za-z]+)/?')
+TRAINER_LINK_PATTERN = re.compile(r'/trainer/(?:result/recent/)?([0-9A-Za-z]+)/?')
+BIRTH_DATE_PATTERN = re.compile(r'(\d{4})年(\d{1,2})月(\d{1,2})日')
+CAREER_PATTERN = re.compile(r'(\d+)戦(\d+)勝')
+PRIZE_PATTERN = re.compile(r'(?:(\d+)億)?([\d,.]+)万円')
+SEX_PATTERN = re.compile(r'(牡|牝|セ)\d*')
+
+
+class ProfileStore(PartitionedStore):
+    """
+    年・競馬場で分割しない追記専用のCSVストア（{table}/part-*.csv.gz）
+    プロフィールのようにレースに属さない行に使う（読み込み・コンパクションはPartitionedStoreと同じ）
+    """
+
+    def append(self, rows):
+        """
+        行をパートファイルとして追記する
+        Returns:
+            list: 書き出したパートファイル名
+        """
+        df = pd.DataFrame(rows)
+        if df.empty:
+            return []
+        return [self._write_part(self._new_part_name(self.partition_prefix()), df)]
+
+
+def _link_id(cell, pattern):
+    link = cell.select_one('a[href]') if cell is not None else None
+    match = pattern.search(link['href']) if link else None
+    return match.group(1) if match else None
+
+
+def _prize_yen(text):
+    """獲得賞金（"1億2,345万円 (中央)"）を円にする（中央・地方の両方があれば合計）"""
+    total = 0.0
+    for oku, man in PRIZE_PATTERN.findall(text):
+        total += (int(oku or 0) * 10000 + float(man.replace(',', ''))) * 10000
+    return total
+
+
+def parse_horse_profile(html, horse_id):
+    """
+    馬のページ（db.netkeiba.com/horse/{horse_id}/）からプロフィールと血統を取り出す
+    Args:
+        html (str): EUC-JPでデコードしたHTML
+        horse_id (str): 馬のID
+    Returns:
+        dict or None: HORSE_PROFILE_COLUMNSの列（fetched_atを除く）。馬のページでなければNone
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+    title = soup.select_one('div.horse_title h1')
+    if not title:
+        return None
+    profile = dict.fromkeys(HORSE_PROFILE_COLUMNS)
+    profile['horse_id'] = horse_id
+    profile['horse_name'] = title.text.strip()
+
+    # 「現役　牡4　鹿毛」
+    status = soup.select_one('div.horse_title p.txt_01')
+    if status:
+        for token in status.text.split():
+            if SEX_PATTERN.fullmatch(token):
+                profile['sex'] = token[0]
+            elif token.endswith('毛') or token in ('芦', '白'):
+                profile['coat'] = token
+
+    for row in soup.select('table.db_prof_table tr'):
+        th, td = row.select_one('th'), row.select_one('td')
+        if not th or not td:
+            continue
+        label, value = th.text.strip(), td.text.strip()
+        if label == '生年月日':
+            match = BIRTH_DATE_PATTERN.search(value)
+            if match:
+                profile['birth_date'] = '{:04d}-{:02d}-{:02d}'.format(*(int(group) for group in match.groups()))
+        elif label == '調教師':
+            profile['trainer_id'] = _link_id(td, TRAINER_LINK_PATTERN)
+        elif label == '馬主':
+            profile['owner'] = value
+        elif label == '生産者':
+            profile['breeder'] = value
+        elif label == '獲得賞金':
+            profile['total_prize'] = _prize_yen(value)
+        elif label == '通算成績':
+            match = CAREER_PATTERN.search(value)
+            if match:
+                profile['career_starts'], profile['career_wins'] = (int(group) for group in match.groups())
+
+    # 血統表：1行目の先頭が父、3行目の先頭が母・その次が母の父
+    blood_rows = soup.select('table.blood_table tr')
+    for name, row_index, cell_index in (('sire', 0, 0), ('dam', 2, 0), ('broodmare_sire', 2, 1)):
+        cells = blood_rows[row_index].select('td') if len(blood_rows) > row_index else []
+        if len(cells) > cell_index:
+            cell = cells[cell_index]
+            link = cell.select_one('a[href]')
+            profile[name] = (link or cell).text.strip()
+            profile[f'{name}_id'] = _link_id(cell, HORSE_LINK_PATTERN)
+    return profile
+
+
+class HorseProfileFetcher:
+    """
+    レース結果に出てきた馬のプロフィール・血統を取得し、別テーブル（horse_profile）に保存する
+    - クロール中に出てきたhorse_idはadd()で集め、重複を除いて最後にまとめて取得する
+    - 保存済みのプロフィールの取得時刻（fetched_at）をキャッシュとして使い、ttl_days以内のものは取得しない
+    - HTMLキャッシュがあればページもmax_age付きで経由する（期限内ならネットワークにアクセスしない）
+    """
+
+    HORSE_URL = 'https://db.netkeiba.com/horse/{horse_id}/'
+
+    def __init__(self, scraper, ttl_days=30, batch_size=200, table='horse_profile'):
+        """
+        Args:
+            scraper (NetkeibaRaceScraper): 取得に使うスクレイパー（フェッチエンジン・HTMLキャッシュ・ストレージを共有）
+            ttl_days (float): 取得したプロフィールを何日間使うか
+            batch_size (int): 何頭ごとにパートファイルとして書き出すか
+            table (str): 保存先のテーブル名
+        """
+        self.scraper = scraper
+        self.ttl_seconds = ttl_days * 24 * 60 * 60
+        self.batch_size = batch_size
+        self.store = ProfileStore(scraper.storage, RACE_RESULT_BUCKET, table, HORSE_PROFILE_KEY,
+                                  HORSE_PROFILE_COLUMNS, string_columns=PROFILE_ID_COLUMNS)
+        self._pending = set()
+        self._fetched_at = None
+
+    def add(self, horse_ids):
+        """取得する馬を追加する（同じ馬は1回だけ取得する）"""
+        self._pending.update(str(horse_id) for horse_id in horse_ids if isinstance(horse_id, str) and horse_id)
+
+    def fetched_at(self):
+        """保存済みのプロフィールの取得時刻（horse_id → UNIX時間。初回のみストレージから読み込む）"""
+        if self._fetched_at is None:
+            df = self.store.read(columns=['fetched_at'])
+            self._fetched_at = dict(zip(df['horse_id'].astype(str), df['fetched_at'].astype(float)))
+        return self._fetched_at
+
+    def stale_ids(self, horse_ids):
+        """プロフィールが無いか、ttl_daysより前に取得した馬（ID順）"""
+        now = time.time()
+        fetched_at = self.fetched_at()
+        return sorted(
+            horse_id for horse_id in set(horse_ids)
+            if now - fetched_at.get(horse_id, float('-inf')) >= self.ttl_seconds
+        )
+
+    def _fetch_profile(self, horse_id):
+        url = self.HORSE_URL.format(horse_id=horse_id)
+        try:
+            if self.scraper.page_cache:
+                content = self.scraper.page_cache.fetch(self.scraper.fetcher, f'horse/{horse_id}', url,
+                                                        max_age=self.ttl_seconds)
+            else:
+                response = self.scraper.fetcher.fetch(url)
+                response.raise_for_status()
+                content = response.content
+        except requests.exceptions.RequestException as e:
+            self.scraper.metrics.inc('scrape_errors_total', stage='profile')
+            print(f"Error fetching horse profile {horse_id}: {str(e)}")
+            return None
+        profile = parse_horse_profile(content.decode('EUC-JP', errors='replace'), horse_id)
+        if profile is not None:
+            profile['fetched_at'] = time.time()
+        return profile
+
+    def fetch(self, horse_ids=None):
+        """
+        プロフィールを取得して保存する
+        Args:
+            horse_ids (iterable, optional): 取得する馬（省略時はadd()で集めた馬）
+        Returns:
+            dict: requested（期限切れ・未取得の馬）/ saved / failed の頭数
+        """
+        if horse_ids is None:
+            horse_ids, self._pending = self._pending, set()
+        targets = self.stale_ids(horse_ids)
+        summary = {'requested': len(targets), 'saved': 0, 'failed': 0}
+        for start in range(0, len(targets), self.batch_size):
+            batch = targets[start:start + self.batch_size]
+            profiles = [profile for profile in self.scraper.fetcher.map(self._fetch_profile, batch) if profile]
+            if profiles:
+                self.store.append(profiles)
+                self._fetched_at.update((profile['horse_id'], profile['fetched_at']) for profile in profiles)
+            summary['saved'] += len(profiles)
+            summary['failed'] += len(batch) - len(profiles)
+        self.scraper.metrics.inc('profiles_saved_total', summary['saved'], entity='horse')
+        log_event('Horse profiles fetched', **summary)
+        return summary
+
+    def read(self):
+        """保存済みのプロフィール（馬ごとに最新の1行）"""
+        return self.store.read()
+
+
+if __name__ == "__main__":
+    from scraping.scraping_netkeiba import NetkeibaRaceScraper
+    from scraping.storage_backends import create_storage
+
+    parser = argparse.ArgumentParser(description='保存済みのレース結果に出てくる馬のプロフィール・血統を取得する')
+    parser.add_argument('--year', type=int, default=datetime.now().year)
+    parser.add_argument('--ttl-days', type=float, default=30, help='取得したプロフィールを何日間使うか')
+    parser.add_argument('--storage', choices=['local', 'gcs'], default=os.environ.get('KEIBA_STORAGE_BACKEND', 'local'))
+    parser.add_argument('--storage-dir', default=os.environ.get('KEIBA_STORAGE_DIR', 'data'))
+    parser.add_argument('--cache-dir', help='生HTMLキャッシュのディレクトリ')
+    args = parser.parse_args()
+
+    scraper = NetkeibaRaceScraper(storage=create_storage(args.storage, args.storage_dir), cache_dir=args.cache_dir,
+                                  use_calendar=False)
+    results = scraper.result_store.read(args.year, columns=['horse_id'])
+    fetcher = HorseProfileFetcher(scraper, ttl_days=args.ttl_days)
+    summary = fetcher.fetch(results['horse_id'].dropna().astype(str) if 'horse_id' in results else [])
+    print(f"Horse profiles: {summary['saved']} saved, {summary['failed']} failed of {summary['requested']} requested")
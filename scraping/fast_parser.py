@@ -0,0 +1,197 @@
+import argparse
+import os
+
+import lxml.etree
+import lxml.html
+
+from scraping.result_columns import entity_ids
+
+
+def _class_xpath(class_name):
+    """CSSの .class_name に相当するXPath条件"""
+    return f'contains(concat(" ", normalize-space(@class), " "), " {class_name} ")'
+
+
+# BeautifulSoupのCSSセレクタと同じ要素を選ぶXPath（コンパイル済み）
+RACE_NAME_XPATH = lxml.etree.XPath(f'(//dl[{_class_xpath("racedata")}]//h1)[1]')
+DATA_INTRO_XPATH = lxml.etree.XPath(f'(//div[{_class_xpath("data_intro")}])[1]')
+SMALLTXT_XPATH = lxml.etree.XPath(f'(//div[{_class_xpath("data_intro")}]//p[{_class_xpath("smalltxt")}])[1]')
+RESULT_TABLE_XPATHS = (
+    lxml.etree.XPath(f'(//*[{_class_xpath("race_table_01")}])[1]'),
+    lxml.etree.XPath(f'(//*[{_class_xpath("RaceTable01")}])[1]'),
+)
+HEADER_XPATH = lxml.etree.XPath('.//tr//th')
+ROW_XPATH = lxml.etree.XPath('.//tr')
+CELL_XPATH = lxml.etree.XPath('.//td')
+LINK_XPATH = lxml.etree.XPath('.//a/@href')
+DETAIL_SPAN_XPATHS = {
+    key: lxml.etree.XPath(f'(.//span[{_class_xpath(class_name)}])[1]')
+    for key, class_name in (
+        ('course_info', 'race_course'),
+        ('weather', 'weather'),
+        ('course_condition', 'course_condition'),
+        ('race_time', 'race_time'),
+    )
+}
+# BeautifulSoupの.textと同様に、script/styleとコメントのテキストは含めない
+TEXT_XPATH = lxml.etree.XPath('.//text()[not(ancestor::script) and not(ancestor::style)]')
+
+
+def _text(element):
+    return ''.join(TEXT_XPATH(element))
+
+
+def _first(xpath, node):
+    found = xpath(node)
+    return found[0] if found else None
+
+
+def parse_document(html):
+    """HTML文字列をlxmlの木にする"""
+    return lxml.html.fromstring(html)
+
+
+def has_result_table(tree):
+    """結果表（.race_table_01）があるか"""
+    return _first(RESULT_TABLE_XPATHS[0], tree) is not None
+
+
+def extract_race_info_texts(tree):
+    """
+    レースの基本情報の組み立てに使うテキストを抜き出す
+    Returns:
+        tuple: (レース名, p.smalltxtのテキスト, div.data_introのテキスト)（無い要素はNone）
+    """
+    race_name = _first(RACE_NAME_XPATH, tree)
+    smalltxt = _first(SMALLTXT_XPATH, tree)
+    data_intro = _first(DATA_INTRO_XPATH, tree)
+    return (
+        _text(race_name) if race_name is not None else None,
+        _text(smalltxt) if smalltxt is not None else None,
+        _text(data_intro) if data_intro is not None else None,
+    )
+
+
+def extract_race_details(tree):
+    """レース詳細情報を取得（NetkeibaRaceScraper._get_race_detailsと同じ辞書を返す）"""
+    data_intro = _first(DATA_INTRO_XPATH, tree)
+    if data_intro is None:
+        return {}
+    details = {}
+    for key, xpath in DETAIL_SPAN_XPATHS.items():
+        span = _first(xpath, data_intro)
+        details[key] = _text(span).strip() if span is not None else None
+    return details
+
+
+def extract_result_table(tree):
+    """
+    結果表の見出しとセルのテキスト・馬／騎手／調教師のIDを抜き出す
+    Returns:
+        tuple: (見出しのリスト, tdを持つ行ごとのセルのテキストのリスト, 行ごとのIDの辞書のリスト)
+            （結果表が無い場合は([], [], [])）
+    """
+    result_table = None
+    for xpath in RESULT_TABLE_XPATHS:
+        result_table = _first(xpath, tree)
+        if result_table is not None:
+            break
+    if result_table is None:
+        return [], [], []
+
+    headers = [_text(th).strip() for th in HEADER_XPATH(result_table)]
+    rows = []
+    row_entity_ids = []
+    for row in ROW_XPATH(result_table):
+        cells = CELL_XPATH(row)
+        if cells:
+            rows.append([_text(cell).strip() for cell in cells])
+            row_entity_ids.append(entity_ids(LINK_XPATH(row)))
+    return headers, rows, row_entity_ids
+
+
+def check_parity(scraper, pages):
+    """
+    BeautifulSoup版とlxml版のパース結果が一致するかを確認する
+    Args:
+        scraper (NetkeibaRaceScraper): パースに使うスクレイパー
+        pages (dict): ページ名 → HTML文字列
+    Returns:
+        list: 一致しなかったページ名
+    """
+    mismatches = []
+    for name, html in pages.items():
+        expected = scraper._parse_race_page(html, parser='bs4')
+        actual = scraper._parse_race_page(html, parser='lxml')
+        if expected != actual:
+            mismatches.append(name)
+            for key in expected:
+                if expected[key] != actual.get(key):
+                    print(f"{name}: {key} differs\n  bs4:  {expected[key]}\n  lxml: {actual.get(key)}")
+    return mismatches
+
+
+def check_save(pages):
+    """
+    行形式・列形式のそれぞれでパース結果を保存し、同じ行数が保存されて処理状況がSAVEDになるかを確認する
+    Args:
+        pages (dict): ページ名（race_id.html）→ HTML文字列
+    Returns:
+        list: 問題のあった結果の形式
+    """
+    from scraping.crawl_state import SAVED
+    from scraping.result_columns import attach_race_id
+    from scraping.scraping_netkeiba import NetkeibaRaceScraper
+
+    failures = []
+    saved_rows = {}
+    for result_format in ('rows', 'columns'):
+        scraper = NetkeibaRaceScraper(storage='memory', result_format=result_format, publish_parquet=False)
+        race_infos, race_results = [], []
+        for name, html in pages.items():
+            race_id = os.path.splitext(name)[0]
+            race_data = scraper._parse_race_page(html)
+            race_infos.append({**race_data['race_info'], 'race_id': race_id})
+            race_results.extend(attach_race_id(race_data['race_results'], race_id))
+        try:
+            scraper.save_consolidated_csv(race_infos, race_results)
+        except Exception as e:
+            print(f"{result_format}: save failed: {e!r}")
+            failures.append(result_format)
+            continue
+        unsaved = [race_id for race_id in (info['race_id'] for info in race_infos)
+                   if scraper.get_crawl_state().status(race_id) != SAVED]
+        if unsaved:
+            print(f"{result_format}: races not marked as saved: {unsaved}")
+            failures.append(result_format)
+        saved_rows[result_format] = len(scraper.result_store.read())
+    if len(set(saved_rows.values())) > 1:
+        print(f"Saved result rows differ between formats: {saved_rows}")
+        failures.append('columns')
+    return failures
+
+
+def load_pages(directory, encoding='EUC-JP'):
+    """ディレクトリ内の*.htmlをページ名 → HTML文字列の辞書として読み込む"""
+    pages = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.html'):
+            with open(os.path.join(directory, filename), 'rb') as f:
+                pages[filename] = f.read().decode(encoding, errors='replace')
+    return pages
+
+
+if __name__ == "__main__":
+    from scraping.scraping_netkeiba import NetkeibaRaceScraper
+
+    parser = argparse.ArgumentParser(description='保存済みページでBeautifulSoup版とlxml版のパース結果を比較する')
+    parser.add_argument('directory', help='race_idごとの*.html（EUC-JP）を置いたディレクトリ')
+    args = parser.parse_args()
+
+    pages = load_pages(args.directory)
+    mismatches = check_parity(NetkeibaRaceScraper(storage='memory'), pages)
+    print(f"{len(pages) - len(mismatches)}/{len(pages)} pages matched")
+    failures = check_save(pages)
+    print(f"Saved rows and columns results: {'failed (' + ', '.join(failures) + ')' if failures else 'ok'}")
+    if mismatches or failures:
+        raise SystemExit(1)
@@ -0,0 +1,200 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+
+from scraping.http_session import create_session, timed_get
+from scraping.metrics import MetricsRegistry
+
+
+class TokenBucket:
+    """
+    トークンバケット方式のレートリミッター
+    Args:
+        rate (float): 1秒あたりに補充されるトークン数（許可するリクエスト数）
+        capacity (int): バケットの容量（バーストで許可するリクエスト数）
+    """
+
+    def __init__(self, rate, capacity=1):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.capacity = max(1, int(capacity))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """トークンを1つ取得できるまで待機する"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostRateLimiter:
+    """ホストごとにトークンバケットを管理するレートリミッター"""
+
+    def __init__(self, rate=1.0, capacity=1, host_rates=None):
+        """
+        Args:
+            rate (float): デフォルトの1秒あたりリクエスト数
+            capacity (int): デフォルトのバースト数
+            host_rates (dict, optional): ホスト名 → (rate, capacity) の個別設定
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.host_rates = host_rates or {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                rate, capacity = self.host_rates.get(host, (self.rate, self.capacity))
+                bucket = TokenBucket(rate, capacity)
+                self._buckets[host] = bucket
+        bucket.acquire()
+
+
+class ConcurrentFetcher:
+    """
+    スレッドプールによる並列フェッチエンジン
+    - ホストごとのトークンバケットでリクエストレートを制限
+    - 同時リクエスト数をmax_concurrencyで制限
+    - 429/5xxはジッター付き指数バックオフでリトライ
+    - リクエストの所要時間・ステータスコード・受信バイト数・リトライ回数をmetricsに記録
+    """
+
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self, headers=None, requests_per_second=1.0, burst=1, max_concurrency=4,
+                 max_retries=3, backoff_base=2.0, backoff_max=60.0, host_rates=None,
+                 session=None, timeout=(5, 30), metrics=None):
+        """
+        Args:
+            headers (dict, optional): 全リクエストに付与するヘッダー
+            requests_per_second (float): ホストごとの1秒あたりリクエスト数
+            burst (int): ホストごとのバースト数
+            max_concurrency (int): 同時に実行するリクエスト数の上限
+            max_retries (int): 429/5xx時のリトライ回数
+            backoff_base (float): バックオフの基準秒数
+            backoff_max (float): バックオフの最大秒数
+            host_rates (dict, optional): ホスト名 → (rate, burst) の個別設定
+            session (requests.Session, optional): 使い回すセッション（省略時は接続プール付きで作成）
+            timeout (float or tuple): (接続, 読み取り) のタイムアウト秒数
+            metrics (MetricsRegistry, optional): 計測値の記録先（省略時はこのフェッチャー専用）
+        """
+        self.headers = headers or {}
+        self.session = session or create_session(pool_size=max(10, int(max_concurrency)))
+        self.timeout = timeout
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = HostRateLimiter(requests_per_second, burst, host_rates)
+        self._semaphore = threading.BoundedSemaphore(self.max_concurrency)
+        self.metrics = metrics or MetricsRegistry()
+        # フェーズごとの累計時間（dns / connect / ttfb / download / total）
+        self._timing_totals = {}
+        self._timing_count = 0
+        self._timing_lock = threading.Lock()
+
+    def _backoff_seconds(self, attempt, response=None):
+        """Retry-Afterヘッダーを優先し、なければフルジッター付き指数バックオフ"""
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                return min(self.backoff_max, float(retry_after))
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _send(self, url, headers):
+        host = urlparse(url).netloc
+        try:
+            response = timed_get(self.session, url, headers=headers, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            self.metrics.inc('http_errors_total', host=host, error=type(e).__name__)
+            raise
+        status = response.status_code
+        self.metrics.inc('http_requests_total', host=host, status=status)
+        self.metrics.inc('http_response_bytes_total', len(response.content), host=host)
+        self.metrics.observe('http_request_seconds', response.timing['total'], host=host, status=status)
+        with self._timing_lock:
+            self._timing_count += 1
+            for phase, seconds in response.timing.items():
+                self._timing_totals[phase] = self._timing_totals.get(phase, 0.0) + seconds
+        return response
+
+    def timing_summary(self):
+        """
+        これまでのリクエストのフェーズ別平均時間を返す
+        Returns:
+            dict: {'requests': 件数, 'dns': 平均秒, 'connect': ..., 'ttfb': ..., 'download': ..., 'total': ...}
+        """
+        with self._timing_lock:
+            count = self._timing_count
+            summary = {phase: total / count for phase, total in self._timing_totals.items()} if count else {}
+        summary['requests'] = count
+        return summary
+
+    def fetch(self, url, headers=None):
+        """
+        URLを取得する（レート制限とリトライ付き）
+        Args:
+            url (str): 取得するURL
+            headers (dict, optional): このリクエストだけに追加するヘッダー
+        Returns:
+            requests.Response: 最終的なレスポンス（リトライ上限に達した場合は最後のレスポンス）
+        """
+        request_headers = dict(self.headers)
+        if headers:
+            request_headers.update(headers)
+
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire(url)
+            with self._semaphore:
+                response = self._send(url, request_headers)
+            if response.status_code not in self.RETRY_STATUS_CODES or attempt >= self.max_retries:
+                return response
+            wait = self._backoff_seconds(attempt, response)
+            self.metrics.inc('http_retries_total', host=urlparse(url).netloc, status=response.status_code)
+            print(f"HTTP {response.status_code} for {url}, retrying in {wait:.1f}s ({attempt + 1}/{self.max_retries})")
+            time.sleep(wait)
+            attempt += 1
+
+    def map(self, func, items):
+        """
+        itemsの各要素にfuncを並列に適用する（結果は入力順）
+        funcの中でfetchを呼べば、レート制限と同時実行数の制限がそのまま効く
+        """
+        items = list(items)
+        if not items:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(items))) as executor:
+            return list(executor.map(func, items))
+
+    def fetch_many(self, urls, headers=None):
+        """
+        複数のURLを並列に取得する
+        Returns:
+            list: 入力順のレスポンス（例外が発生したURLは例外オブジェクト）
+        """
+        def _fetch(url):
+            try:
+                return self.fetch(url, headers=headers)
+            except requests.exceptions.RequestException as e:
+                return e
+
+        return self.map(_fetch, urls)
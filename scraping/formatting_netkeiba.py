@@ -1,41 +1,263 @@
+import argparse
+import io
+import json
+import os
+import shutil
+
 import pandas as pd
 
-# CSVファイルを読み込む
-df = pd.read_csv('results/race_result_consolidated.csv')
-
-# データの確認
-print("変換前のデータ例：")
-print("日付例：", df['race_date'].head())
-print("時刻例：", df['start_time'].head())
-print("着順例：", df['着順'].head())
-print("単勝例：", df['単勝'].head())
-
-# 日付形式を変換（順序を修正）
-df['race_date'] = (df['race_date']
-                  .str.replace('年', '-')
-                  .str.replace('月', '-')
-                  .str.replace('日', ''))
-df['race_date'] = pd.to_datetime(df['race_date'])
-df['race_date'] = df['race_date'].dt.strftime('%Y-%m-%d')
-
-# 時刻形式を変換（HH:MM → HH:MM:00）
-df['start_time'] = df['start_time'] + ':00'
-
-# 着順カラムの特殊な値を処理
-# 数値以外の値（中止、除外、取消など）を-1に変換
-df['着順'] = pd.to_numeric(df['着順'], errors='coerce').fillna(-1).astype(int)
-
-# 単勝オッズの処理
-# "---"などの特殊な値を-1に変換
-df['単勝'] = df['単勝'].replace('---', '-1')  # 特殊な値を-1に置換
-df['単勝'] = pd.to_numeric(df['単勝'], errors='coerce').fillna(-1)  # 数値変換できない値も-1に
-
-# 変換後のデータを確認
-print("\n変換後のデータ例：")
-print("日付例：", df['race_date'].head())
-print("時刻例：", df['start_time'].head())
-print("着順例：", df['着順'].head())
-print("単勝例：", df['単勝'].head())
-
-# 変換したデータを保存
-df.to_csv('results/race_result_formatted.csv', index=False)
+INPUT_PATH = 'results/race_result_consolidated.csv'
+OUTPUT_PATH = 'results/race_result_formatted.csv'
+CHUNK_SIZE = 100_000
+
+
+def format_chunk(df):
+    """
+    1チャンク分の行を整形する
+    Args:
+        df (DataFrame): 全列を文字列として読み込んだ行
+    Returns:
+        DataFrame: 整形した行
+    """
+    # 日付形式をそろえる（スクレイパーの2024-05-26はそのまま、2024年5月26日 → 2024-05-26。形式を固定して推測させない）
+    if 'race_date' in df.columns:
+        df['race_date'] = format_race_date(df['race_date'])
+
+    # 時刻形式を変換（HH:MM → HH:MM:00）
+    if 'start_time' in df.columns:
+        df['start_time'] = df['start_time'].where(df['start_time'] == '', df['start_time'] + ':00')
+
+    # 着順カラムの特殊な値を処理
+    # 数値以外の値（中止、除外、取消など）を-1に変換
+    if '着順' in df.columns:
+        df['着順'] = pd.to_numeric(df['着順'], errors='coerce').fillna(-1).astype(int)
+
+    # 単勝オッズの処理
+    # "---"などの特殊な値を-1に変換
+    if '単勝' in df.columns:
+        df['単勝'] = df['単勝'].replace('---', '-1')  # 特殊な値を-1に置換
+        df['単勝'] = pd.to_numeric(df['単勝'], errors='coerce').fillna(-1)  # 数値変換できない値も-1に
+
+    return df
+
+
+def format_race_date(values):
+    """
+    レース日をYYYY-MM-DDにする（ISO形式を先に試し、だめなら年月日の形式）
+    どちらの形式でもない値は空にせず元の値のまま残し、件数を表示する
+    """
+    race_date = pd.to_datetime(values, format='%Y-%m-%d', errors='coerce')
+    race_date = race_date.fillna(pd.to_datetime(values, format='%Y年%m月%d日', errors='coerce'))
+    formatted = race_date.dt.strftime('%Y-%m-%d')
+    unparsed = formatted.isna() & (values != '')
+    if unparsed.any():
+        print(f"Kept {int(unparsed.sum())} race_date values in an unknown format "
+              f"(e.g. {values[unparsed].iloc[0]!r})")
+    return formatted.where(formatted.notna(), values)
+
+
+class _BoundedReader(io.RawIOBase):
+    """ファイルの現在位置からlimitバイトだけを読めるようにする"""
+
+    def __init__(self, f, limit):
+        self.f = f
+        self.remaining = limit
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        data = self.f.read(size)
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+class RaceResultFormatter:
+    """
+    統合済みのレース結果CSVを整形する
+    - 入力はチャンクごとに読み込むので、何シーズン分あってもメモリ使用量は一定
+    - 全列を文字列として読み込み（型の推測をしない）、整形する列だけ変換する
+    - 前回整形した位置（バイトオフセット）を透かしとして保存し、追記された行だけを処理する
+    - 追記分だけを整形し、前回の出力のコピー（整形し直さずにバイト列のまま写す）の末尾に足す
+    - 出力は常に一時ファイルに書いてから置き換える（読み手に書きかけの出力が見えず、途中で失敗しても
+      前回の出力は壊れない）
+    """
+
+    def __init__(self, input_path=INPUT_PATH, output_path=OUTPUT_PATH, chunk_size=CHUNK_SIZE,
+                 watermark_path=None):
+        """
+        Args:
+            input_path (str): 統合済みのレース結果CSV（追記されていくもの）
+            output_path (str): 整形後のCSV
+            chunk_size (int): 1度に読み込む行数
+            watermark_path (str, optional): 透かしのファイル（省略時は出力ファイル名 + '.watermark.json'）
+        """
+        self.input_path = input_path
+        self.output_path = output_path
+        self.chunk_size = chunk_size
+        self.watermark_path = watermark_path or f'{output_path}.watermark.json'
+
+    def _read_header(self):
+        with open(self.input_path, encoding='utf-8', newline='') as f:
+            return pd.read_csv(f, nrows=0).columns.tolist()
+
+    def load_watermark(self):
+        """前回の透かし（無ければNone）"""
+        try:
+            with open(self.watermark_path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _resume_offset(self, header):
+        """
+        追記分だけを処理できる場合は前回の終了位置、最初から処理し直す場合はNoneを返す
+        （出力が無いか透かしの記録より短い、入力の列が変わった、入力が前回より短い＝作り直された場合は最初から）
+        """
+        watermark = self.load_watermark()
+        if watermark is None or not os.path.exists(self.output_path):
+            return None
+        # 記録より長い分は透かしを書く前に落ちた前回の追記なので、_appendでコピーから除く
+        if os.path.getsize(self.output_path) < watermark['output_size']:
+            return None
+        if watermark['columns'] != header or os.path.getsize(self.input_path) < watermark['offset']:
+            return None
+        return watermark['offset']
+
+    def _complete_rows_end(self):
+        """
+        今回処理する範囲の終了位置（最後の改行の直後）
+        処理中に追記された行や書きかけの行は次回に回す
+        """
+        size = os.path.getsize(self.input_path)
+        with open(self.input_path, 'rb') as f:
+            position = size
+            while position > 0:
+                start = max(0, position - 65536)
+                f.seek(start)
+                newline = f.read(position - start).rfind(b'\n')
+                if newline >= 0:
+                    return start + newline + 1
+                position = start
+        return 0
+
+    def _chunks(self, header, offset, end_offset):
+        """入力のoffset〜end_offsetを全列文字列としてチャンクごとに読み込む"""
+        with open(self.input_path, 'rb') as f:
+            f.seek(offset or 0)
+            bounded = io.BufferedReader(_BoundedReader(f, end_offset - (offset or 0)))
+            options = {'dtype': str, 'keep_default_na': False, 'chunksize': self.chunk_size, 'encoding': 'utf-8'}
+            if offset is None:
+                reader = pd.read_csv(bounded, **options)
+            else:
+                reader = pd.read_csv(bounded, header=None, names=header, **options)
+            with reader:
+                for chunk in reader:
+                    yield chunk
+
+    def _write_json_atomic(self, path, data):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _write_chunks(self, out, header, offset, end_offset, write_header):
+        formatted_rows = 0
+        for chunk in self._chunks(header, offset, end_offset):
+            chunk = format_chunk(chunk)
+            chunk.to_csv(out, index=False, header=write_header)
+            write_header = False
+            formatted_rows += len(chunk)
+        if write_header:
+            pd.DataFrame(columns=header).to_csv(out, index=False)
+        return formatted_rows
+
+    def _replace_output(self, write):
+        """
+        一時ファイルに書いてから出力を置き換える（書き終えてディスクに書き出してから置き換える）
+        Args:
+            write (callable): 一時ファイルのパス → 整形した行数
+        """
+        tmp_path = f'{self.output_path}.{os.getpid()}.tmp'
+        try:
+            formatted_rows = write(tmp_path)
+            with open(tmp_path, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.output_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return formatted_rows
+
+    def _append(self, header, offset, end_offset):
+        """前回の出力のコピーの末尾に追記分を足してから置き換える"""
+        output_size = self.load_watermark()['output_size']
+
+        def write(tmp_path):
+            shutil.copyfile(self.output_path, tmp_path)
+            # 透かしより後ろは前回の書きかけ（透かしを書く前に落ちた分）なので除く
+            os.truncate(tmp_path, output_size)
+            with open(tmp_path, 'a', encoding='utf-8', newline='') as out:
+                return self._write_chunks(out, header, offset, end_offset, write_header=False)
+
+        return self._replace_output(write)
+
+    def _rewrite(self, header, end_offset):
+        """最初から整形し、一時ファイルに書いてから出力を置き換える"""
+        # 置き換えた後に透かしを書く前に落ちても、古い透かしで新しい出力に追記しないように先に消す
+        if os.path.exists(self.watermark_path):
+            os.remove(self.watermark_path)
+
+        def write(tmp_path):
+            with open(tmp_path, 'w', encoding='utf-8', newline='') as out:
+                return self._write_chunks(out, header, None, end_offset, write_header=True)
+
+        return self._replace_output(write)
+
+    def run(self, full=False):
+        """
+        整形を実行する
+        Args:
+            full (bool): 透かしを無視して最初から整形し直す
+        Returns:
+            int: 整形した行数
+        """
+        header = self._read_header()
+        end_offset = self._complete_rows_end()
+        offset = None if full else self._resume_offset(header)
+        if offset is not None and offset == end_offset:
+            print("No new rows to format")
+            return 0
+
+        output_dir = os.path.dirname(self.output_path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        if offset is not None:
+            formatted_rows = self._append(header, offset, end_offset)
+        else:
+            formatted_rows = self._rewrite(header, end_offset)
+
+        # 出力のサイズも記録しておき、出力を置き換えてから透かしを書く前に落ちた場合は次回その位置から追記し直す
+        self._write_json_atomic(self.watermark_path, {
+            'offset': end_offset,
+            'columns': header,
+            'output_size': os.path.getsize(self.output_path),
+        })
+        print(f"Formatted {formatted_rows} rows ({'incremental' if offset is not None else 'full'}) "
+              f"into {self.output_path}")
+        return formatted_rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='統合済みのレース結果CSVを整形する（追記された行だけを処理）')
+    parser.add_argument('--input', default=INPUT_PATH)
+    parser.add_argument('--output', default=OUTPUT_PATH)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--full', action='store_true', help='透かしを無視して最初から整形し直す')
+    args = parser.parse_args()
+
+    RaceResultFormatter(args.input, args.output, args.chunk_size).run(full=args.full)
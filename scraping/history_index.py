@@ -0,0 +1,365 @@
+import io
+import posixpath
+
+import numpy as np
+import pandas as pd
+
+from scraping.partitioned_store import unread_parts
+from scraping.storage_backends import RACE_RESULT_BUCKET
+
+# インデックスを作る対象 → レース結果の列
+ENTITY_COLUMNS = {
+    'horse': '馬名',
+    'jockey': '騎手',
+    'trainer': '調教師',
+}
+
+# 履歴として持つ列（列名は nk_race_result_schema.json に合わせる）
+# 整数の欠損は-1、小数の欠損はNaN、日付の欠損はNaT
+HISTORY_DTYPE = np.dtype([
+    ('race_id', 'U12'),
+    ('race_date', 'datetime64[D]'),
+    ('horse', 'i4'),
+    ('jockey', 'i4'),
+    ('trainer', 'i4'),
+    ('horse_number', 'i2'),
+    ('rank', 'i2'),
+    ('popularity', 'i2'),
+    ('burden_weight', 'f4'),
+    ('finish_time', 'f4'),
+    ('last_3f', 'f4'),
+    ('odds', 'f4'),
+    ('horse_weight', 'i2'),
+    ('distance', 'i2'),
+    ('track_type', 'U2'),
+    ('track_condition', 'U2'),
+    ('venue', 'U4'),
+])
+# 履歴の列 → レース結果の列
+RESULT_FIELDS = {
+    'horse_number': '馬番',
+    'rank': '着順',
+    'popularity': '人気',
+    'burden_weight': '斤量',
+    'finish_time': 'タイム',
+    'last_3f': '上り',
+    'odds': '単勝',
+    'horse_weight': '馬体重',
+}
+# 履歴の列 → レース情報の列
+INFO_FIELDS = {
+    'race_date': 'race_date',
+    'distance': 'track_distance',
+    'track_type': 'track_type',
+    'track_condition': 'track_condition',
+    'venue': 'kaisai_place',
+}
+
+_DEAD = ''  # 置き換えられた行のrace_id
+
+
+def _upgrade_rows(rows):
+    """race_idが整数だった以前のインデックスの行を、race_idを文字列にした行にする（海外のレースIDは英字を含む）"""
+    if rows.dtype == HISTORY_DTYPE:
+        return rows
+    upgraded = np.zeros(len(rows), dtype=HISTORY_DTYPE)
+    for field in HISTORY_DTYPE.names:
+        if field != 'race_id':
+            upgraded[field] = rows[field]
+    race_ids = rows['race_id']
+    upgraded['race_id'] = np.where(race_ids < 0, _DEAD, race_ids.astype(str))
+    return upgraded
+
+
+def _field_values(df, name, dtype):
+    """DataFrameの列を履歴の型の配列にする（列が無ければ欠損）"""
+    n = len(df)
+    if dtype.kind == 'M':
+        if name not in df.columns:
+            return np.full(n, np.datetime64('NaT'), dtype=dtype)
+        return pd.to_datetime(df[name], errors='coerce').to_numpy().astype(dtype)
+    if dtype.kind == 'U':
+        if name not in df.columns:
+            return np.full(n, '', dtype=dtype)
+        return df[name].astype(object).where(df[name].notna(), '').astype(str).to_numpy().astype(dtype)
+    if name not in df.columns:
+        return np.full(n, -1 if dtype.kind == 'i' else np.nan, dtype=dtype)
+    numbers = pd.to_numeric(df[name], errors='coerce').astype(float)
+    if dtype.kind == 'i':
+        return numbers.fillna(-1).to_numpy().astype(dtype)
+    return numbers.to_numpy().astype(dtype)
+
+
+class EntityHistoryIndex:
+    """
+    馬・騎手・調教師ごとの過去成績のインデックス
+    - 過去成績の行（HISTORY_DTYPEの構造化配列）と、対象ごとの行番号の配列（レース日順）を持つ
+    - 出走表の全頭分の過去成績を、全履歴を走査せずに辞書の参照と配列のスライスだけで取り出せる
+    - 保存したレースは add() でメモリ上に追加し、persist() で1つのnpzとしてデータの隣に書き戻す
+    - 最後に取り込んだパートファイル名を記録しておき、読み込み時はそれより新しいパートだけを読み足す
+    """
+
+    INDEX_NAME = '_index/entity_history.npz'
+
+    def __init__(self, storage, result_store, info_store, bucket=RACE_RESULT_BUCKET, name=INDEX_NAME):
+        """
+        Args:
+            storage (StorageBackend): インデックスの保存先
+            result_store (PartitionedStore): レース結果のストア
+            info_store (PartitionedStore): レース情報のストア（レース日・コースを付けるのに使う）
+            bucket (str): インデックスを置くバケット
+            name (str): インデックスのオブジェクト名
+        """
+        self.storage = storage
+        self.result_store = result_store
+        self.info_store = info_store
+        self.bucket = bucket
+        self.name = name
+        self._rows = np.zeros(0, dtype=HISTORY_DTYPE)
+        self._n = 0
+        self._names = {entity: [] for entity in ENTITY_COLUMNS}
+        self._codes = {entity: {} for entity in ENTITY_COLUMNS}
+        self._offsets = {entity: [] for entity in ENTITY_COLUMNS}
+        self._race_ids = set()
+        self._absorbed = set()
+        self._dirty = False
+
+    @classmethod
+    def load(cls, storage, result_store, info_store, bucket=RACE_RESULT_BUCKET, name=INDEX_NAME):
+        """保存済みのインデックスを読み込み、その後に追加されたパートを反映して返す"""
+        index = cls(storage, result_store, info_store, bucket, name)
+        try:
+            with np.load(io.BytesIO(storage.read_bytes(bucket, name)), allow_pickle=False) as data:
+                index._rows = _upgrade_rows(data['rows'])
+                index._n = len(index._rows)
+                if 'parts' in data:
+                    index._absorbed = set(data['parts'].tolist())
+                else:
+                    # 以前の形式（最後に取り込んだパート名）は、それ以前のパートを取り込み済みとして読む
+                    last_part = str(data['last_part'])
+                    index._absorbed = {posixpath.basename(name) for name in result_store.list_parts()
+                                       if posixpath.basename(name) <= last_part}
+                for entity in ENTITY_COLUMNS:
+                    names = data[f'{entity}_names'].tolist()
+                    index._names[entity] = names
+                    index._codes[entity] = {name: code for code, name in enumerate(names)}
+                    indptr = data[f'{entity}_indptr']
+                    offsets = data[f'{entity}_offsets']
+                    index._offsets[entity] = [offsets[indptr[i]:indptr[i + 1]] for i in range(len(names))]
+        except FileNotFoundError:
+            pass
+        index._race_ids = set(index._rows['race_id'][index._rows['race_id'] != _DEAD].tolist())
+        index.refresh()
+        return index
+
+    def __len__(self):
+        return int(np.count_nonzero(self._rows['race_id'][:self._n] != _DEAD))
+
+    def refresh(self):
+        """
+        インデックスに未反映のパートファイルから行を読み足す（レース情報は同じパーティションから付ける）
+        取り込んだパートはファイル名の集合で記録する（同時に書かれた名前の小さいパートも読み落とさない）
+        コンパクションでまとめたパートは、まとめた最後のパートを取り込み済みなら読み直さない
+        """
+        names = self.result_store.list_parts()
+        parts = unread_parts(names, self._absorbed, skip_compacted=True)
+        # 一覧のパートはすべて取り込み済みになる（コンパクションで消えたパートは記録から外す）
+        listed = {posixpath.basename(name) for name in names}
+        if listed != self._absorbed:
+            self._absorbed = listed - {posixpath.basename(name) for name in parts}
+            self._dirty = True
+        if not parts:
+            return
+        results = pd.concat([self.result_store.read_part(name) for name in parts], ignore_index=True)
+        results = results.drop_duplicates(subset=self.result_store.key_columns, keep='last')
+        race_ids = results['race_id'].astype(str)
+        infos = []
+        for year, venue in sorted(set(zip(race_ids.str[:4], race_ids.str[4:6]))):
+            infos.append(self.info_store.read(year, venue, columns=list(INFO_FIELDS.values())))
+        self.add(pd.concat(infos, ignore_index=True), results, parts)
+
+    def _code(self, entity, names):
+        """名前をコードにする（初めての名前は登録する。空の名前は-1）"""
+        codes = self._codes[entity]
+        uniques, inverse = np.unique(names, return_inverse=True)
+        unique_codes = np.empty(len(uniques), dtype=np.int32)
+        for i, name in enumerate(uniques.tolist()):
+            if not name:
+                unique_codes[i] = -1
+                continue
+            code = codes.get(name)
+            if code is None:
+                code = codes[name] = len(self._names[entity])
+                self._names[entity].append(name)
+                self._offsets[entity].append(np.zeros(0, dtype=np.int32))
+            unique_codes[i] = code
+        return unique_codes[inverse]
+
+    def _sort_key(self, offsets):
+        # レース日（欠損は最後）→ race_id の順
+        rows = self._rows[offsets]
+        dates = rows['race_date'].astype(np.int64)
+        dates[np.isnat(rows['race_date'])] = np.iinfo(np.int64).max
+        return np.lexsort((rows['race_id'], dates))
+
+    def _append_rows(self, rows):
+        start = self._n
+        needed = start + len(rows)
+        if needed > len(self._rows):
+            grown = np.zeros(max(needed, len(self._rows) * 2, 1024), dtype=HISTORY_DTYPE)
+            grown[:start] = self._rows[:start]
+            self._rows = grown
+        self._rows[start:needed] = rows
+        self._n = needed
+        return np.arange(start, needed, dtype=np.int32)
+
+    def _remove_rows(self, race_ids, horse_numbers):
+        """
+        置き換える行（race_id・馬番が同じ行）を無効にし、対象ごとの行番号から外す
+        （upsertは変わった行だけを書き出すので、レースの全行が届くとは限らない）
+        """
+        candidates = np.flatnonzero(np.isin(self._rows['race_id'][:self._n], np.unique(race_ids)))
+        existing = pd.MultiIndex.from_arrays([self._rows['race_id'][candidates],
+                                              self._rows['horse_number'][candidates]])
+        dead = candidates[existing.isin(pd.MultiIndex.from_arrays([race_ids, horse_numbers]))]
+        for entity in ENTITY_COLUMNS:
+            for code in np.unique(self._rows[entity][dead]).tolist():
+                if code >= 0:
+                    offsets = self._offsets[entity][code]
+                    self._offsets[entity][code] = offsets[~np.isin(offsets, dead)]
+        self._rows['race_id'][dead] = _DEAD
+
+    def _set_race_info(self, infos):
+        """レース情報が後から保存されたレースの行にレース日・コースを付け、並び順を直す"""
+        if infos.empty:
+            return
+        info_ids = infos['race_id'].astype(str).to_numpy()
+        rows = self._rows[:self._n]
+        positions = np.flatnonzero(np.isnat(rows['race_date']) & np.isin(rows['race_id'], info_ids))
+        if not len(positions):
+            return
+        lookup = pd.Series(np.arange(len(info_ids)), index=info_ids)
+        source = lookup.loc[self._rows['race_id'][positions]].to_numpy()
+        for field, column in INFO_FIELDS.items():
+            self._rows[field][positions] = _field_values(infos, column, HISTORY_DTYPE[field])[source]
+        for entity in ENTITY_COLUMNS:
+            for code in np.unique(self._rows[entity][positions]).tolist():
+                if code >= 0:
+                    offsets = self._offsets[entity][code]
+                    self._offsets[entity][code] = offsets[self._sort_key(offsets)]
+
+    def add(self, race_infos, race_results, parts=()):
+        """
+        保存したレースの結果を追加する（同じrace_id・馬番の行が既にあれば置き換える）
+        Args:
+            race_infos (list or DataFrame): 同時に保存したレース情報
+            race_results (list or DataFrame): 保存したレース結果
+            parts (iterable): 結果を書き込んだパートファイル名（次回のrefreshで読み直さないように記録）
+        """
+        infos = race_infos if isinstance(race_infos, pd.DataFrame) else pd.DataFrame(race_infos)
+        results = race_results if isinstance(race_results, pd.DataFrame) else pd.DataFrame(race_results)
+        self._absorbed.update(posixpath.basename(name) for name in parts)
+        self._dirty = True
+        if not infos.empty:
+            infos = infos.assign(race_id=infos['race_id'].astype(str)).drop_duplicates('race_id', keep='last')
+        if results.empty:
+            if not infos.empty:
+                self._set_race_info(infos)
+            return
+
+        results = results.assign(race_id=results['race_id'].astype(str))
+        race_ids = results['race_id'].unique()
+        replaced = results['race_id'].isin([race_id for race_id in race_ids.tolist() if race_id in self._race_ids])
+        if replaced.any():
+            self._remove_rows(results.loc[replaced, 'race_id'].to_numpy(),
+                              _field_values(results[replaced], RESULT_FIELDS['horse_number'],
+                                            HISTORY_DTYPE['horse_number']))
+        if not infos.empty:
+            # 今回結果の無いレースの情報は、既にある行に付ける
+            self._set_race_info(infos[~infos['race_id'].isin(race_ids)])
+            merge_columns = ['race_id'] + [c for c in INFO_FIELDS.values() if c in infos.columns]
+            results = results.merge(infos[merge_columns], on='race_id', how='left')
+
+        rows = np.zeros(len(results), dtype=HISTORY_DTYPE)
+        rows['race_id'] = results['race_id'].to_numpy()
+        for field, column in {**RESULT_FIELDS, **INFO_FIELDS}.items():
+            rows[field] = _field_values(results, column, HISTORY_DTYPE[field])
+        for entity, column in ENTITY_COLUMNS.items():
+            if column in results.columns:
+                names = results[column].astype(object).where(results[column].notna(), '').astype(str).str.strip()
+                rows[entity] = self._code(entity, names.to_numpy())
+            else:
+                rows[entity] = -1
+        offsets = self._append_rows(rows)
+        self._race_ids.update(race_ids.tolist())
+
+        for entity in ENTITY_COLUMNS:
+            codes = rows[entity]
+            order = np.argsort(codes, kind='stable')
+            boundaries = np.flatnonzero(np.diff(codes[order])) + 1
+            for group in np.split(order, boundaries):
+                code = int(codes[group[0]])
+                if code < 0:
+                    continue
+                merged = np.concatenate([self._offsets[entity][code], offsets[group]])
+                self._offsets[entity][code] = merged[self._sort_key(merged)]
+
+    def history(self, entity, name, last_n=None, before=None):
+        """
+        過去成績を取得する
+        Args:
+            entity (str): 'horse' / 'jockey' / 'trainer'
+            name (str): 馬名・騎手名・調教師名
+            last_n (int, optional): 直近の何走分を返すか（省略時は全部）
+            before (str or datetime64, optional): この日より前のレースだけを返す（当日のレースは含まない）
+        Returns:
+            numpy.ndarray: HISTORY_DTYPEの行（レース日の古い順。該当なしなら空）
+        """
+        code = self._codes[entity].get(name)
+        if code is None:
+            return self._rows[:0]
+        offsets = self._offsets[entity][code]
+        if before is not None:
+            dates = self._rows['race_date'][offsets]
+            offsets = offsets[:np.searchsorted(dates, np.datetime64(before, 'D'), side='left')]
+        if last_n is not None:
+            offsets = offsets[-last_n:] if last_n > 0 else offsets[:0]
+        return self._rows[offsets]
+
+    def card_history(self, entity, names, last_n=5, before=None):
+        """
+        出走表の全員分の過去成績を取得する
+        Args:
+            entity (str): 'horse' / 'jockey' / 'trainer'
+            names (list): 馬名などのリスト
+            last_n (int, optional): 1頭あたり直近の何走分を返すか
+            before (str or datetime64, optional): この日より前のレースだけを返す
+        Returns:
+            dict: 名前 → HISTORY_DTYPEの行
+        """
+        return {name: self.history(entity, name, last_n, before) for name in names}
+
+    def names(self, entity, codes):
+        """行のコード（horse / jockey / trainer列）を名前に戻す"""
+        names = self._names[entity]
+        return [names[code] if code >= 0 else '' for code in np.asarray(codes).tolist()]
+
+    def persist(self):
+        """変更があればインデックスを書き戻す（無効になった行は詰めてから保存する）"""
+        if not self._dirty:
+            return
+        rows = self._rows[:self._n]
+        alive = rows['race_id'] != _DEAD
+        # 詰めた後の行番号
+        new_offsets = np.cumsum(alive, dtype=np.int64) - 1
+        arrays = {'rows': rows[alive], 'parts': np.array(sorted(self._absorbed), dtype=str)}
+        for entity in ENTITY_COLUMNS:
+            offsets = [new_offsets[o] for o in self._offsets[entity]]
+            lengths = np.array([len(o) for o in offsets], dtype=np.int64)
+            arrays[f'{entity}_names'] = np.array(self._names[entity], dtype=str)
+            arrays[f'{entity}_indptr'] = np.concatenate([[0], np.cumsum(lengths)])
+            arrays[f'{entity}_offsets'] = (np.concatenate(offsets) if offsets else np.zeros(0)).astype(np.int32)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        self.storage.write_bytes(self.bucket, self.name, buffer.getvalue(), content_type='application/octet-stream')
+        self._dirty = False
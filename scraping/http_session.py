@@ -0,0 +1,133 @@
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+try:
+    import brotli  # noqa: F401  urllib3はbrotliがあればbrの展開に対応する
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+# 新規接続時のDNS解決・TCP/TLS接続時間（リクエストを送ったスレッドごとに記録）
+_connection_timing = threading.local()
+
+
+def _reset_connection_timing():
+    _connection_timing.dns = 0.0
+    _connection_timing.connect = 0.0
+
+
+def _record_new_conn(conn, super_new_conn):
+    """名前解決と接続を分けて計測しながら新規接続を張る"""
+    dns_start = time.perf_counter()
+    host = conn._dns_host
+    try:
+        addr = socket.getaddrinfo(host, conn.port, socket.AF_UNSPEC, socket.SOCK_STREAM)[0][4][0]
+    except (socket.gaierror, IndexError):
+        addr = None
+    dns_time = time.perf_counter() - dns_start
+
+    connect_start = time.perf_counter()
+    if addr:
+        # 解決済みのアドレスに接続する（TLSのSNI・証明書検証は元のホスト名のまま）
+        conn._dns_host = addr
+    try:
+        sock = super_new_conn()
+    finally:
+        conn._dns_host = host
+    _connection_timing.dns = getattr(_connection_timing, 'dns', 0.0) + dns_time
+    _connection_timing.connect = getattr(_connection_timing, 'connect', 0.0) + time.perf_counter() - connect_start
+    return sock
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def _new_conn(self):
+        return _record_new_conn(self, super()._new_conn)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def _new_conn(self):
+        return _record_new_conn(self, super()._new_conn)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """新規接続のDNS解決・接続時間を計測するHTTPAdapter"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
+
+
+def create_session(headers=None, pool_size=10, max_retries=3, backoff_factor=0.5):
+    """
+    接続プール付きの永続セッションを作成する
+    Args:
+        headers (dict, optional): セッション共通のヘッダー
+        pool_size (int): ホストごとに保持するコネクション数
+        max_retries (int): 接続エラー・読み取りエラー時のリトライ回数
+            （429/5xxのリトライはConcurrentFetcher側で行う）
+        backoff_factor (float): 接続リトライのバックオフ係数
+    Returns:
+        requests.Session: keep-aliveと圧縮転送が有効なセッション
+    """
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=max_retries,
+        status=0,
+        backoff_factor=backoff_factor,
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        raise_on_status=False,
+    )
+    adapter = TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': ACCEPT_ENCODING, 'Connection': 'keep-alive'})
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+def timed_get(session, url, headers=None, timeout=None):
+    """
+    GETリクエストを送り、フェーズごとの所要時間をresponse.timingに格納する
+    Returns:
+        requests.Response: timing属性に dns / connect / ttfb / download / total（秒）を持つレスポンス
+            （既存のコネクションを再利用した場合、dnsとconnectは0）
+    """
+    _reset_connection_timing()
+    start = time.perf_counter()
+    response = session.get(url, headers=headers, timeout=timeout, stream=True)
+    headers_received = time.perf_counter()
+    response.content  # 本文を読み切る（展開も含めてdownloadに計上）
+    finished = time.perf_counter()
+
+    dns = _connection_timing.dns
+    connect = _connection_timing.connect
+    response.timing = {
+        'dns': dns,
+        'connect': connect,
+        'ttfb': max(0.0, headers_received - start - dns - connect),
+        'download': finished - headers_received,
+        'total': finished - start,
+    }
+    return response
@@ -0,0 +1,501 @@
+import argparse
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from scraping.schema import VENUE_NAMES
+
+# 固定長レコードの項目
+# offset: JRDBの仕様書と同じ1始まりのバイト位置 / length: バイト数
+# kind: 'int'（数字。前後の空白と符号を許す）/ 'decimal'（ZZ9.9のような小数。scaleは小数点以下の桁数）
+#       'hex'（16進1桁）/ 'str'（Shift-JISの文字列。前後の空白を除きcategoryにする）
+FieldSpec = namedtuple('FieldSpec', ['name', 'offset', 'length', 'kind', 'scale'], defaults=(0,))
+
+_RACE_KEY_FIELDS = (
+    FieldSpec('レースキー', 1, 8, 'str'),
+    FieldSpec('レースキー_場コード', 1, 2, 'int'),
+    FieldSpec('レースキー_年', 3, 2, 'int'),
+    FieldSpec('レースキー_回', 5, 1, 'int'),
+    FieldSpec('レースキー_日', 6, 1, 'hex'),
+    FieldSpec('レースキー_R', 7, 2, 'int'),
+)
+
+# 成績データ（SED）
+SED_FIELDS = _RACE_KEY_FIELDS + (
+    FieldSpec('馬番', 9, 2, 'int'),
+    FieldSpec('競走成績キー_血統登録番号', 11, 8, 'str'),
+    FieldSpec('競走成績キー_年月日', 19, 8, 'int'),
+    FieldSpec('馬名', 27, 36, 'str'),
+    FieldSpec('レース条件_距離', 63, 4, 'int'),
+    FieldSpec('レース条件_芝ダ障害コード', 67, 1, 'int'),
+    FieldSpec('レース条件_右左', 68, 1, 'int'),
+    FieldSpec('レース条件_内外', 69, 1, 'int'),
+    FieldSpec('レース条件_馬場状態', 70, 2, 'int'),
+    FieldSpec('レース条件_種別', 72, 2, 'int'),
+    FieldSpec('レース条件_条件', 74, 2, 'str'),
+    FieldSpec('レース条件_記号', 76, 3, 'str'),
+    FieldSpec('レース条件_重量', 79, 1, 'int'),
+    FieldSpec('レース条件_グレード', 80, 1, 'int'),
+    FieldSpec('レース条件_レース名', 81, 50, 'str'),
+    FieldSpec('レース条件_頭数', 131, 2, 'int'),
+    FieldSpec('レース条件_レース名略称', 133, 8, 'str'),
+    FieldSpec('馬成績_着順', 141, 2, 'int'),
+    FieldSpec('馬成績_異常区分', 143, 1, 'int'),
+    FieldSpec('馬成績_タイム', 144, 4, 'int'),  # 1345 = 1分34秒5
+    FieldSpec('馬成績_斤量', 148, 3, 'int'),  # 0.1kg単位
+    FieldSpec('馬成績_騎手名', 151, 12, 'str'),
+    FieldSpec('馬成績_調教師名', 163, 12, 'str'),
+    FieldSpec('馬成績_確定単勝オッズ', 175, 6, 'decimal', 1),
+    FieldSpec('馬成績_確定単勝人気順位', 181, 2, 'int'),
+    FieldSpec('ＪＲＤＢデータ_ＩＤＭ', 183, 3, 'int'),
+    FieldSpec('ＪＲＤＢデータ_素点', 186, 3, 'int'),
+    FieldSpec('ＪＲＤＢデータ_馬場差', 189, 3, 'int'),
+    FieldSpec('ＪＲＤＢデータ_ペース', 192, 3, 'int'),
+    FieldSpec('ＪＲＤＢデータ_出遅', 195, 3, 'int'),
+    FieldSpec('ＪＲＤＢデータ_位置取', 198, 3, 'int'),
+    FieldSpec('ＪＲＤＢデータ_不利', 201, 3, 'int'),
+    FieldSpec('ＪＲＤＢデータ_前不利', 204, 3, 'int'),
+    FieldSpec('ＪＲＤＢデータ_中不利', 207, 3, 'int'),
+    FieldSpec('ＪＲＤＢデータ_後不利', 210, 3, 'int'),
+    FieldSpec('ＪＲＤＢデータ_レース', 213, 3, 'int'),
+    FieldSpec('ＪＲＤＢデータ_コース取り', 216, 1, 'int'),
+    FieldSpec('ＪＲＤＢデータ_上昇度コード', 217, 1, 'int'),
+    FieldSpec('ＪＲＤＢデータ_クラスコード', 218, 2, 'int'),
+    FieldSpec('ＪＲＤＢデータ_馬体コード', 220, 1, 'int'),
+    FieldSpec('ＪＲＤＢデータ_気配コード', 221, 1, 'int'),
+    FieldSpec('ＪＲＤＢデータ_レースペース', 222, 1, 'str'),
+    FieldSpec('ＪＲＤＢデータ_馬ペース', 223, 1, 'str'),
+    FieldSpec('ＪＲＤＢデータ_テン指数', 224, 5, 'decimal', 1),
+    FieldSpec('ＪＲＤＢデータ_上がり指数', 229, 5, 'decimal', 1),
+    FieldSpec('ＪＲＤＢデータ_ペース指数', 234, 5, 'decimal', 1),
+    FieldSpec('ＪＲＤＢデータ_レースＰ指数', 239, 5, 'decimal', 1),
+    FieldSpec('ＪＲＤＢデータ_1(2)着馬名', 244, 12, 'str'),
+    FieldSpec('ＪＲＤＢデータ_1(2)着タイム差', 256, 3, 'int'),
+    FieldSpec('ＪＲＤＢデータ_前３Ｆタイム', 259, 3, 'int'),  # 0.1秒単位
+    FieldSpec('ＪＲＤＢデータ_後３Ｆタイム', 262, 3, 'int'),  # 0.1秒単位
+    FieldSpec('ＪＲＤＢデータ_備考', 265, 24, 'str'),
+    FieldSpec('確定複勝オッズ下', 291, 6, 'decimal', 1),
+    FieldSpec('10時単勝オッズ', 297, 6, 'decimal', 1),
+    FieldSpec('10時複勝オッズ', 303, 6, 'decimal', 1),
+    FieldSpec('コーナー順位１', 309, 2, 'int'),
+    FieldSpec('コーナー順位２', 311, 2, 'int'),
+    FieldSpec('コーナー順位３', 313, 2, 'int'),
+    FieldSpec('コーナー順位４', 315, 2, 'int'),
+    FieldSpec('前３Ｆ先頭差', 317, 3, 'int'),
+    FieldSpec('後３Ｆ先頭差', 320, 3, 'int'),
+    FieldSpec('騎手コード', 323, 5, 'str'),
+    FieldSpec('調教師コード', 328, 5, 'str'),
+    FieldSpec('馬体重', 333, 3, 'int'),
+    FieldSpec('馬体重増減', 336, 3, 'int'),
+    FieldSpec('天候コード', 339, 1, 'int'),
+    FieldSpec('コース', 340, 1, 'int'),
+    FieldSpec('レース脚質', 341, 1, 'str'),
+    FieldSpec('払戻データ_単勝', 342, 7, 'int'),
+    FieldSpec('払戻データ_複勝', 349, 7, 'int'),
+    FieldSpec('本賞金', 356, 5, 'int'),
+    FieldSpec('収得賞金', 361, 5, 'int'),
+    FieldSpec('レースペース流れ', 366, 2, 'int'),
+    FieldSpec('馬ペース流れ', 368, 2, 'int'),
+    FieldSpec('４角コース取り', 370, 1, 'int'),
+    FieldSpec('発走時間', 371, 4, 'str'),
+)
+
+# 番組データ（BAC）
+BAC_FIELDS = _RACE_KEY_FIELDS + (
+    FieldSpec('年月日', 9, 8, 'int'),
+    FieldSpec('発走時間', 17, 4, 'str'),
+    FieldSpec('レース条件_距離', 21, 4, 'int'),
+    FieldSpec('レース条件_芝ダ障害コード', 25, 1, 'int'),
+    FieldSpec('レース条件_右左', 26, 1, 'int'),
+    FieldSpec('レース条件_内外', 27, 1, 'int'),
+    FieldSpec('レース条件_種別', 28, 2, 'int'),
+    FieldSpec('レース条件_条件', 30, 2, 'str'),
+    FieldSpec('レース条件_記号', 32, 3, 'str'),
+    FieldSpec('レース条件_重量', 35, 1, 'int'),
+    FieldSpec('レース条件_グレード', 36, 1, 'int'),
+    FieldSpec('レース名', 37, 50, 'str'),
+    FieldSpec('回数', 87, 8, 'str'),
+    FieldSpec('頭数', 95, 2, 'int'),
+    FieldSpec('コース', 97, 1, 'int'),
+    FieldSpec('開催区分', 98, 1, 'int'),
+    FieldSpec('レース名短縮', 99, 4, 'str'),
+    FieldSpec('レース名９文字', 103, 18, 'str'),
+    FieldSpec('データ区分', 121, 1, 'int'),
+    FieldSpec('１着賞金', 122, 5, 'int'),
+    FieldSpec('２着賞金', 127, 5, 'int'),
+    FieldSpec('３着賞金', 132, 5, 'int'),
+    FieldSpec('４着賞金', 137, 5, 'int'),
+    FieldSpec('５着賞金', 142, 5, 'int'),
+    FieldSpec('１着算入賞金', 147, 5, 'int'),
+    FieldSpec('２着算入賞金', 152, 5, 'int'),
+    FieldSpec('馬券発売フラグ', 157, 16, 'str'),
+    FieldSpec('WIN5フラグ', 173, 1, 'int'),
+)
+
+# 競走馬データ（KYI）（予想に使う主な項目。必要になったら仕様書に沿って足す）
+KYI_FIELDS = _RACE_KEY_FIELDS + (
+    FieldSpec('馬番', 9, 2, 'int'),
+    FieldSpec('血統登録番号', 11, 8, 'str'),
+    FieldSpec('馬名', 19, 36, 'str'),
+    FieldSpec('ＩＤＭ', 55, 5, 'decimal', 1),
+    FieldSpec('騎手指数', 60, 5, 'decimal', 1),
+    FieldSpec('情報指数', 65, 5, 'decimal', 1),
+    FieldSpec('総合指数', 85, 5, 'decimal', 1),
+    FieldSpec('脚質', 90, 1, 'int'),
+    FieldSpec('距離適性', 91, 1, 'int'),
+    FieldSpec('上昇度', 92, 1, 'int'),
+    FieldSpec('ローテーション', 93, 3, 'int'),
+    FieldSpec('基準オッズ', 96, 5, 'decimal', 1),
+    FieldSpec('基準人気順位', 101, 2, 'int'),
+    FieldSpec('基準複勝オッズ', 103, 5, 'decimal', 1),
+    FieldSpec('基準複勝人気順位', 108, 2, 'int'),
+    FieldSpec('人気指数', 140, 5, 'int'),
+    FieldSpec('調教指数', 145, 5, 'decimal', 1),
+    FieldSpec('厩舎指数', 150, 5, 'decimal', 1),
+    FieldSpec('調教矢印コード', 155, 1, 'int'),
+    FieldSpec('厩舎評価コード', 156, 1, 'int'),
+    FieldSpec('騎手期待連対率', 157, 4, 'decimal', 1),
+    FieldSpec('激走指数', 161, 3, 'int'),
+    FieldSpec('蹄コード', 164, 2, 'int'),
+    FieldSpec('重適性コード', 166, 1, 'int'),
+    FieldSpec('クラスコード', 167, 2, 'int'),
+    FieldSpec('ブリンカー', 171, 1, 'str'),
+    FieldSpec('騎手名', 172, 12, 'str'),
+    FieldSpec('負担重量', 184, 3, 'int'),  # 0.1kg単位
+    FieldSpec('見習い区分', 187, 1, 'int'),
+    FieldSpec('調教師名', 188, 12, 'str'),
+    FieldSpec('調教師所属', 200, 4, 'str'),
+)
+
+FILE_SPECS = {
+    'SED': SED_FIELDS,
+    'BAC': BAC_FIELDS,
+    'KYI': KYI_FIELDS,
+}
+
+_ZERO, _SPACE, _PLUS, _MINUS = ord('0'), ord(' '), ord('+'), ord('-')
+
+
+def _int_dtype(length):
+    return 'Int16' if length <= 4 else 'Int32' if length <= 9 else 'Int64'
+
+
+def _decode_int(field_bytes):
+    """
+    数字の項目を整数にする（1バイトずつ位取りして足し合わせる）
+    右詰めの数字の前の空白と符号（+/-）を許し、空白だけの値・数字以外を含む値は欠損にする
+    Args:
+        field_bytes (ndarray): (桁数, レコード数) のuint8配列（桁ごとに連続したメモリ）
+    """
+    n_records = field_bytes.shape[1]
+    values = np.zeros(n_records, dtype=np.int64)
+    valid = np.ones(n_records, dtype=bool)
+    seen_digit = np.zeros(n_records, dtype=bool)
+    negative = np.zeros(n_records, dtype=bool)
+    for column in field_bytes:
+        digit = column - np.uint8(_ZERO)  # 数字以外は桁あふれで10以上になる
+        is_digit = digit < 10
+        is_space = column == _SPACE
+        is_minus = column == _MINUS
+        values *= 10
+        values += np.where(is_digit, digit, 0)
+        valid &= is_digit | is_space | is_minus | (column == _PLUS)
+        valid &= ~(seen_digit & ~is_digit)  # 数字の後ろに空白・符号がある値は不正
+        seen_digit |= is_digit
+        negative |= is_minus
+    np.negative(values, out=values, where=negative)
+    return pd.arrays.IntegerArray(values, ~(valid & seen_digit)).astype(_int_dtype(len(field_bytes)))
+
+
+def _decode_decimal(field_bytes, scale):
+    """ZZ9.9のような小数の項目をfloat32にする（位置が固定の小数点を除いた整数を10**scaleで割る）"""
+    digits = np.delete(field_bytes, len(field_bytes) - scale - 1, axis=0)
+    integers = _decode_int(digits)
+    return integers.to_numpy(dtype=np.float32, na_value=np.nan) / np.float32(10 ** scale)
+
+
+def _decode_hex(field_bytes):
+    """16進1桁の項目（開催日の「日」など）を整数にする"""
+    c = field_bytes[0].astype(np.int16)
+    lower = c | 0x20
+    values = np.where((c >= _ZERO) & (c <= _ZERO + 9), c - _ZERO,
+                      np.where((lower >= ord('a')) & (lower <= ord('f')), lower - ord('a') + 10, -1))
+    return pd.arrays.IntegerArray(values.astype(np.int64), values < 0).astype('Int8')
+
+
+def _factorize_bytes(field_bytes):
+    """
+    固定長のバイト列をコードと重複のないバイト列に分ける
+    8バイトずつの語からハッシュを作ってfactorizeし（ソートしないので速い）、
+    ハッシュが衝突していないかを全行の比較で確かめる（衝突していればnp.uniqueでやり直す）
+    Args:
+        field_bytes (ndarray): (レコード数, バイト数) のuint8配列
+    Returns:
+        tuple: (コードの配列, (重複のない値の数, バイト数) のuint8配列)
+    """
+    n_records, length = field_bytes.shape
+    padded = np.zeros((n_records, -(-length // 8) * 8), dtype=np.uint8)
+    padded[:, :length] = field_bytes
+    words = padded.view(np.uint64)
+    hashes = words[:, 0].copy()
+    for k in range(1, words.shape[1]):
+        hashes *= np.uint64(0x100000001B3)
+        hashes ^= words[:, k]
+    codes, unique_hashes = pd.factorize(hashes)
+
+    first = np.empty(len(unique_hashes), dtype=np.int64)
+    first[codes[::-1]] = np.arange(n_records - 1, -1, -1)
+    uniques = padded[first]
+    if words.shape[1] > 1 and not np.array_equal(uniques[codes], padded):
+        uniques, codes = np.unique(padded, axis=0, return_inverse=True)
+    return codes.ravel(), uniques[:, :length]
+
+
+def _decode_str(field_bytes, encoding):
+    """
+    文字列の項目をcategoryにする
+    同じ値が何度も現れるので、重複を除いたバイト列だけをデコードしてコードで全行に展開する
+    """
+    codes, uniques = _factorize_bytes(field_bytes)
+    categories = [bytes(value).decode(encoding, errors='replace').strip(' 　') for value in uniques]
+    # 前後の空白を除くと同じになる値をまとめる
+    categories, remap = np.unique(np.array(categories, dtype=object), return_inverse=True)
+    return pd.Categorical.from_codes(remap.ravel()[codes], categories)
+
+
+def _transpose(records, start, end, block_size=8192):
+    """
+    レコードのstart〜endバイト目を (バイト位置, レコード数) の配列にする
+    （キャッシュに収まる大きさのブロックごとに転置する。列を1つずつ取り出すより何倍も速い）
+    """
+    transposed = np.empty((end - start, len(records)), dtype=np.uint8)
+    for i in range(0, len(records), block_size):
+        transposed[:, i:i + block_size] = records[i:i + block_size, start:end].T
+    return transposed
+
+
+def _record_length(data):
+    """最初の改行までの長さからレコード長（改行を含む）を求める"""
+    newline = bytes(data[:4096]).find(b'\r\n')
+    if newline < 0:
+        raise ValueError("Could not find a record terminator (CRLF) in the first 4096 bytes")
+    return newline + 2
+
+
+def read_records(path, fields, columns=None, encoding='cp932'):
+    """
+    JRDBの固定長レコードのファイルを読み込む
+    ファイルはメモリマップし、項目ごとにバイト列の列をまとめてデコードする（行ごとの処理はしない）
+    Args:
+        path (str): ファイルのパス
+        fields (tuple): FieldSpecのタプル
+        columns (list, optional): 読み込む項目名（省略時はすべて）
+        encoding (str): 文字列の項目のエンコーディング
+    Returns:
+        DataFrame: 項目名を列名とする表
+    """
+    if columns is not None:
+        by_name = {field.name: field for field in fields}
+        unknown = [name for name in columns if name not in by_name]
+        if unknown:
+            raise KeyError(f"Unknown JRDB fields: {unknown}")
+        fields = [by_name[name] for name in columns]
+
+    if os.path.getsize(path) == 0:
+        return pd.DataFrame({field.name: pd.Series(dtype=object) for field in fields})
+
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    record_length = _record_length(data)
+    # 末尾のEOF（0x1A）や改行の欠けた最終行は切り捨てる
+    n_records = len(data) // record_length
+    records = data[:n_records * record_length].reshape(n_records, record_length)
+
+    for field in fields:
+        if field.offset - 1 + field.length > record_length - 2:
+            raise ValueError(f"{field.name} is outside the {record_length}-byte record of {path}")
+
+    # 数値の項目は桁ごとに連続した配列で1桁ずつ処理するので、使うバイト位置の範囲を先にまとめて転置しておく
+    numeric = [field for field in fields if field.kind != 'str']
+    if numeric:
+        start = min(field.offset for field in numeric) - 1
+        columns_by_position = _transpose(records, start, max(field.offset - 1 + field.length for field in numeric))
+
+    decoded = {}
+    for field in fields:
+        begin, end = field.offset - 1, field.offset - 1 + field.length
+        if field.kind == 'str':
+            decoded[field.name] = _decode_str(np.ascontiguousarray(records[:, begin:end]), encoding)
+            continue
+        field_bytes = columns_by_position[begin - start:end - start]
+        if field.kind == 'int':
+            decoded[field.name] = _decode_int(field_bytes)
+        elif field.kind == 'decimal':
+            decoded[field.name] = _decode_decimal(field_bytes, field.scale)
+        else:
+            decoded[field.name] = _decode_hex(field_bytes)
+    return pd.DataFrame(decoded)
+
+
+def file_kind(path):
+    """ファイル名（SED240526.txtなど）の先頭3文字からファイルの種類を求める"""
+    kind = os.path.basename(path)[:3].upper()
+    if kind not in FILE_SPECS:
+        raise ValueError(f"Unknown JRDB file kind: {path}")
+    return kind
+
+
+def read_jrdb(paths, kind=None, columns=None):
+    """
+    JRDBのファイル（複数可）を読み込んで1つの表にする
+    Args:
+        paths (str or list): ファイルのパス、またはパスのリスト
+        kind (str, optional): 'SED' / 'BAC' / 'KYI'（省略時はファイル名から判定）
+        columns (list, optional): 読み込む項目名
+    Returns:
+        DataFrame: すべてのファイルのレコード（文字列の項目はcategoryのまま結合する）
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    frames = [read_records(path, FILE_SPECS[kind or file_kind(path)], columns) for path in paths]
+    if len(frames) == 1:
+        return frames[0]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+
+    combined = {}
+    for name in frames[0].columns:
+        parts = [frame[name] for frame in frames]
+        if isinstance(parts[0].dtype, pd.CategoricalDtype):
+            combined[name] = union_categoricals([part.array for part in parts])
+        else:
+            combined[name] = pd.concat(parts, ignore_index=True).array
+    return pd.DataFrame(combined)
+
+
+def list_jrdb_files(directory, kind):
+    """ディレクトリ内の指定した種類のファイル（SED*.txtなど）を日付順で返す"""
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.upper().startswith(kind) and name.lower().endswith('.txt')
+    )
+
+
+# SEDから nk_race_result_schema.json の列を作るのに使う項目
+SED_RACE_RESULT_FIELDS = [
+    'レースキー_場コード', 'レースキー_回', 'レースキー_日', 'レースキー_R', '馬番', '競走成績キー_年月日', '馬名',
+    'レース条件_距離', 'レース条件_芝ダ障害コード', 'レース条件_右左', 'レース条件_馬場状態', 'レース条件_レース名',
+    '馬成績_着順', '馬成績_タイム', '馬成績_斤量', '馬成績_騎手名', '馬成績_調教師名', '馬成績_確定単勝オッズ',
+    '馬成績_確定単勝人気順位', 'ＪＲＤＢデータ_後３Ｆタイム', 'コーナー順位１', 'コーナー順位２', 'コーナー順位３',
+    'コーナー順位４', '馬体重', '馬体重増減', '天候コード', '本賞金', '発走時間',
+]
+TRACK_TYPE_NAMES = {1: '芝', 2: 'ダ', 3: '障'}
+TRACK_DIRECTION_NAMES = {1: '右', 2: '左', 3: '直線'}
+WEATHER_NAMES = {1: '晴', 2: '曇', 3: '小雨', 4: '雨', 5: '小雪', 6: '雪'}
+# 馬場状態コードの10の位（11=速良、12=遅良なども良として扱う）
+TRACK_CONDITION_NAMES = {1: '良', 2: '稍重', 3: '重', 4: '不良'}
+
+
+def _zero_padded(values, width):
+    return values.astype('string').str.zfill(width)
+
+
+def sed_race_results(sed):
+    """
+    SEDのレコードを nk_race_result_schema.json の列名・単位の表にする
+    （race_idはnetkeibaと同じ 年4桁+場2桁+回2桁+日2桁+R2桁。SEDに無い項目の列は作らない）
+    Args:
+        sed (DataFrame): SED_RACE_RESULT_FIELDSを含むSEDのレコード
+    Returns:
+        DataFrame: スキーマの列名の行
+    """
+    race_date = sed['競走成績キー_年月日']
+    race_id = _zero_padded(race_date // 10000, 4)
+    for column, width in (('レースキー_場コード', 2), ('レースキー_回', 2), ('レースキー_日', 2), ('レースキー_R', 2)):
+        race_id = race_id + _zero_padded(sed[column], width)
+
+    finish_time = sed['馬成績_タイム']
+    start_time = sed['発走時間'].astype(object)
+    has_start_time = start_time.str.fullmatch(r'\d{4}', na=False)
+    venue = _zero_padded(sed['レースキー_場コード'], 2)
+    return pd.DataFrame({
+        'race_id': race_id.astype(object),
+        # 取消・中止などの着順0はスクレイパーと同じ-1にする
+        'rank': sed['馬成績_着順'].where(sed['馬成績_着順'] != 0, -1),
+        'horse_number': sed['馬番'],
+        'horse_name': sed['馬名'],
+        'burden_weight': sed['馬成績_斤量'] / 10,
+        'jockey': sed['馬成績_騎手名'],
+        # 1345 = 1分34秒5
+        'finish_time': ((finish_time // 1000) * 60 + (finish_time % 1000) / 10).where(finish_time > 0),
+        'pass_1f': sed['コーナー順位１'],
+        'pass_2f': sed['コーナー順位２'],
+        'pass_3f': sed['コーナー順位３'],
+        'pass_4f': sed['コーナー順位４'],
+        'last_3f': sed['ＪＲＤＢデータ_後３Ｆタイム'] / 10,
+        'odds': sed['馬成績_確定単勝オッズ'],
+        'popularity': sed['馬成績_確定単勝人気順位'],
+        'horse_weight': sed['馬体重'],
+        'weight_change': sed['馬体重増減'],
+        'trainer': sed['馬成績_調教師名'],
+        # 本賞金は万円単位
+        'prize': sed['本賞金'] * 10000,
+        'race_name': sed['レース条件_レース名'],
+        'race_date': pd.to_datetime(race_date.astype('string'), format='%Y%m%d', errors='coerce'),
+        'kaisai_kai': sed['レースキー_回'],
+        'venue': venue.map(VENUE_NAMES).astype(object),
+        'day_number': sed['レースキー_日'],
+        'track_type': sed['レース条件_芝ダ障害コード'].map(TRACK_TYPE_NAMES),
+        'track_direction': sed['レース条件_右左'].map(TRACK_DIRECTION_NAMES),
+        'distance': sed['レース条件_距離'],
+        'weather': sed['天候コード'].map(WEATHER_NAMES),
+        'track_condition': (sed['レース条件_馬場状態'] // 10).map(TRACK_CONDITION_NAMES),
+        'start_time': (start_time.str[:2] + ':' + start_time.str[2:] + ':00').where(has_start_time),
+    })
+
+
+def publish_sed(paths, dataset):
+    """
+    SEDのファイルをParquetデータセットに書き出す
+    ファイル名をパートのIDにするので、同じファイルを書き出し直しても行は重複しない
+    Args:
+        paths (list): SEDのファイルのパス
+        dataset (ParquetDataset): 書き出し先のデータセット
+    Returns:
+        int: 書き出した行数
+    """
+    rows = 0
+    for path in paths:
+        sed = read_records(path, SED_FIELDS, SED_RACE_RESULT_FIELDS)
+        dataset.write(sed_race_results(sed), part_id=os.path.splitext(os.path.basename(path))[0])
+        rows += len(sed)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='JRDBの固定長ファイルを読み込んでCSVに変換する')
+    parser.add_argument('kind', choices=sorted(FILE_SPECS))
+    parser.add_argument('directory', help='SED*.txtなどを置いたディレクトリ')
+    parser.add_argument('--output', help='出力するCSV（例: Datas/csv/sed.csv）')
+    parser.add_argument('--columns', nargs='*', help='読み込む項目名')
+    parser.add_argument('--publish', action='store_true',
+                        help='SEDをParquetデータセットに書き出す（ストレージは環境変数 KEIBA_STORAGE_BACKEND に従う）')
+    args = parser.parse_args()
+
+    if args.publish:
+        from scraping.parquet_dataset import JRDB_RACE_RESULT_DATASET, ParquetDataset
+        from scraping.storage_backends import RACE_RESULT_BUCKET, create_storage
+
+        if args.kind != 'SED':
+            parser.error('--publish is only supported for SED')
+        dataset = ParquetDataset(create_storage(), RACE_RESULT_BUCKET, JRDB_RACE_RESULT_DATASET)
+        rows = publish_sed(list_jrdb_files(args.directory, args.kind), dataset)
+        print(f"Published {rows} SED records to {JRDB_RACE_RESULT_DATASET}")
+        raise SystemExit(0)
+
+    df = read_jrdb(list_jrdb_files(args.directory, args.kind), args.kind, args.columns)
+    print(f"Read {len(df)} {args.kind} records ({df.memory_usage(deep=True).sum() / 1024 ** 2:.1f} MiB)")
+    if args.output:
+        df.to_csv(args.output, index=False)
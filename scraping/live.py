@@ -0,0 +1,192 @@
+import argparse
+import hashlib
+import heapq
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from scraping.metrics import log_event
+from scraping.race_calendar import RaceCalendar
+from scraping.result_columns import attach_race_id
+
+JST = timezone(timedelta(hours=9))
+
+
+class LiveRaceMonitor:
+    """
+    開催日のレースを発走時刻の順に監視し、結果が出たレースをすぐに保存する
+    - 優先度付きキュー（heapq）は次にポーリングする時刻の順。発走時刻＋offset_secondsまでは何も取得しない
+    - ポーリングはそのレースの結果ページだけを条件付きGET（ETag/Last-Modified）で取得する
+    - 結果表が出たらすぐに保存し（on_resultにも渡す）、ページが変わらなくなるまでポーリングを続ける
+      （着順の訂正などで内容が変わった場合は保存し直す。保存はupsertなので変わった行だけが書き出される）
+    - 1日分（3場36レース）でも、各レースのページを数回ずつ取得するだけで済む
+    """
+
+    def __init__(self, scraper, offset_seconds=120, poll_interval=30, max_polls=20, on_result=None,
+                 clock=time.time, sleep=time.sleep):
+        """
+        Args:
+            scraper (NetkeibaRaceScraper): 取得・パース・保存に使うスクレイパー
+            offset_seconds (float): 発走時刻の何秒後から結果ページをポーリングするか
+            poll_interval (float): 結果が出るまで・確定するまでのポーリングの間隔（秒）
+            max_polls (int): 1レースあたりのポーリング回数の上限
+            on_result (callable, optional): (race_id, race_data) → None 結果を保存するたびに呼ぶ
+            clock (callable): 現在時刻（UNIX時間）を返す関数
+            sleep (callable): 指定秒数待つ関数
+        """
+        self.scraper = scraper
+        self.offset_seconds = offset_seconds
+        self.poll_interval = poll_interval
+        self.max_polls = max_polls
+        self.on_result = on_result
+        self.clock = clock
+        self.sleep = sleep
+        self.calendar = scraper.race_calendar or RaceCalendar(scraper.fetcher)
+        self._pages = {}
+
+    def schedule(self, kaisai_date, race_ids=None):
+        """
+        開催日のレースの発走時刻
+        Args:
+            kaisai_date (str): 'YYYYMMDD'形式の開催日
+            race_ids (iterable, optional): 監視するレース（省略時はその日の全レース）
+        Returns:
+            dict: レースID → 発走時刻（UNIX時間）
+        """
+        post_times = self.calendar.post_times(kaisai_date)
+        if race_ids is not None:
+            race_ids = {str(race_id) for race_id in race_ids}
+            post_times = {race_id: post_time for race_id, post_time in post_times.items() if race_id in race_ids}
+        return {
+            race_id: datetime.strptime(f'{kaisai_date} {post_time}', '%Y%m%d %H:%M').replace(tzinfo=JST).timestamp()
+            for race_id, post_time in post_times.items()
+        }
+
+    def _poll(self, race_id):
+        """
+        結果ページを条件付きGETで1回取得する
+        Returns:
+            bytes or None: 前回から変わった本文（変わっていない・まだ無い場合はNone）
+        """
+        page = self._pages.setdefault(race_id, {'etag': None, 'last_modified': None, 'digest': None, 'polls': 0})
+        headers = {}
+        if page['etag']:
+            headers['If-None-Match'] = page['etag']
+        if page['last_modified']:
+            headers['If-Modified-Since'] = page['last_modified']
+
+        page['polls'] += 1
+        with self.scraper.metrics.labels(year=race_id[:4], venue=race_id[4:6]):
+            response = self.scraper.fetcher.fetch(self.scraper.RACE_URL.format(race_id=race_id), headers=headers)
+        self.scraper.metrics.inc('live_polls_total', status=response.status_code)
+        if response.status_code in (304, 404):
+            return None
+        response.raise_for_status()
+
+        # 条件付きGETに対応していないページもあるので、本文のハッシュでも比べる
+        digest = hashlib.sha256(response.content).hexdigest()
+        if digest == page['digest']:
+            return None
+        page.update(etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'),
+                    digest=digest)
+        return response.content
+
+    def _push(self, race_id, race_data, post_time):
+        """結果を保存し、on_resultに渡す"""
+        race_infos = []
+        if race_data['race_info']:
+            race_data['race_info']['race_id'] = race_id
+            race_infos.append(race_data['race_info'])
+        race_results = attach_race_id(race_data['race_results'], race_id)
+        self.scraper.save_consolidated_csv(race_infos, race_results)
+        if self.on_result is not None:
+            self.on_result(race_id, race_data)
+
+        latency = self.clock() - post_time
+        self.scraper.metrics.observe('live_result_latency_seconds', latency, venue=race_id[4:6])
+        log_event('Live result saved', race_id=race_id, seconds_after_post=round(latency, 1),
+                  polls=self._pages[race_id]['polls'])
+
+    def _check(self, race_id, post_time, pushed):
+        """
+        レースの結果ページを1回ポーリングする
+        Returns:
+            str: 'waiting'（結果が未掲載）/ 'pushed'（結果を保存した）/ 'final'（保存後ページが変わらなかった）
+        """
+        try:
+            content = self._poll(race_id)
+        except Exception as e:
+            self.scraper.metrics.inc('scrape_errors_total', stage='live', venue=race_id[4:6])
+            print(f"Error polling race {race_id}: {str(e)}")
+            return 'waiting'
+        if content is None:
+            return 'final' if pushed else 'waiting'
+
+        race_data = self.scraper._parse_race_page(content.decode('EUC-JP', errors='replace'))
+        if not race_data['race_results']:
+            return 'waiting'
+        self.scraper.record_parsed(race_id, race_data)
+        self._push(race_id, race_data, post_time)
+        return 'pushed'
+
+    def run(self, kaisai_date=None, race_ids=None):
+        """
+        開催日のレースを監視する（最後のレースの結果が確定するか、ポーリングの上限に達するまで戻らない）
+        Args:
+            kaisai_date (str, optional): 'YYYYMMDD'形式の開催日（省略時は今日）
+            race_ids (iterable, optional): 監視するレース（省略時はその日の全レース）
+        Returns:
+            dict: レースID → 'final' / 'pushed'（確定前に上限に達した）/ 'missed'（結果が出なかった）
+        """
+        kaisai_date = kaisai_date or datetime.now(JST).strftime('%Y%m%d')
+        schedule = self.schedule(kaisai_date, race_ids)
+        log_event('Live monitoring started', date=kaisai_date, races=len(schedule))
+
+        # (次にポーリングする時刻, レースID)
+        queue = [(post_time + self.offset_seconds, race_id) for race_id, post_time in schedule.items()]
+        heapq.heapify(queue)
+        pushed = set()
+        outcome = {}
+        while queue:
+            due, race_id = heapq.heappop(queue)
+            wait = due - self.clock()
+            if wait > 0:
+                self.sleep(wait)
+
+            status = self._check(race_id, schedule[race_id], race_id in pushed)
+            if status == 'pushed':
+                pushed.add(race_id)
+            if status == 'final':
+                outcome[race_id] = 'final'
+            elif self._pages[race_id]['polls'] >= self.max_polls:
+                outcome[race_id] = 'pushed' if race_id in pushed else 'missed'
+            else:
+                heapq.heappush(queue, (self.clock() + self.poll_interval, race_id))
+
+        self.scraper.persist_indexes()
+        log_event('Live monitoring completed', date=kaisai_date, races=len(schedule),
+                  final=sum(status == 'final' for status in outcome.values()),
+                  missed=sorted(race_id for race_id, status in outcome.items() if status == 'missed'),
+                  polls=sum(page['polls'] for page in self._pages.values()))
+        return outcome
+
+
+if __name__ == "__main__":
+    from scraping.scraping_netkeiba import NetkeibaRaceScraper
+    from scraping.storage_backends import create_storage
+
+    parser = argparse.ArgumentParser(description='開催日のレースを発走時刻の順に監視し、結果をすぐに保存する')
+    parser.add_argument('--date', help="'YYYYMMDD'形式の開催日（省略時は今日）")
+    parser.add_argument('--offset', type=float, default=120, help='発走時刻の何秒後からポーリングするか')
+    parser.add_argument('--interval', type=float, default=30, help='ポーリングの間隔（秒）')
+    parser.add_argument('--max-polls', type=int, default=20)
+    parser.add_argument('--storage', choices=['local', 'gcs'], default=os.environ.get('KEIBA_STORAGE_BACKEND', 'local'))
+    parser.add_argument('--storage-dir', default=os.environ.get('KEIBA_STORAGE_DIR', 'data'))
+    parser.add_argument('--parser', choices=['bs4', 'lxml'], default='lxml')
+    args = parser.parse_args()
+
+    scraper = NetkeibaRaceScraper(storage=create_storage(args.storage, args.storage_dir), parser=args.parser)
+    monitor = LiveRaceMonitor(scraper, offset_seconds=args.offset, poll_interval=args.interval,
+                              max_polls=args.max_polls)
+    result = monitor.run(args.date)
+    print(f"Live monitoring completed: {sum(status == 'final' for status in result.values())} of {len(result)} races final")
@@ -1,9 +1,74 @@
-# GCSからBigQueryにデータをロード
-bq load \
-  --source_format=CSV \
-  --skip_leading_rows=1 \
-  --allow_quoted_newlines \
-  --encoding=UTF-8 \
-  keiba.nk_race_results \
-  gs://nk_race_result/race_result_formatted.csv \
-  nk_race_result_schema.json
\ No newline at end of file
+# GCSの保存済みのパートファイル（gzip圧縮CSV）からBigQueryのレース結果テーブルを作り直す
+# - race_result/ と race_info/ の year=YYYY/venue=PP/ 以下のパートを一時的な外部テーブルとして読む
+#   （パスのvenue=はスキーマのvenue列と名前がぶつかるので、Hiveパーティションの列としては使わない）
+# - パートは追記されていくので、同じキーの行は後に書いたパート（ファイル名が大きい方）のものだけを使う
+#   （コンパクション前の古い行が残っていてもよい）
+# - 結果のパートの列（race_id〜prize、horse_id・jockey_id・trainer_id）にレース情報の列を付けて
+#   nk_race_result_schema.json の列の並びにする
+set -euo pipefail
+cd "$(dirname "$0")"
+
+TMP_DIR=$(mktemp -d)
+trap 'rm -rf "$TMP_DIR"' EXIT
+
+# 結果のパートの列：スキーマからレース情報の列を除いたもの
+# （IDの無い以前のパートは列が足りないので、allowJaggedRowsで欠損にする）
+jq '{
+  sourceFormat: "CSV",
+  compression: "GZIP",
+  sourceUris: ["gs://nk_race_result/race_result/*"],
+  csvOptions: {skipLeadingRows: 1, allowQuotedNewlines: true, allowJaggedRows: true, encoding: "UTF-8"},
+  schema: {fields: [.[] | select(.name | IN("race_name", "race_date", "kaisai_kai", "venue", "day_number",
+    "track_type", "track_direction", "distance", "weather", "track_condition", "start_time",
+    "race_conditions") | not)]}
+}' nk_race_result_schema.json > "$TMP_DIR/race_result.json"
+
+# レース情報のパートの列（schema.RACE_INFO_COLUMNS。整形前の値なので文字列で読んでクエリで変換する）
+jq -n '{
+  sourceFormat: "CSV",
+  compression: "GZIP",
+  sourceUris: ["gs://nk_race_info/race_info/*"],
+  csvOptions: {skipLeadingRows: 1, allowQuotedNewlines: true, encoding: "UTF-8"},
+  schema: {fields: [$ARGS.positional[] | {name: ., type: "STRING"}]}
+}' --args race_id race_name race_date kaisai_kai kaisai_place kaisai_nichime race_conditions \
+  track_type track_direction track_distance weather track_condition start_time timestamp \
+  > "$TMP_DIR/race_info.json"
+
+bq query \
+  --use_legacy_sql=false \
+  --external_table_definition=race_result::"$TMP_DIR/race_result.json" \
+  --external_table_definition=race_info::"$TMP_DIR/race_info.json" \
+  '
+CREATE OR REPLACE TABLE keiba.nk_race_results AS
+WITH results AS (
+  SELECT * EXCEPT (part)
+  FROM (SELECT *, _FILE_NAME AS part FROM race_result)
+  WHERE true
+  QUALIFY ROW_NUMBER() OVER (PARTITION BY race_id, horse_number ORDER BY part DESC) = 1
+),
+infos AS (
+  SELECT * EXCEPT (part)
+  FROM (SELECT *, _FILE_NAME AS part FROM race_info)
+  WHERE true
+  QUALIFY ROW_NUMBER() OVER (PARTITION BY race_id ORDER BY part DESC) = 1
+)
+SELECT
+  r.* EXCEPT (horse_id, jockey_id, trainer_id),
+  i.race_name,
+  COALESCE(SAFE.PARSE_DATE("%Y-%m-%d", i.race_date), SAFE.PARSE_DATE("%Y年%m月%d日", i.race_date)) AS race_date,
+  SAFE_CAST(i.kaisai_kai AS INT64) AS kaisai_kai,
+  i.kaisai_place AS venue,
+  SAFE_CAST(i.kaisai_nichime AS INT64) AS day_number,
+  i.track_type,
+  i.track_direction,
+  SAFE_CAST(i.track_distance AS FLOAT64) AS distance,
+  i.weather,
+  i.track_condition,
+  SAFE.PARSE_TIME("%H:%M", REGEXP_EXTRACT(i.start_time, r"^\d{1,2}:\d{2}")) AS start_time,
+  i.race_conditions,
+  r.horse_id,
+  r.jockey_id,
+  r.trainer_id
+FROM results AS r
+LEFT JOIN infos AS i USING (race_id)
+'
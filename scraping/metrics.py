@@ -0,0 +1,220 @@
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    from opentelemetry import trace  # OpenTelemetryがあればスパンも送る
+    _tracer = trace.get_tracer('scraping')
+except ImportError:
+    _tracer = None
+
+# 秒数のヒストグラムの区切り（上限。これを超える値は+Infにだけ数える）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def log_event(message, severity='INFO', **fields):
+    """
+    構造化ログを1行のJSONで標準出力に書く（Cloud Loggingはseverity・messageとその他の項目を解釈する）
+    Args:
+        message (str): ログのメッセージ
+        severity (str): 'INFO' / 'WARNING' / 'ERROR' など
+        **fields: ログに付ける項目
+    """
+    record = {'severity': severity, 'message': message, 'time': datetime.now(timezone.utc).isoformat()}
+    record.update(fields)
+    print(json.dumps(record, ensure_ascii=False, default=str), flush=True)
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.bucket_counts[index] += 1
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in items) + '}'
+
+
+class MetricsRegistry:
+    """
+    ラベル付きのカウンター・ヒストグラムの置き場（スレッドセーフ）
+    - labels()で囲んだ範囲では、そのスレッドで記録する値に共通のラベル（年・競馬場など）を付ける
+    - span()は処理時間をヒストグラムに記録し、構造化ログ（とOpenTelemetryのスパン）を出す
+    - snapshot()はJSON向けの辞書、to_prometheus()はPrometheusのテキスト形式で全体を返す
+    """
+
+    def __init__(self, namespace='keiba', buckets=DEFAULT_BUCKETS):
+        """
+        Args:
+            namespace (str): Prometheusのメトリクス名の接頭辞
+            buckets (tuple): ヒストグラムの区切り
+        """
+        self.namespace = namespace
+        self.buckets = tuple(buckets)
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._context = threading.local()
+
+    def _key(self, name, labels):
+        merged = dict(getattr(self._context, 'labels', {}))
+        merged.update({label: str(value) for label, value in labels.items() if value is not None})
+        return name, tuple(sorted(merged.items()))
+
+    @contextmanager
+    def labels(self, **labels):
+        """この範囲でこのスレッドが記録する値に共通のラベルを付ける"""
+        previous = getattr(self._context, 'labels', {})
+        self._context.labels = {**previous, **{label: str(value) for label, value in labels.items()
+                                               if value is not None}}
+        try:
+            yield
+        finally:
+            self._context.labels = previous
+
+    def inc(self, name, value=1, **labels):
+        """カウンターを増やす（名前は *_total にする）"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ヒストグラムに値を記録する"""
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """範囲の処理時間（秒）をヒストグラムに記録する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        範囲の処理時間を {name}_seconds に記録し、終了時に構造化ログを出す
+        Args:
+            name (str): スパン名
+            **attributes: ログに付ける項目（yieldした辞書に範囲内で項目を足せる）
+        """
+        otel_span = _tracer.start_as_current_span(name) if _tracer is not None else None
+        if otel_span is not None:
+            otel_span.__enter__()
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            yield attributes
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(f'{name}_seconds', seconds, status=status)
+            if otel_span is not None:
+                current = trace.get_current_span()
+                for key, value in attributes.items():
+                    if isinstance(value, (str, bool, int, float)):
+                        current.set_attribute(key, value)
+                otel_span.__exit__(None, None, None)
+            log_event(name, severity='INFO' if status == 'ok' else 'ERROR', span=name,
+                      duration_seconds=round(seconds, 3), status=status, **attributes)
+
+    def snapshot(self):
+        """
+        全体を辞書で返す
+        Returns:
+            dict: {'counters': {名前: [{'labels': ..., 'value': ...}]},
+                   'histograms': {名前: [{'labels': ..., 'count': ..., 'sum': ..., 'mean': ...}]}}
+        """
+        with self._lock:
+            counters = {}
+            for (name, labels), value in sorted(self._counters.items()):
+                counters.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            histograms = {}
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                histograms.setdefault(name, []).append({
+                    'labels': dict(labels),
+                    'count': histogram.count,
+                    'sum': round(histogram.sum, 6),
+                    'mean': round(histogram.sum / histogram.count, 6) if histogram.count else None,
+                })
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self):
+        """Prometheusのテキスト形式（0.0.4）で全体を返す"""
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                metric = f'{self.namespace}_{name}'
+                if metric not in typed:
+                    lines.append(f'# TYPE {metric} counter')
+                    typed.add(metric)
+                lines.append(f'{metric}{_format_labels(labels)} {value}')
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                metric = f'{self.namespace}_{name}'
+                if metric not in typed:
+                    lines.append(f'# TYPE {metric} histogram')
+                    typed.add(metric)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{_format_labels(labels, [("le", str(bound))])} {cumulative}')
+                lines.append(f'{metric}_bucket{_format_labels(labels, [("le", "+Inf")])} {histogram.count}')
+                lines.append(f'{metric}_sum{_format_labels(labels)} {histogram.sum}')
+                lines.append(f'{metric}_count{_format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=9100, host='0.0.0.0'):
+        """
+        /metrics でPrometheusのテキスト形式を返すHTTPサーバーをバックグラウンドで起動する
+        Returns:
+            ThreadingHTTPServer: 起動したサーバー（shutdown()で停止）
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
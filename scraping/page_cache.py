@@ -0,0 +1,201 @@
+import gzip
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+RACE_DATE_PATTERN = re.compile(r'(\d{4})年(\d{1,2})月(\d{1,2})日')
+
+
+class HtmlPageCache:
+    """
+    生HTMLのローカルキャッシュ
+    - 本文はSHA-256で内容アドレス化し、gzip圧縮して objects/ 以下に保存
+    - キー（race_idなど）→ 本文・ETag・Last-Modified の対応はSQLiteのインデックスで管理
+    - 合計サイズがmax_bytesを超えたら最終アクセスが古い順に削除（LRU）
+    - レース日からfinal_after_days日以上経ってから取得したページは確定済みとして再検証しない
+    """
+
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3, final_after_days=7, metrics=None):
+        """
+        Args:
+            directory (str): キャッシュを置くディレクトリ
+            max_bytes (int): 圧縮後の合計サイズの上限
+            final_after_days (int): レース日から何日経てば結果が確定したとみなすか
+            metrics (MetricsRegistry, optional): ヒット・再検証・ミスの件数の記録先
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.final_after = timedelta(days=final_after_days)
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0, 'evictions': 0}
+        self.metrics = metrics
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, 'index.sqlite3'), check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                key TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                race_date TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._db.commit()
+
+    def _count(self, result):
+        self.stats[result] += 1
+        if self.metrics is not None:
+            self.metrics.inc('page_cache_total', result=result)
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], f'{digest}.gz')
+
+    def get(self, key):
+        """
+        キャッシュされたページを取得する
+        Returns:
+            dict or None: content(bytes), etag, last_modified, race_date, fetched_at
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT digest, etag, last_modified, race_date, fetched_at FROM pages WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE pages SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+
+        digest, etag, last_modified, race_date, fetched_at = row
+        try:
+            with gzip.open(self._object_path(digest), 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        return {
+            'content': content,
+            'etag': etag,
+            'last_modified': last_modified,
+            'race_date': race_date,
+            'fetched_at': fetched_at,
+        }
+
+    def is_final(self, entry):
+        """レース日から一定期間経った後に取得したページか（以降は変化しないとみなす）"""
+        if not entry or not entry.get('race_date'):
+            return False
+        race_date = datetime.strptime(entry['race_date'], '%Y-%m-%d')
+        return datetime.fromtimestamp(entry['fetched_at']) >= race_date + self.final_after
+
+    def put(self, key, content, etag=None, last_modified=None, encoding='EUC-JP'):
+        """ページをキャッシュに保存する"""
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with gzip.open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+
+        match = RACE_DATE_PATTERN.search(content.decode(encoding, errors='replace'))
+        race_date = None
+        if match:
+            year, month, day = (int(group) for group in match.groups())
+            race_date = f'{year:04d}-{month:02d}-{day:02d}'
+
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT digest FROM pages WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, digest, os.path.getsize(path), etag, last_modified, race_date, now, now)
+            )
+            self._db.commit()
+            if old and old[0] != digest:
+                self._remove_object_if_unreferenced(old[0])
+        self.evict()
+
+    def mark_validated(self, key):
+        """304 Not Modifiedを受けたページの取得時刻を更新する"""
+        now = time.time()
+        with self._lock:
+            self._db.execute("UPDATE pages SET fetched_at = ?, accessed_at = ? WHERE key = ?", (now, now, key))
+            self._db.commit()
+
+    def _remove_object_if_unreferenced(self, digest):
+        """どのキーからも参照されなくなった本文を削除する（削除した場合True）"""
+        if self._db.execute("SELECT 1 FROM pages WHERE digest = ? LIMIT 1", (digest,)).fetchone() is not None:
+            return False
+        try:
+            os.remove(self._object_path(digest))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def total_bytes(self):
+        with self._lock:
+            # 同じ本文を複数のキーが参照していても1回だけ数える
+            row = self._db.execute("SELECT SUM(size) FROM (SELECT DISTINCT digest, size FROM pages)").fetchone()
+        return row[0] or 0
+
+    def evict(self):
+        """合計サイズが上限を超えていれば、最終アクセスが古いページから削除する"""
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        with self._lock:
+            rows = self._db.execute("SELECT key, digest, size FROM pages ORDER BY accessed_at").fetchall()
+            for key, digest, size in rows:
+                if total <= self.max_bytes:
+                    break
+                self._db.execute("DELETE FROM pages WHERE key = ?", (key,))
+                if self._remove_object_if_unreferenced(digest):
+                    total -= size
+                self.stats['evictions'] += 1
+            self._db.commit()
+
+    def fetch(self, fetcher, key, url, max_age=None):
+        """
+        キャッシュを通してページを取得する
+        - 確定済みのページはネットワークにアクセスせずに返す
+        - それ以外はETag/Last-Modifiedによる条件付きGETで再検証する
+        Args:
+            fetcher (ConcurrentFetcher): 取得に使うフェッチエンジン
+            key (str): キャッシュキー（race_idなど）
+            url (str): 取得するURL
+            max_age (float, optional): 取得から何秒以内ならネットワークにアクセスしないか
+                （指定した場合はレース日による確定の判定の代わりに使う。馬のページなど）
+        Returns:
+            bytes: ページの本文
+        """
+        entry = self.get(key)
+        fresh = (time.time() - entry['fetched_at'] < max_age) if entry and max_age is not None else self.is_final(entry)
+        if entry and fresh:
+            self._count('hits')
+            return entry['content']
+
+        headers = {}
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        response = fetcher.fetch(url, headers=headers)
+        if response.status_code == 304 and entry:
+            self.mark_validated(key)
+            self._count('revalidated')
+            return entry['content']
+
+        response.raise_for_status()
+        self._count('misses')
+        self.put(key, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return response.content
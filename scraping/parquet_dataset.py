@@ -0,0 +1,291 @@
+import json
+import os
+import re
+import uuid
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from scraping.schema import RACE_RESULT_COLUMNS, VENUE_NAMES
+from scraping.storage_backends import LocalStorage
+
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), 'nk_race_result_schema.json')
+
+# スクレイパーが出力するデータセットとJRDBから作るデータセットのテーブル名
+RACE_RESULT_DATASET = 'race_result_parquet'
+JRDB_RACE_RESULT_DATASET = 'jrdb_race_result'
+
+# BigQueryの型 → Parquetの型
+ARROW_TYPES = {
+    'STRING': pa.string(),
+    'INTEGER': pa.int64(),
+    'FLOAT': pa.float64(),
+    'DATE': pa.date32(),
+    'TIME': pa.time32('s'),
+}
+
+# スクレイパーのレース情報の列名 → スキーマの列名
+RACE_INFO_COLUMN_NAMES = {
+    'race_name': 'race_name',
+    'race_date': 'race_date',
+    'kaisai_kai': 'kaisai_kai',
+    'kaisai_place': 'venue',
+    'kaisai_nichime': 'day_number',
+    'track_type': 'track_type',
+    'track_direction': 'track_direction',
+    'track_distance': 'distance',
+    'weather': 'weather',
+    'track_condition': 'track_condition',
+    'start_time': 'start_time',
+    'race_conditions': 'race_conditions',
+}
+
+# 同じキーの行は後に書いたパートのものが優先
+KEY_COLUMNS = ['race_id', 'horse_number']
+
+_PARTITION_PATTERN = re.compile(r'/year=(\d{4})/venue=([^/]+)/')
+_TIME_PATTERN = r'^(\d{1,2}):(\d{2})(?::(\d{2}))?'
+
+
+def load_schema(path=SCHEMA_PATH):
+    """nk_race_result_schema.json からParquetのスキーマを作る（列の並びも同じ）"""
+    with open(path, encoding='utf-8') as f:
+        fields = json.load(f)
+    return pa.schema([pa.field(field['name'], ARROW_TYPES[field['type']]) for field in fields])
+
+
+RACE_RESULT_SCHEMA = load_schema()
+# スクレイパーの結果の列名 → スキーマの列名（schema.RACE_RESULT_COLUMNS と同じ並びなので位置で対応する）
+RACE_RESULT_COLUMN_NAMES = dict(zip(RACE_RESULT_COLUMNS, RACE_RESULT_SCHEMA.names))
+
+
+def race_result_frame(race_infos, race_results):
+    """
+    スクレイパーのレース情報と結果をスキーマの列名の1つの表にする
+    Args:
+        race_infos (list): レース情報の辞書のリスト（結果と同じ保存単位のもの）
+        race_results (list or DataFrame): レース結果
+    Returns:
+        DataFrame: 結果の行にレース情報の列を付けたもの（情報の無いレースの列は欠損）
+    """
+    results = race_results if isinstance(race_results, pd.DataFrame) else pd.DataFrame(race_results)
+    results = results.rename(columns=RACE_RESULT_COLUMN_NAMES)
+    results['race_id'] = results['race_id'].astype(str)
+    if not race_infos:
+        return results
+
+    infos = pd.DataFrame(race_infos)
+    infos = infos[['race_id'] + [c for c in RACE_INFO_COLUMN_NAMES if c in infos.columns]]
+    infos = infos.rename(columns=RACE_INFO_COLUMN_NAMES)
+    infos['race_id'] = infos['race_id'].astype(str)
+    infos = infos.drop_duplicates(subset='race_id', keep='last')
+    # 結果側にある同名の列より、レース情報の値を使う
+    results = results.drop(columns=[c for c in infos.columns if c != 'race_id' and c in results.columns])
+    return results.merge(infos, on='race_id', how='left')
+
+
+def _column_array(values, type_):
+    """1列をスキーマの型の配列にする（変換できない値は欠損）"""
+    if pa.types.is_string(type_):
+        try:
+            # 文字列・category・数値の列はそのまま変換できる
+            return pa.array(values, from_pandas=True).cast(type_)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            values = values.astype(object)
+            return pa.array(values.where(values.isna(), values.astype(str)), type=type_, from_pandas=True)
+    if pa.types.is_integer(type_):
+        numbers = pd.to_numeric(values, errors='coerce').astype(float)
+        return pa.array(numbers, from_pandas=True).cast(type_, safe=False)
+    if pa.types.is_floating(type_):
+        return pa.array(pd.to_numeric(values, errors='coerce').astype(float), type=type_, from_pandas=True)
+    if pa.types.is_date(type_):
+        dates = pd.to_datetime(values, errors='coerce')
+        return pa.array(dates, from_pandas=True).cast(type_)
+    # 時刻（"10:20:00"。スクレイパーは末尾に":00"が余分に付くので先頭のHH:MM:SSだけを使う）
+    parts = values.astype(object).where(values.notna()).astype(str).str.extract(_TIME_PATTERN)
+    seconds = (pd.to_numeric(parts[0]) * 3600 + pd.to_numeric(parts[1]) * 60
+               + pd.to_numeric(parts[2]).fillna(0))
+    return pa.array(seconds, from_pandas=True).cast(pa.int32()).cast(type_)
+
+
+def to_arrow_table(df, schema=RACE_RESULT_SCHEMA):
+    """
+    スキーマの列だけを、スキーマの並び・型のテーブルにする
+    （データに無い列は欠損で埋めるので、どのパートも同じスキーマになる）
+    """
+    df = df.reset_index(drop=True)
+    arrays = []
+    for field in schema:
+        if field.name in df.columns:
+            arrays.append(_column_array(df[field.name], field.type))
+        else:
+            arrays.append(pa.nulls(len(df), field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _venue_codes(venues):
+    """競馬場の指定（コードまたは名前、複数可）を競馬場コードにする"""
+    if isinstance(venues, str):
+        venues = [venues]
+    codes_by_name = {name: code for code, name in VENUE_NAMES.items()}
+    return [codes_by_name.get(venue, venue) for venue in venues]
+
+
+def _as_list(values):
+    return [values] if isinstance(values, str) else list(values)
+
+
+class ParquetDataset:
+    """
+    年・競馬場で分割したParquetのデータセット（nk_race_result_schema.json のスキーマ）
+    - {table}/year=YYYY/venue=PP/part-*.parquet にパートファイルを追記する
+    - query()は年・競馬場をパスで絞り込んでから、必要な列と条件だけをファイルの読み込みに渡す
+      （ローカルのファイルは必要な列・行グループだけを読む）
+    """
+
+    def __init__(self, storage, bucket_name, table=RACE_RESULT_DATASET, schema=RACE_RESULT_SCHEMA):
+        """
+        Args:
+            storage (StorageBackend): 保存先のストレージ
+            bucket_name (str): バケット名
+            table (str): テーブル名（パーティションの接頭辞）
+            schema (pyarrow.Schema): 書き出すスキーマ
+        """
+        self.storage = storage
+        self.bucket_name = bucket_name
+        self.table = table
+        self.schema = schema
+
+    def partition_prefix(self, year=None, venue=None):
+        prefix = f'{self.table}/'
+        if year is not None:
+            prefix += f'year={year}/'
+            if venue is not None:
+                prefix += f'venue={venue}/'
+        return prefix
+
+    def _part_name(self, prefix, part_id):
+        if part_id is None:
+            part_id = f"{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}-{uuid.uuid4().hex[:8]}"
+        return f'{prefix}part-{part_id}.parquet'
+
+    def write(self, df, part_id=None):
+        """
+        行を年・競馬場ごとのパートファイルとして書き出す
+        Args:
+            df (DataFrame): スキーマの列名の行（race_id列が必須）
+            part_id (str, optional): パートファイル名に使うID。同じIDで書き直すとパートを置き換える
+                （省略時は書き込み時刻から作り、常に追記になる）
+        Returns:
+            list: 書き出したパートファイル名
+        """
+        if df.empty:
+            return []
+        race_id = df['race_id'].astype(str).reset_index(drop=True)
+        # 型の変換は全体で1度だけ行い、パーティションごとに行を取り出す
+        table = to_arrow_table(df, self.schema)
+        sort_keys = [(column, 'ascending') for column in KEY_COLUMNS if column in self.schema.names]
+        written = []
+        for (year, venue), index in race_id.groupby([race_id.str[:4], race_id.str[4:6]], sort=True).indices.items():
+            # キー順に並べておくと、行グループの統計情報で読み飛ばせる範囲が広がる
+            part = table.take(index).sort_by(sort_keys)
+            sink = pa.BufferOutputStream()
+            pq.write_table(part, sink, compression='zstd')
+            name = self._part_name(self.partition_prefix(year, venue), part_id)
+            self.storage.write_bytes(self.bucket_name, name, sink.getvalue().to_pybytes(),
+                                     content_type='application/vnd.apache.parquet')
+            written.append(name)
+        return written
+
+    def list_parts(self, start_year=None, end_year=None, venues=None):
+        """
+        条件に合うパーティションのパートファイル名を返す
+        Args:
+            start_year (int, optional): 最初の年
+            end_year (int, optional): 最後の年（この年を含む）
+            venues (str or list, optional): 競馬場コードまたは競馬場名
+        Returns:
+            list: パートファイル名（パーティション内はファイル名順＝書き込み順）
+        """
+        codes = _venue_codes(venues) if venues else None
+        if start_year is not None and end_year is not None:
+            # 年の範囲が決まっていればパーティションごとに一覧を取る（履歴全体を列挙しない）
+            prefixes = [self.partition_prefix(year, code)
+                        for year in range(int(start_year), int(end_year) + 1) for code in (codes or [None])]
+        else:
+            prefixes = [self.partition_prefix()]
+
+        names = []
+        for prefix in prefixes:
+            for name in self.storage.list(self.bucket_name, prefix):
+                match = _PARTITION_PATTERN.search(name)
+                if not name.endswith('.parquet') or match is None:
+                    continue
+                year, code = int(match.group(1)), match.group(2)
+                if start_year is not None and year < int(start_year):
+                    continue
+                if end_year is not None and year > int(end_year):
+                    continue
+                if codes is not None and code not in codes:
+                    continue
+                names.append(name)
+        return names
+
+    def _source(self, name):
+        # ローカルのファイルはパスで渡し、必要な列・行グループだけを読ませる
+        # （それ以外は1度だけダウンロードし、同じバッファから何度でも読めるようにする）
+        if isinstance(self.storage, LocalStorage):
+            return self.storage.path(self.bucket_name, name)
+        return pa.py_buffer(self.storage.read_bytes(self.bucket_name, name))
+
+    def _read(self, source, columns, filters=None):
+        # パスのvenue=PPは競馬場コードなので、列のvenue（競馬場名）をパーティションの値で上書きさせない
+        return pq.read_table(source, columns=columns, filters=filters, schema=self.schema, partitioning=None)
+
+    def query(self, columns=None, start_year=None, end_year=None, venues=None, track_type=None,
+              race_name=None, filter=None):
+        """
+        条件に合う行の指定した列だけを読み込む
+        年・競馬場はパーティションのパスで、それ以外の条件はパートファイルの読み込み時に絞り込む
+        Args:
+            columns (list, optional): 読み込む列（省略時は全列）
+            start_year (int, optional): 最初の年
+            end_year (int, optional): 最後の年（この年を含む）
+            venues (str or list, optional): 競馬場コードまたは競馬場名（例: '東京'）
+            track_type (str or list, optional): '芝' / 'ダ' など
+            race_name (str, optional): レース名に含まれる文字列（例: 'マイルカップ'）
+            filter (pyarrow.compute.Expression, optional): その他の条件
+                （例: (pc.field('rank') >= 1) & (pc.field('rank') <= 3)）
+        Returns:
+            DataFrame: 読み込んだ行（同じキーの行は最後に書いたものだけを残す）
+        """
+        columns = list(columns or self.schema.names)
+        expression = filter
+        conditions = []
+        if track_type is not None:
+            conditions.append(pc.field('track_type').isin(_as_list(track_type)))
+        if race_name is not None:
+            conditions.append(pc.match_substring(pc.field('race_name'), race_name))
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+
+        keys = [column for column in KEY_COLUMNS if column in self.schema.names]
+        read_columns = list(dict.fromkeys(keys + columns))
+        sources = [self._source(name) for name in self.list_parts(start_year, end_year, venues)]
+        if not sources:
+            return pd.DataFrame(columns=columns)
+        tables = [self._read(source, read_columns, expression) for source in sources]
+        df = pa.concat_tables(tables).to_pandas(date_as_object=False)
+        if expression is not None and keys:
+            # 条件で絞り込む前に、キーごとに最後に書いたパートを決める
+            # （新しい行が条件に合わなくなったときに、条件に合う古い行を返さない）
+            latest = pd.concat([
+                self._read(source, keys).to_pandas().assign(_part=i) for i, source in enumerate(sources)
+            ]).drop_duplicates(subset=keys, keep='last')
+            df['_part'] = [i for i, table in enumerate(tables) for _ in range(table.num_rows)]
+            df = df.merge(latest, on=keys + ['_part'], how='inner', sort=False)
+        df = df.drop_duplicates(subset=keys, keep='last')
+        return df[columns].reset_index(drop=True)
@@ -0,0 +1,306 @@
+import io
+import posixpath
+import uuid
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# パーティションごとのキーのインデックス（upsertで使う）の置き場
+KEY_INDEX_PREFIX = '_index/'
+# コンパクションでまとめたパートのファイル名の末尾（まとめた最後のパート名の'.csv.gz'を置き換える）
+COMPACTED_SUFFIX = '-compacted.csv.gz'
+
+
+def unread_parts(names, absorbed, skip_compacted=False):
+    """
+    反映済みのパートに無いパートファイル名を返す
+    （ファイル名の大小ではなく名前の集合で判定するので、同時に書かれた名前の小さいパートも読み落とさない）
+    Args:
+        names (list): パートファイル名（list_partsの結果）
+        absorbed (set): 反映済みのパートのファイル名（basename）
+        skip_compacted (bool): コンパクションでできたパートのうち、まとめた最後のパートが反映済みのものも
+            反映済みとみなす（同じ行を読み直さない）
+    Returns:
+        list: 未反映のパートファイル名
+    """
+    unread = []
+    for name in names:
+        basename = posixpath.basename(name)
+        if basename in absorbed:
+            continue
+        if (skip_compacted and basename.endswith(COMPACTED_SUFFIX)
+                and basename[:-len(COMPACTED_SUFFIX)] + '.csv.gz' in absorbed):
+            continue
+        unread.append(name)
+    return unread
+
+
+def _comparable(df, columns):
+    """
+    比較用に列を文字列にそろえる（保存前の値とCSVから読んだ値が同じ文字列になるように）
+    数値として読める値は小数の書式に、欠損は空文字列にする
+    """
+    values = {}
+    for column in columns:
+        if column not in df.columns:
+            values[column] = pd.Series('', index=df.index)
+            continue
+        column_values = df[column]
+        if column_values.dtype == np.float32:
+            # float32の列（列形式の結果）はfloat64にすると12.300000190734863のように桁が増えるので、
+            # CSVに書かれるのと同じfloat32の最短の表記（12.3）にしてから比べる
+            column_values = column_values.astype(str).where(column_values.notna())
+        text = column_values.astype(object)
+        text = text.where(text.isna(), text.astype(str))
+        numbers = pd.to_numeric(text, errors='coerce').astype(float)
+        values[column] = text.where(numbers.isna(), numbers.astype(str)).fillna('')
+    return pd.DataFrame(values, index=df.index)
+
+
+def _merge_hashes(keys, rows, new_keys, new_rows):
+    """キーのハッシュに新しい値を足す（同じキーは後の値で置き換え、キー順に並べ直す）"""
+    all_keys = np.concatenate([keys, new_keys])[::-1]
+    all_rows = np.concatenate([rows, new_rows])[::-1]
+    # 逆順にしてから最初に現れた位置を取る＝各キーの最後の値
+    unique_keys, last = np.unique(all_keys, return_index=True)
+    return unique_keys, all_rows[last]
+
+
+class PartitionedStore:
+    """
+    年・競馬場で分割した追記専用のCSVストア
+    - 保存のたびに新しい行だけを gzip圧縮CSVのパートファイルとして書き出す
+      （{table}/year=YYYY/venue=PP/part-YYYYmmddHHMMSSffffff-xxxxxxxx.csv.gz）
+    - 既存データのダウンロード・再アップロードをしないので、保存コストは履歴の量によらず一定
+    - 同じキーの行が複数のパートにある場合は、ファイル名順で後のパートが優先
+    - compact()でパーティション内のパートを1ファイルにまとめる
+    - upsert()はキーで既存の行とつき合わせ、追加・変更された行だけを書き出す
+    """
+
+    def __init__(self, storage, bucket_name, table, key_columns, columns, string_columns=('race_id',)):
+        """
+        Args:
+            storage (StorageBackend): 保存先のストレージ
+            bucket_name (str): バケット名
+            table (str): テーブル名（パーティションの接頭辞）
+            key_columns (list): 行を一意に識別する列
+            columns (list): 出力する列の並び（これ以外の列は後ろに付ける）
+            string_columns (iterable): 読み込むときに文字列のままにする列（先頭の0を残すIDなど）
+        """
+        self.storage = storage
+        self.bucket_name = bucket_name
+        self.table = table
+        self.key_columns = key_columns
+        self.columns = columns
+        self.string_columns = tuple(string_columns)
+
+    def partition_prefix(self, year=None, venue=None):
+        prefix = f'{self.table}/'
+        if year is not None:
+            prefix += f'year={year}/'
+            if venue is not None:
+                prefix += f'venue={venue}/'
+        return prefix
+
+    def _ordered(self, df):
+        columns = [c for c in self.columns if c in df.columns]
+        columns += [c for c in df.columns if c not in self.columns]
+        return df[columns]
+
+    def _new_part_name(self, prefix):
+        return f"{prefix}part-{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}-{uuid.uuid4().hex[:8]}.csv.gz"
+
+    def _write_part(self, name, df):
+        buffer = io.BytesIO()
+        self._ordered(df).to_csv(buffer, index=False, compression={'method': 'gzip', 'mtime': 0})
+        self.storage.write_bytes(self.bucket_name, name, buffer.getvalue(), content_type='application/gzip')
+        return name
+
+    def append(self, rows):
+        """
+        新しい行をパートファイルとして追記する
+        Args:
+            rows (list or DataFrame): 追記する行（race_id列が必須）
+        Returns:
+            list: 書き出したパートファイル名
+        """
+        df = pd.DataFrame(rows)
+        if df.empty:
+            return []
+        df['race_id'] = df['race_id'].astype(str)
+
+        written = []
+        for (year, venue), part in df.groupby([df['race_id'].str[:4], df['race_id'].str[4:6]], sort=True):
+            written.append(self._write_part(self._new_part_name(self.partition_prefix(year, venue)), part))
+        return written
+
+    def _hashes(self, df):
+        """行のキー（key_columns）と内容（columnsの列）のハッシュ"""
+        keys = pd.util.hash_pandas_object(_comparable(df, self.key_columns), index=False).to_numpy()
+        rows = pd.util.hash_pandas_object(_comparable(df, self.columns), index=False).to_numpy()
+        return keys, rows
+
+    def _key_index_name(self, year, venue):
+        return f'{KEY_INDEX_PREFIX}{self.partition_prefix(year, venue)}keys.npz'
+
+    def _load_key_index(self, year, venue):
+        """
+        パーティションのキーのインデックスを読み込み、インデックスに無いパートを読み足す
+        （他の書き込み・コンパクションで増えたパートだけを読むので、普段はパートを読まない）
+        Returns:
+            tuple: (ソート済みのキーのハッシュ, 行の内容のハッシュ, 反映済みのパートファイル名のset)
+        """
+        try:
+            data = self.storage.read_bytes(self.bucket_name, self._key_index_name(year, venue))
+            with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+                keys, rows, indexed = arrays['keys'], arrays['rows'], set(arrays['parts'].tolist())
+        except FileNotFoundError:
+            keys, rows, indexed = np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint64), set()
+
+        names = self.list_parts(year, venue)
+        unread = [name for name in names if posixpath.basename(name) not in indexed]
+        if unread:
+            new_keys, new_rows = self._hashes(pd.concat([self.read_part(name) for name in unread], ignore_index=True))
+            keys, rows = _merge_hashes(keys, rows, new_keys, new_rows)
+        # コンパクションで消えたパートは記録から外す
+        return keys, rows, {posixpath.basename(name) for name in names}
+
+    def _save_key_index(self, year, venue, keys, rows, parts):
+        buffer = io.BytesIO()
+        np.savez(buffer, keys=keys, rows=rows, parts=np.array(sorted(parts), dtype=str))
+        self.storage.write_bytes(self.bucket_name, self._key_index_name(year, venue), buffer.getvalue(),
+                                 content_type='application/octet-stream')
+
+    def upsert(self, rows):
+        """
+        キー（key_columns）で既存の行とつき合わせ、追加・変更された行だけをパートファイルとして書き出す
+        - 新しい行が属するパーティションのキーのインデックス（キーと行の内容のハッシュ）だけを読むので、
+          処理量は履歴の量ではなく新しい行の数で決まる
+        - 内容が同じ行は書き出さない（同じレースを保存し直してもパートファイルは増えない）
+        Args:
+            rows (list or DataFrame): 行（race_id列が必須）
+        Returns:
+            dict: inserted / updated / unchanged の行数と、書き出したパートファイル名のリスト（parts）
+        """
+        result = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'parts': []}
+        df = pd.DataFrame(rows)
+        if df.empty:
+            return result
+        df['race_id'] = df['race_id'].astype(str)
+        keys, row_hashes = self._hashes(df)
+        # 同じキーの行が複数あれば最後の行を使う
+        last = ~pd.Series(keys).duplicated(keep='last').to_numpy()
+        df, keys, row_hashes = df[last].reset_index(drop=True), keys[last], row_hashes[last]
+
+        race_ids = df['race_id']
+        for (year, venue), index in race_ids.groupby([race_ids.str[:4], race_ids.str[4:6]], sort=True).indices.items():
+            index_keys, index_rows, parts = self._load_key_index(year, venue)
+            batch_keys, batch_rows = keys[index], row_hashes[index]
+            found = np.zeros(len(index), dtype=bool)
+            unchanged = np.zeros(len(index), dtype=bool)
+            if len(index_keys):
+                position = np.minimum(np.searchsorted(index_keys, batch_keys), len(index_keys) - 1)
+                found = index_keys[position] == batch_keys
+                unchanged = found & (index_rows[position] == batch_rows)
+            changed = ~unchanged
+            result['inserted'] += int((~found).sum())
+            result['updated'] += int((found & changed).sum())
+            result['unchanged'] += int(unchanged.sum())
+            if not changed.any():
+                continue
+
+            name = self._write_part(self._new_part_name(self.partition_prefix(year, venue)), df.iloc[index[changed]])
+            result['parts'].append(name)
+            index_keys, index_rows = _merge_hashes(index_keys, index_rows, batch_keys[changed], batch_rows[changed])
+            self._save_key_index(year, venue, index_keys, index_rows, parts | {posixpath.basename(name)})
+        return result
+
+    def list_parts(self, year=None, venue=None):
+        """パートファイル名をファイル名順（＝書き込み順）で返す"""
+        names = self.storage.list(self.bucket_name, self.partition_prefix(year, venue))
+        return [name for name in names if name.endswith('.csv.gz')]
+
+    def read_part(self, name, columns=None):
+        data = self.storage.read_bytes(self.bucket_name, name)
+        usecols = (lambda c: c in columns) if columns else None
+        return pd.read_csv(io.BytesIO(data), compression='gzip', usecols=usecols,
+                           dtype={column: str for column in self.string_columns})
+
+    def read(self, year=None, venue=None, columns=None):
+        """
+        パーティションの行を読み込む（同じキーの行は最新のものだけを残す）
+        Args:
+            year (int, optional): 年（省略時は全期間）
+            venue (str, optional): 競馬場コード
+            columns (list, optional): 読み込む列（キー列は常に含む）
+        Returns:
+            DataFrame: 読み込んだ行
+        """
+        if columns:
+            columns = list(dict.fromkeys(self.key_columns + list(columns)))
+        frames = [self.read_part(name, columns) for name in self.list_parts(year, venue)]
+        if not frames:
+            return pd.DataFrame(columns=columns or self.columns)
+        df = pd.concat(frames, ignore_index=True)
+        keys = [c for c in self.key_columns if c in df.columns]
+        return df.drop_duplicates(subset=keys, keep='last').reset_index(drop=True)
+
+    def read_races(self, race_ids):
+        """
+        指定したレースの行を読み込む（レースの属するパーティションだけを読む）
+        Args:
+            race_ids (iterable): レースID
+        Returns:
+            DataFrame: 読み込んだ行（同じキーの行は最新のものだけ）
+        """
+        race_ids = {str(race_id) for race_id in race_ids}
+        frames = [self.read(year, venue) for year, venue in sorted({(race_id[:4], race_id[4:6]) for race_id in race_ids})]
+        if not frames:
+            return pd.DataFrame(columns=self.columns)
+        df = pd.concat(frames, ignore_index=True)
+        return df[df['race_id'].astype(str).isin(race_ids)].reset_index(drop=True)
+
+    def read_race_ids(self, year=None):
+        """保存済みのレースIDを取得する（race_id列だけを読む）"""
+        return set(self.read(year, columns=['race_id'])['race_id'].astype(str))
+
+    def compact(self, year=None, venue=None):
+        """
+        パーティションごとにパートファイルを1ファイルにまとめる
+        Returns:
+            int: まとめたパーティションの数
+        """
+        partitions = {}
+        for name in self.list_parts(year, venue):
+            partitions.setdefault(name.rsplit('/', 1)[0] + '/', []).append(name)
+
+        compacted = 0
+        for names in partitions.values():
+            if len(names) < 2:
+                continue
+            frames = [self.read_part(name) for name in names]
+            df = pd.concat(frames, ignore_index=True)
+            df = df.drop_duplicates(subset=self.key_columns, keep='last')
+            df = df.sort_values(self.key_columns, kind='stable')
+            # 最後にまとめたパートの直後に並ぶ名前にする（まとめている間に追記されたパートが優先されるように）
+            self._write_part(names[-1][:-len('.csv.gz')] + COMPACTED_SUFFIX, df)
+            # 新しいファイルを書いてから古いパートを消す（途中で失敗してもデータは失われない）
+            for name in names:
+                self.storage.delete(self.bucket_name, name)
+            compacted += 1
+        return compacted
+
+    def import_legacy_csv(self, blob_name):
+        """
+        従来の1ファイル形式のCSVをパートファイルに移行する
+        Returns:
+            int: 移行した行数
+        """
+        try:
+            data = self.storage.read_bytes(self.bucket_name, blob_name)
+        except FileNotFoundError:
+            return 0
+        df = pd.read_csv(io.BytesIO(data), dtype={'race_id': str})
+        self.append(df)
+        return len(df)
@@ -0,0 +1,194 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from scraping.result_columns import attach_race_id
+
+# ワーカープロセスごとに1つだけ作るパース用のスクレイパー
+_worker_scraper = None
+
+_DONE = object()
+
+
+def _parse_in_worker(race_id, html, parser, result_format):
+    """ワーカープロセスでレースページをパースする"""
+    global _worker_scraper
+    if _worker_scraper is None:
+        from scraping.scraping_netkeiba import NetkeibaRaceScraper
+        _worker_scraper = NetkeibaRaceScraper(storage='memory', use_calendar=False, parser=parser,
+                                              result_format=result_format)
+    start = time.perf_counter()
+    try:
+        race_data = _worker_scraper._parse_race_page(html, parser=parser)
+    except Exception as e:
+        print(f"Error parsing race {race_id}: {str(e)}")
+        race_data = None
+    return race_id, race_data, time.perf_counter() - start
+
+
+class StageCounter:
+    """ステージごとの処理件数・処理時間・スループット"""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def record(self, seconds, error=False, count=1):
+        with self._lock:
+            if self.started is None:
+                self.started = time.perf_counter() - seconds
+            self.items += count
+            self.errors += int(error)
+            self.busy_seconds += seconds
+            self.finished = time.perf_counter()
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = (self.finished - self.started) if self.started is not None else 0.0
+            return {
+                'items': self.items,
+                'errors': self.errors,
+                'busy_seconds': round(self.busy_seconds, 3),
+                'items_per_second': round(self.items / elapsed, 2) if elapsed > 0 else 0.0,
+            }
+
+
+class ScrapePipeline:
+    """
+    取得・パース・保存を分けたパイプライン
+    - fetch: スクレイパーのフェッチエンジン（レート制限付き）で生HTMLを取得し、上限付きキューに入れる
+    - parse: プロセスプールで _get_race_info / _get_race_results 相当のパースを並列に実行
+    - write: パース結果をbatch_sizeレース分ずつまとめて保存
+    キューと実行中タスク数に上限があるので、後段が詰まれば前段は待つ（バックプレッシャー）
+    """
+
+    def __init__(self, scraper, parse_workers=None, queue_size=64, batch_size=100):
+        """
+        Args:
+            scraper (NetkeibaRaceScraper): 取得・保存に使うスクレイパー
+            parse_workers (int, optional): パースに使うプロセス数（省略時はCPUコア数）
+            queue_size (int): ステージ間のキューの長さ
+            batch_size (int): 何レース分ずつ保存するか
+        """
+        self.scraper = scraper
+        self.parse_workers = parse_workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.counters = {name: StageCounter(name) for name in ('fetch', 'parse', 'write')}
+
+    def stats(self):
+        """ステージごとのカウンター"""
+        return {name: counter.snapshot() for name, counter in self.counters.items()}
+
+    def _fetch_stage(self, race_ids, html_queue, fetch_html):
+        def _fetch(race_id):
+            start = time.perf_counter()
+            try:
+                html = fetch_html(race_id)
+            except Exception as e:
+                print(f"Error fetching race {race_id}: {str(e)}")
+                self.counters['fetch'].record(time.perf_counter() - start, error=True)
+                return
+            self.counters['fetch'].record(time.perf_counter() - start)
+            html_queue.put((race_id, html))  # キューが満杯ならパースが追いつくまで待つ
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.scraper.fetcher.max_concurrency) as executor:
+                list(executor.map(_fetch, race_ids))
+        finally:
+            html_queue.put(_DONE)
+
+    def _parse_stage(self, html_queue, parsed_queue):
+        in_flight = threading.BoundedSemaphore(self.parse_workers * 2)
+
+        def _on_done(future):
+            try:
+                race_id, race_data, seconds = future.result()
+                self.counters['parse'].record(seconds, error=race_data is None)
+                labels = {'year': race_id[:4], 'venue': race_id[4:6]}
+                self.scraper.metrics.observe('parse_seconds', seconds, **labels)
+                if race_data is None:
+                    self.scraper.metrics.inc('scrape_errors_total', stage='parse', **labels)
+                else:
+                    self.scraper.metrics.inc('races_processed_total', **labels)
+                self.scraper.record_parsed(race_id, race_data)
+                parsed_queue.put((race_id, race_data))
+            except Exception as e:
+                print(f"Error in parse worker: {str(e)}")
+            finally:
+                in_flight.release()
+
+        # 取得スレッドが動いている最中にforkしないよう、ワーカーはspawnで起動する
+        context = multiprocessing.get_context('spawn')
+        try:
+            with ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=context) as executor:
+                while True:
+                    item = html_queue.get()
+                    if item is _DONE:
+                        break
+                    in_flight.acquire()  # 実行中のパースが上限に達していれば待つ
+                    race_id, html = item
+                    future = executor.submit(_parse_in_worker, race_id, html, self.scraper.parser, self.scraper.result_format)
+                    future.add_done_callback(_on_done)
+        finally:
+            parsed_queue.put(_DONE)
+
+    def run(self, race_ids, select_rows=None, fetch_html=None):
+        """
+        パイプラインを実行する
+        Args:
+            race_ids (list): 処理するレースID
+            select_rows (callable, optional): (race_id, race_data) → (race_infoのリスト, race_resultのリスト)
+                保存する行を選ぶ関数（省略時は両方とも保存）
+            fetch_html (callable, optional): race_id → HTML（省略時はスクレイパーの取得処理。キャッシュも使う）
+        Returns:
+            dict: ステージごとのカウンター
+        """
+        select_rows = select_rows or _all_rows
+        fetch_html = fetch_html or self.scraper._fetch_race_page
+        html_queue = queue.Queue(maxsize=self.queue_size)
+        parsed_queue = queue.Queue(maxsize=self.queue_size)
+
+        fetch_thread = threading.Thread(target=self._fetch_stage, args=(list(race_ids), html_queue, fetch_html), daemon=True)
+        parse_thread = threading.Thread(target=self._parse_stage, args=(html_queue, parsed_queue), daemon=True)
+        fetch_thread.start()
+        parse_thread.start()
+
+        race_infos, race_results, batched = [], [], 0
+        while True:
+            item = parsed_queue.get()
+            if item is not _DONE:
+                race_id, race_data = item
+                if race_data:
+                    infos, results = select_rows(race_id, race_data)
+                    race_infos.extend(infos)
+                    race_results.extend(results)
+                    batched += 1
+            if (item is _DONE or batched >= self.batch_size) and (race_infos or race_results):
+                start = time.perf_counter()
+                self.scraper.save_consolidated_csv(race_infos, race_results)
+                self.counters['write'].record(time.perf_counter() - start, count=batched)
+                race_infos, race_results, batched = [], [], 0
+            if item is _DONE:
+                break
+
+        fetch_thread.join()
+        parse_thread.join()
+        return self.stats()
+
+
+def _all_rows(race_id, race_data):
+    race_infos = []
+    if race_data['race_info']:
+        race_data['race_info']['race_id'] = race_id
+        race_infos.append(race_data['race_info'])
+    race_results = attach_race_id(race_data['race_results'], race_id) if race_data['race_results'] else []
+    return race_infos, race_results
@@ -0,0 +1,156 @@
+import json
+import os
+import re
+import threading
+from datetime import date, datetime, timedelta
+
+JRA_PLACE_CODES = ('01', '02', '03', '04', '05', '06', '07', '08', '09', '10')
+
+KAISAI_DATE_PATTERN = re.compile(r'kaisai_date=(\d{8})')
+RACE_ID_PATTERN = re.compile(r'/race/(\d{12})/')
+SCHEDULE_RACE_ID_PATTERN = re.compile(r'race_id=(\d{12})')
+POST_TIME_PATTERN = re.compile(r'(\d{1,2}):(\d{2})')
+
+
+class RaceCalendar:
+    """
+    netkeibaの開催カレンダーから実在するレースIDを特定する
+    - 月ごとのカレンダーページから開催日を取得
+    - 開催日ごとのレース一覧ページからレースIDを取得
+    - 終わった月・日の結果はJSONにキャッシュし、次回以降はリクエストしない
+    - 開催日のレース一覧（race.netkeiba.com）から各レースの発走時刻を取得する（当日の監視用）
+    """
+
+    CALENDAR_URL = 'https://race.netkeiba.com/top/calendar.html?year={year}&month={month}'
+    RACE_LIST_URL = 'https://db.netkeiba.com/race/list/{kaisai_date}/'
+    RACE_SCHEDULE_URL = 'https://race.netkeiba.com/top/race_list_sub.html?kaisai_date={kaisai_date}'
+
+    def __init__(self, fetcher, cache_path=None):
+        """
+        Args:
+            fetcher (ConcurrentFetcher): ページ取得に使うフェッチエンジン
+            cache_path (str, optional): キャッシュのJSONファイルのパス（省略時はメモリ上のみ）
+        """
+        self.fetcher = fetcher
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._cache = {'months': {}, 'dates': {}}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, encoding='utf-8') as f:
+                self._cache = json.load(f)
+
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        tmp_path = f'{self.cache_path}.tmp'
+        with self._lock:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._cache, f, ensure_ascii=False)
+        os.replace(tmp_path, self.cache_path)
+
+    def kaisai_dates(self, year, month):
+        """
+        指定月の開催日を取得する
+        Returns:
+            list: 'YYYYMMDD'形式の開催日（昇順）
+        """
+        key = f'{year:04d}{month:02d}'
+        if key in self._cache['months']:
+            return self._cache['months'][key]
+
+        response = self.fetcher.fetch(self.CALENDAR_URL.format(year=year, month=month))
+        response.raise_for_status()
+        dates = sorted(set(KAISAI_DATE_PATTERN.findall(response.text)))
+        dates = [d for d in dates if d[:6] == key]
+
+        # 月が終わっていれば開催日は確定しているのでキャッシュする
+        month_end = (date(year, month, 28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+        if month_end < date.today():
+            with self._lock:
+                self._cache['months'][key] = dates
+        return dates
+
+    def race_ids_for_date(self, kaisai_date):
+        """
+        指定日のJRAのレースIDを取得する
+        Args:
+            kaisai_date (str): 'YYYYMMDD'形式の開催日
+        Returns:
+            list: レースID（昇順）
+        """
+        if kaisai_date in self._cache['dates']:
+            return self._cache['dates'][kaisai_date]
+
+        response = self.fetcher.fetch(self.RACE_LIST_URL.format(kaisai_date=kaisai_date))
+        response.raise_for_status()
+        race_ids = sorted(set(
+            race_id for race_id in RACE_ID_PATTERN.findall(response.text)
+            if race_id[4:6] in JRA_PLACE_CODES
+        ))
+
+        # 過去の開催日の一覧は変わらないのでキャッシュする
+        if datetime.strptime(kaisai_date, '%Y%m%d').date() < date.today():
+            with self._lock:
+                self._cache['dates'][kaisai_date] = race_ids
+        return race_ids
+
+    def post_times(self, kaisai_date):
+        """
+        指定日のJRAのレースの発走時刻を取得する（当日の発走時刻は変わることがあるのでキャッシュしない）
+        Args:
+            kaisai_date (str): 'YYYYMMDD'形式の開催日
+        Returns:
+            dict: レースID → 発走時刻（'HH:MM'）（レースID順）
+        """
+        response = self.fetcher.fetch(self.RACE_SCHEDULE_URL.format(kaisai_date=kaisai_date))
+        response.raise_for_status()
+        post_times = {}
+        # レースごとの項目（RaceList_DataItem）にレースIDと発走時刻が1つずつある
+        for item in response.text.split('RaceList_DataItem')[1:]:
+            race_id = SCHEDULE_RACE_ID_PATTERN.search(item)
+            post_time = POST_TIME_PATTERN.search(item)
+            if race_id and post_time and race_id.group(1)[4:6] in JRA_PLACE_CODES:
+                hour, minute = post_time.groups()
+                post_times.setdefault(race_id.group(1), f'{int(hour):02d}:{minute}')
+        return dict(sorted(post_times.items()))
+
+    def discover_race_ids(self, start_date, end_date):
+        """
+        期間内に実在するレースIDをすべて取得する
+        Args:
+            start_date (date): 開始日（この日を含む）
+            end_date (date): 終了日（この日を含む）
+        Returns:
+            dict: 開催日（'YYYYMMDD'）→ レースIDのリスト
+        """
+        kaisai_dates = []
+        year, month = start_date.year, start_date.month
+        while (year, month) <= (end_date.year, end_date.month):
+            kaisai_dates.extend(
+                d for d in self.kaisai_dates(year, month)
+                if start_date.strftime('%Y%m%d') <= d <= end_date.strftime('%Y%m%d')
+            )
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+        race_ids = dict(zip(kaisai_dates, self.fetcher.map(self.race_ids_for_date, kaisai_dates)))
+        self._save_cache()
+        return race_ids
+
+    def meeting_days(self, year):
+        """
+        指定年の開催日ごとのレースIDを、競馬場コード・開催回・日目でまとめて返す
+        Returns:
+            dict: 競馬場コード → {base_race_id（YYYYPPKKDD）: [レースID, ...]}（いずれも昇順）
+        """
+        end_date = min(date(year, 12, 31), date.today())
+        meetings = {}
+        for race_ids in self.discover_race_ids(date(year, 1, 1), end_date).values():
+            for race_id in race_ids:
+                if race_id[:4] != str(year):
+                    continue
+                meetings.setdefault(race_id[4:6], {}).setdefault(race_id[:10], []).append(race_id)
+        return {
+            place: {base: sorted(set(ids)) for base, ids in sorted(days.items())}
+            for place, days in sorted(meetings.items())
+        }
@@ -0,0 +1,130 @@
+import io
+import posixpath
+
+import numpy as np
+
+from scraping.partitioned_store import unread_parts
+from scraping.storage_backends import RACE_INFO_BUCKET
+
+TABLES = ('race_info', 'race_result')
+
+
+class RaceIdIndex:
+    """
+    保存済みレースIDのインデックス
+    - race_info / race_result ごとにソート済みの文字列の配列で保持し、1つの小さなnpzとして保存
+      （海外のレースIDは英字を含む（2024C8100204など）ので整数にしない）
+    - 実行中に保存したレースIDはメモリ上で追加し、persist()でまとめて書き戻す
+    - 取り込んだパートファイル名を記録しておき、記録に無いパートだけを読み足す
+      （名前の大小で判定しないので、同時に実行された保存・シャードの書いたパートも読み落とさない）
+    """
+
+    INDEX_NAME = '_index/race_ids.npz'
+
+    def __init__(self, storage, stores, bucket=RACE_INFO_BUCKET, name=INDEX_NAME):
+        """
+        Args:
+            storage (StorageBackend): インデックスの保存先
+            stores (dict): テーブル名 → PartitionedStore
+            bucket (str): インデックスを置くバケット
+            name (str): インデックスのオブジェクト名
+        """
+        self.storage = storage
+        self.stores = stores
+        self.bucket = bucket
+        self.name = name
+        self._ids = {table: np.array([], dtype=str) for table in TABLES}
+        self._absorbed = {table: set() for table in TABLES}
+        self._pending = {table: set() for table in TABLES}
+        self._dirty = False
+
+    @classmethod
+    def load(cls, storage, stores, bucket=RACE_INFO_BUCKET, name=INDEX_NAME):
+        """保存済みのインデックスを読み込み、その後に追加されたパートを反映して返す"""
+        index = cls(storage, stores, bucket, name)
+        try:
+            with np.load(io.BytesIO(storage.read_bytes(bucket, name)), allow_pickle=False) as data:
+                for table in TABLES:
+                    # 以前のint64のインデックスもそのまま文字列にして読める
+                    index._ids[table] = data[table].astype(str)
+                    if f'{table}_parts' in data:
+                        index._absorbed[table] = set(data[f'{table}_parts'].tolist())
+                    else:
+                        # 以前の形式（最後に取り込んだパート名）は、それ以前のパートを取り込み済みとして読む
+                        last_part = str(data[f'{table}_last_part'])
+                        names = stores[table].list_parts() if table in stores else []
+                        index._absorbed[table] = {posixpath.basename(name) for name in names
+                                                  if posixpath.basename(name) <= last_part}
+        except FileNotFoundError:
+            pass
+        index.refresh()
+        return index
+
+    def refresh(self):
+        """
+        インデックスに未反映のパートファイルからレースIDを読み足す
+        （コンパクションでまとめたパートも読む。レースIDの集合なので読み直しても変わらない）
+        """
+        for table, store in self.stores.items():
+            names = store.list_parts()
+            parts = unread_parts(names, self._absorbed[table])
+            if parts:
+                ids = set()
+                for name in parts:
+                    ids.update(store.read_part(name, ['race_id'])['race_id'].astype(str))
+                self.add(table, ids, parts)
+            # コンパクションで消えたパートは記録から外す
+            listed = {posixpath.basename(name) for name in names}
+            if self._absorbed[table] - listed:
+                self._absorbed[table] &= listed
+                self._dirty = True
+
+    def _merged(self, table):
+        if self._pending[table]:
+            new_ids = np.array(sorted(self._pending[table]), dtype=str)
+            self._ids[table] = np.union1d(self._ids[table], new_ids)
+            self._pending[table] = set()
+        return self._ids[table]
+
+    def add(self, table, race_ids, parts=()):
+        """
+        保存したレースIDをメモリ上のインデックスに追加する
+        Args:
+            table (str): 'race_info' または 'race_result'
+            race_ids (iterable): 追加するレースID
+            parts (iterable): レースIDを書き込んだパートファイル名（次回のrefreshで読み直さないように記録）
+        """
+        self._pending[table].update(str(race_id) for race_id in race_ids)
+        self._absorbed[table].update(posixpath.basename(name) for name in parts)
+        self._dirty = True
+
+    def ids(self, table, year=None):
+        """
+        保存済みのレースIDを取得する
+        Args:
+            table (str): 'race_info' または 'race_result'
+            year (int, optional): 指定された年のレースIDのみを取得
+        Returns:
+            set: レースID（文字列）
+        """
+        ids = self._merged(table)
+        if year is not None:
+            # レースIDは年から始まるので、文字列の順で年の範囲を切り出せる
+            lo, hi = np.searchsorted(ids, [str(int(year)), str(int(year) + 1)])
+            ids = ids[lo:hi]
+        return set(ids.tolist())
+
+    def common_ids(self):
+        """race_infoとrace_resultの両方に存在するレースID（ソート済みの文字列の配列）"""
+        return np.intersect1d(self._merged('race_info'), self._merged('race_result'), assume_unique=True)
+
+    def persist(self):
+        """変更があればインデックスを書き戻す"""
+        if not self._dirty:
+            return
+        arrays = {table: self._merged(table) for table in TABLES}
+        arrays.update({f'{table}_parts': np.array(sorted(self._absorbed[table]), dtype=str) for table in TABLES})
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        self.storage.write_bytes(self.bucket, self.name, buffer.getvalue(), content_type='application/octet-stream')
+        self._dirty = False
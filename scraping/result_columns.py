@@ -0,0 +1,248 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from scraping.schema import ENTITY_ID_COLUMNS, RACE_RESULT_COLUMNS
+
+# nk_race_result_schema.json の型に合わせた列の型（ここに無い文字列の列はcategory）
+INT8_COLUMNS = ('枠番', '馬番', '齢', '通過_1F', '通過_2F', '通過_3F', '通過_4F', '人気')
+FLOAT32_COLUMNS = ('斤量', '上り')
+# 馬名・馬主など値の種類が多い列はcategoryにしても小さくならない
+OBJECT_COLUMNS = ('race_id', '馬名', 'horse_id')
+# 馬・騎手・調教師のページへのリンク（/horse/2021105000/、/jockey/result/recent/01000/、/trainer/01100/ など）
+ENTITY_LINK_PATTERN = re.compile(r'^/(horse|jockey|trainer)/(?:result/recent/)?([0-9A-Za-z]+)/?$')
+
+
+class RawResultColumns(dict):
+    """
+    1レース分の結果表を、見出し → セルの生の文字列のリスト として持つ
+    （行ごとの辞書を作らず、normalize_result_columnsでまとめて型変換する）
+    """
+
+    def __init__(self, columns=None, n_rows=0):
+        super().__init__(columns or {})
+        self.n_rows = n_rows
+
+
+def entity_ids(hrefs):
+    """
+    行の中のリンク先から馬・騎手・調教師のIDを取り出す
+    Args:
+        hrefs (iterable): 行の中のaタグのhref
+    Returns:
+        dict: 'horse_id' / 'jockey_id' / 'trainer_id' → ID（リンクの無いものは含まない）
+    """
+    ids = {}
+    for href in hrefs:
+        match = ENTITY_LINK_PATTERN.match(href)
+        if match:
+            ids.setdefault(f'{match.group(1)}_id', match.group(2))
+    return ids
+
+
+def raw_result_columns(headers, rows, row_entity_ids=None):
+    """
+    結果表の見出しとセルのテキストを列ごとのリストにする
+    Args:
+        headers (list): 見出しセルのテキスト（前後の空白は除去済み）
+        rows (list): tdを持つ行ごとのセルのテキストのリスト（前後の空白は除去済み）
+        row_entity_ids (list, optional): 行ごとの馬・騎手・調教師のID（entity_idsの戻り値）
+    Returns:
+        RawResultColumns: 見出し → セルのテキストのリスト（セルが無い行はNone）
+    """
+    if not headers or not rows:
+        return RawResultColumns()
+    columns = {
+        header: [cells[i] if i < len(cells) else None for cells in rows]
+        for i, header in enumerate(headers)
+    }
+    for column in ENTITY_ID_COLUMNS:
+        if row_entity_ids and any(column in ids for ids in row_entity_ids):
+            columns[column] = [ids.get(column) for ids in row_entity_ids]
+    return RawResultColumns(columns, len(rows))
+
+
+def attach_race_id(race_results, race_id):
+    """
+    レース結果にrace_idを付け、保存用のリストに追加できる形で返す
+    （行の辞書のリストはそのまま、列形式は1レース分を1要素とするリスト）
+    """
+    if isinstance(race_results, RawResultColumns):
+        race_results['race_id'] = [race_id] * race_results.n_rows
+        return [race_results]
+    for result in race_results:
+        result['race_id'] = race_id
+    return race_results
+
+
+def _concat(batch):
+    """複数レースの列を1つにつなげる（そのレースに無い見出しはNoneで埋める）"""
+    headers = list(dict.fromkeys(header for columns in batch for header in columns))
+    concatenated = {}
+    for header in headers:
+        values = []
+        for columns in batch:
+            values.extend(columns.get(header) or [None] * columns.n_rows)
+        concatenated[header] = pd.Series(values, dtype=object)
+    return concatenated
+
+
+def _to_number(values, default=None):
+    """数値に変換する（変換できない値はdefault、セルが無い行は欠損のまま）"""
+    numbers = pd.to_numeric(values, errors='coerce')
+    if default is not None:
+        numbers = numbers.fillna(default).where(values.notna())
+    return numbers
+
+
+def _mask(flags):
+    """欠損を含む真偽値の列をboolの列にする"""
+    return flags.eq(True)
+
+
+def _to_int(values, default=None):
+    # int()と同じく、小数点付きの値は整数として扱わない
+    integers = pd.to_numeric(values.where(values.str.fullmatch(r'[+-]?\d+', na=False)), errors='coerce')
+    if default is not None:
+        integers = integers.fillna(default)
+    return integers.where(values.notna())
+
+
+def _time_to_seconds(values):
+    """タイム（"1:34.5"）を秒数に変換する（NetkeibaRaceScraper._convert_time_to_secondsと同じ結果）"""
+    has_minutes = values.str.count(':') == 1
+    parts = values.str.partition(':')
+    with_minutes = pd.to_numeric(parts[0], errors='coerce') * 60 + pd.to_numeric(parts[2], errors='coerce')
+    seconds = pd.to_numeric(values.where(~has_minutes), errors='coerce')
+    seconds = seconds.where(~has_minutes, with_minutes)
+    return seconds.fillna(0.0).where(values.notna())
+
+
+def _split_passing(values, out):
+    positions = values.fillna('').str.split('-', expand=True).reindex(columns=range(4))
+    for j in range(4):
+        out[f'通過_{j+1}F'] = _to_int(positions[j].where(values.notna()))
+
+
+def _split_sex_age(values, out):
+    has_value = values.fillna('') != ''
+    out['性'] = values.str[0].where(has_value)
+    out['齢'] = _to_int(values.str[1:].where(has_value))
+
+
+def _split_horse_weight(values, out):
+    has_weight = values.str.contains('(', regex=False) & values.str.contains(')', regex=False)
+    has_weight = _mask(has_weight)
+    parts = values.where(has_weight).str.replace(')', '', regex=False).str.split('(', expand=True)
+    parts = parts.reindex(columns=range(2))
+    weight = parts[0].where(_mask(parts[0].str.isdigit()))
+    change_is_digit = parts[1].str.replace('+', '', regex=False).str.replace('-', '', regex=False).str.isdigit()
+    change = parts[1].where(_mask(change_is_digit))
+    out['馬体重'] = _to_number(weight).fillna(0).where(has_weight)
+    out['増減'] = _to_number(change).fillna(0).where(has_weight)
+
+
+def _split_trainer(values, out):
+    values = values.str.replace('\n', '', regex=False)
+    extracted = values.str.extract(r'^\[(東|西|地|外)\](.*)')
+    matched = extracted[0].notna()
+    out['所属'] = extracted[0].where(matched, '').where(values.notna())
+    out['調教師'] = extracted[1].str.strip().where(matched, values.fillna('')).where(values.notna())
+
+
+def _typed(df):
+    """列をスキーマの型（int8/int16/float32/category）にする"""
+    for column in df.columns:
+        if column in INT8_COLUMNS or column == '着順':
+            df[column] = df[column].astype('Int8')
+        elif column in ('馬体重', '増減'):
+            df[column] = df[column].astype('Int16')
+        elif column in FLOAT32_COLUMNS or column in ('タイム', '単勝', 'オッズ'):
+            df[column] = df[column].astype(np.float32)
+        elif column == '賞金':
+            df[column] = df[column].astype(np.float64)
+        elif column not in OBJECT_COLUMNS and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    return df
+
+
+def _convert_rank(values, out):
+    out['着順'] = _to_int(values, -1)
+
+
+def _convert_odds(header):
+    def convert(values, out):
+        out[header] = _to_number(values.str.replace('---', '-1', regex=False), -1.0)
+    return convert
+
+
+def _convert_time(values, out):
+    out['タイム'] = _time_to_seconds(values)
+
+
+def _convert_prize(values, out):
+    prize = values.str.replace(',', '', regex=False)
+    out['賞金'] = (_to_number(prize, 0.0) * 10000).where(prize.fillna('') != '', 0.0).where(values.notna())
+
+
+# 見出しごとの変換（_build_race_resultsの分岐と同じ）
+CONVERTERS = {
+    '着順': _convert_rank,
+    '単勝': _convert_odds('単勝'),
+    'オッズ': _convert_odds('オッズ'),
+    'タイム': _convert_time,
+    '通過': _split_passing,
+    '性齢': _split_sex_age,
+    '馬体重': _split_horse_weight,
+    '調教師': _split_trainer,
+    '賞金(万円)': _convert_prize,
+}
+
+
+def _convert_column(header, values, out):
+    """
+    1列を変換してoutに入れる
+    同じ値が何度も現れる列なので、factorizeで得た重複のない値だけを変換し、コードで全行に展開する
+    """
+    codes, uniques = pd.factorize(values)
+    if header not in CONVERTERS and header not in INT8_COLUMNS and header not in FLOAT32_COLUMNS:
+        if header in OBJECT_COLUMNS:
+            out[header] = values
+        else:
+            out[header] = pd.Categorical.from_codes(codes, pd.Index(uniques, dtype=object))
+        return
+
+    # 最後にセルが無い行（コード-1）用のNoneを足しておく
+    codes = np.where(codes < 0, len(uniques), codes)
+    uniques = pd.Series(list(uniques) + [None], dtype=object)
+    converted = {}
+    if header in CONVERTERS:
+        CONVERTERS[header](uniques, converted)
+    elif header in INT8_COLUMNS:
+        converted[header] = _to_int(uniques)
+    else:
+        converted[header] = _to_number(uniques)
+    for name, column in converted.items():
+        out[name] = column.to_numpy()[codes]
+
+
+def normalize_result_columns(batch):
+    """
+    複数レースの列形式の結果をまとめて型変換する（NetkeibaRaceScraper._build_race_resultsと同じ値）
+    Args:
+        batch (list): RawResultColumnsのリスト（attach_race_idでrace_idを付けたもの）
+    Returns:
+        DataFrame: RACE_RESULT_COLUMNSの並びで、nk_race_result_schema.jsonの型に合わせたレース結果
+            （その他の見出しの列は後ろに付ける）
+    """
+    out = {}
+    for header, values in _concat(batch).items():
+        _convert_column(header, values, out)
+
+    n_rows = sum(columns.n_rows for columns in batch)
+    df = pd.DataFrame(out, index=pd.RangeIndex(n_rows))
+    # スキーマの列はすべて出力する（BigQueryには列の位置で読み込むため）
+    columns = RACE_RESULT_COLUMNS + [c for c in df.columns if c not in RACE_RESULT_COLUMNS]
+    df = df.reindex(columns=columns)
+    return _typed(df)
@@ -0,0 +1,74 @@
+# スクレイパーが出力するテーブルの列順
+# （nk_race_result_schema.json の race_id 〜 prize と同じ並び）
+
+RACE_INFO_COLUMNS = [
+    'race_id',
+    'race_name',
+    'race_date',
+    'kaisai_kai',
+    'kaisai_place',
+    'kaisai_nichime',
+    'race_conditions',
+    'track_type',
+    'track_direction',
+    'track_distance',
+    'weather',
+    'track_condition',
+    'start_time',
+    'timestamp',
+]
+
+RACE_RESULT_COLUMNS = [
+    'race_id',
+    '着順',
+    '枠番',
+    '馬番',
+    '馬名',
+    '性',
+    '齢',
+    '斤量',
+    '騎手',
+    'タイム',
+    '着差',
+    'ﾀｲﾑ指数',
+    '通過_1F',
+    '通過_2F',
+    '通過_3F',
+    '通過_4F',
+    '上り',
+    '単勝',
+    '人気',
+    '馬体重',
+    '増減',
+    '調教ﾀｲﾑ',
+    '厩舎ｺﾒﾝﾄ',
+    '備考',
+    '所属',
+    '調教師',
+    '馬主',
+    '賞金',
+]
+
+# 結果表の馬名・騎手・調教師のリンクから取る馬・騎手・調教師のID
+# （nk_race_result_schema.json の最後の3列。馬のプロフィール（horse_profile）とは horse_id で結合する）
+ENTITY_ID_COLUMNS = ['horse_id', 'jockey_id', 'trainer_id']
+# レース結果のストアに書き出す列（IDも行の内容として比べるので、IDの無い以前の行は取得し直すと更新される）
+RACE_RESULT_STORE_COLUMNS = RACE_RESULT_COLUMNS + ENTITY_ID_COLUMNS
+
+# 同じキーの行は新しいものが古いものを上書きする
+RACE_INFO_KEY = ['race_id']
+RACE_RESULT_KEY = ['race_id', '馬番']
+
+# 競馬場コード（race_idの5〜6桁目、JRDBの場コードも同じ）→ 競馬場名
+VENUE_NAMES = {
+    '01': '札幌',
+    '02': '函館',
+    '03': '福島',
+    '04': '新潟',
+    '05': '東京',
+    '06': '中山',
+    '07': '中京',
+    '08': '京都',
+    '09': '阪神',
+    '10': '小倉',
+}
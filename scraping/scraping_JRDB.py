@@ -1,48 +1,263 @@
-import requests
+import argparse
+import io
+import json
+import os
+import re
+import threading
+import zipfile
+from datetime import datetime
+from urllib.parse import urljoin
+
 from requests.exceptions import RequestException
 import configparser
 import logging
 
+from scraping.fetcher import ConcurrentFetcher
+from scraping.http_session import create_session
+from scraping.jrdb_records import publish_sed
+from scraping.parquet_dataset import JRDB_RACE_RESULT_DATASET, ParquetDataset
+from scraping.storage_backends import RACE_RESULT_BUCKET, create_storage
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+LOGIN_URL = "http://www.jrdb.com/member/n_index.html"
+# 種類ごとのアーカイブ一覧のページ（{kind}は 'Sed' / 'Kyi' / 'Bac'）
+INDEX_URL = "http://www.jrdb.com/member/datazip/{kind}/index.html"
+# 日次のアーカイブ（SED240526.zipなど）。これ以外（年単位のまとめなど）は内容が更新されうる
+DAILY_ARCHIVE_PATTERN = re.compile(r'^[A-Z]{3}\d{6}\.zip$', re.IGNORECASE)
+ARCHIVE_LINK_PATTERN = re.compile(r'href="([^"]+\.(?:zip|lzh))"', re.IGNORECASE)
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'ja,en-US;q=0.7,en;q=0.3',
+}
+
 def load_config():
     config = configparser.ConfigParser()
     config.read('config.ini')
     return config
 
-def login_and_check(config):
-    jrdb_username = config['login']['jrdb_username'].strip()
-    jrdb_password = config['login']['jrdb_password'].strip()
-    login_url = "http://www.jrdb.com/member/n_index.html"
-    
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'ja,en-US;q=0.7,en;q=0.3',
-    }
-    
+def create_jrdb_session(config, pool_size=10):
+    """認証情報を設定した接続プール付きのセッションを作成する"""
+    session = create_session(headers=HEADERS, pool_size=pool_size)
+    session.auth = (config['login']['jrdb_username'].strip(), config['login']['jrdb_password'].strip())
+    return session
+
+def login_and_check(config, session=None, timeout=(5, 30)):
+    session = session or create_jrdb_session(config)
     try:
-        with requests.Session() as session:
-            session.auth = (jrdb_username, jrdb_password)
-            response = session.get(login_url, headers=headers)
-            response.raise_for_status()
-            response.encoding = 'utf-8'
-            
-            if "過去重賞レース結果" in response.text:
-                logger.info("ログインに成功しました。")
-                return True
-            else:
-                logger.error("ログインに失敗しました。ユーザー名とパスワードを確認してください。")
-                return False
+        response = session.get(LOGIN_URL, timeout=timeout)
+        response.raise_for_status()
+        response.encoding = 'utf-8'
+
+        if "過去重賞レース結果" in response.text:
+            logger.info("ログインに成功しました。")
+            return True
+        else:
+            logger.error("ログインに失敗しました。ユーザー名とパスワードを確認してください。")
+            return False
     except RequestException as e:
         logger.error(f"ログイン処理中にエラーが発生しました: {e}")
         return False
 
+
+class JRDBSync:
+    """
+    JRDBの会員向けアーカイブを固定長ファイルの置き場に同期する
+    - 認証済みの1つのセッション（接続プール付き）を全リクエストで使い回す
+    - アーカイブ一覧から、未取得または更新されたアーカイブだけを並列に（同時実行数を制限して）ダウンロード
+    - zipはメモリ上で展開し、中の固定長ファイルを {store_dir}/{種類}/ に直接書き出す
+    - 取得済みのアーカイブはマニフェストに記録し、再実行時は一覧の取得だけで済むようにする
+    - datasetを渡すと、展開したSEDをParquetデータセットにも書き出す
+    """
+
+    MANIFEST_NAME = 'manifest.json'
+
+    def __init__(self, session, store_dir='Datas/jrdb', max_concurrency=4, requests_per_second=2.0,
+                 index_url=INDEX_URL, dataset=None):
+        """
+        Args:
+            session (requests.Session): 認証済みのセッション（create_jrdb_sessionで作成）
+            store_dir (str): 固定長ファイルの置き場
+            max_concurrency (int): 同時にダウンロードするアーカイブ数の上限
+            requests_per_second (float): JRDBへの1秒あたりリクエスト数
+            index_url (str): アーカイブ一覧のURLのテンプレート
+            dataset (ParquetDataset, optional): 展開したSEDの書き出し先
+        """
+        self.fetcher = ConcurrentFetcher(session=session, requests_per_second=requests_per_second,
+                                         burst=max_concurrency, max_concurrency=max_concurrency)
+        self.store_dir = store_dir
+        self.index_url = index_url
+        self.dataset = dataset
+        self.manifest_path = os.path.join(store_dir, self.MANIFEST_NAME)
+        self.manifest = self._load_manifest()
+        self._lock = threading.Lock()
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_manifest(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        tmp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+        with self._lock:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def list_archives(self, kind):
+        """
+        アーカイブ一覧のページからアーカイブのURLを取得する
+        Args:
+            kind (str): 'SED' / 'KYI' / 'BAC'
+        Returns:
+            list: アーカイブのURL（lzh形式は展開できないので除く）
+        """
+        index_url = self.index_url.format(kind=kind.capitalize())
+        response = self.fetcher.fetch(index_url)
+        response.raise_for_status()
+        urls = []
+        for href in dict.fromkeys(ARCHIVE_LINK_PATTERN.findall(response.text)):
+            name = os.path.basename(href)
+            if not name.upper().startswith(kind.upper()):
+                continue
+            if name.lower().endswith('.lzh'):
+                logger.warning(f"lzh形式のアーカイブは展開できないためスキップします: {name}")
+                continue
+            urls.append(urljoin(index_url, href))
+        return urls
+
+    def _needs_download(self, kind, url, revalidate):
+        """
+        取得が必要か判定する
+        Returns:
+            dict or None: 取得する場合は条件付きGETのヘッダー（無条件なら空の辞書）、不要ならNone
+        """
+        entry = self.manifest.get(url)
+        if entry is None:
+            return {}
+        if not all(os.path.exists(os.path.join(self.store_dir, kind, name)) for name in entry['files']):
+            return {}
+        # 日次のアーカイブは公開後に変わらないので再検証しない
+        if DAILY_ARCHIVE_PATTERN.match(os.path.basename(url)) and not revalidate:
+            return None
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def _extract(self, kind, content):
+        """zipの中の固定長ファイルを置き場に書き出す（一時ファイルに書いてから置き換える）"""
+        kind_dir = os.path.join(self.store_dir, kind)
+        os.makedirs(kind_dir, exist_ok=True)
+        names = []
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                name = os.path.basename(info.filename)
+                path = os.path.join(kind_dir, name)
+                tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with archive.open(info) as src, open(tmp_path, 'wb') as dst:
+                    dst.write(src.read())
+                os.replace(tmp_path, path)
+                names.append(name)
+        return names
+
+    def _download(self, kind, url, headers):
+        """
+        アーカイブを取得して展開する
+        Returns:
+            str: 'downloaded' / 'not_modified' / 'failed'
+        """
+        try:
+            response = self.fetcher.fetch(url, headers=headers)
+            if response.status_code == 304:
+                return 'not_modified'
+            response.raise_for_status()
+            files = self._extract(kind, response.content)
+            if self.dataset is not None and kind == 'SED':
+                # 書き出しに失敗したアーカイブはマニフェストに載せず、次回取得し直す
+                publish_sed([os.path.join(self.store_dir, kind, name) for name in files], self.dataset)
+        except (RequestException, zipfile.BadZipFile, OSError, ValueError) as e:
+            logger.error(f"{url} の取得に失敗しました: {e}")
+            return 'failed'
+        with self._lock:
+            self.manifest[url] = {
+                'files': files,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'size': len(response.content),
+                'fetched_at': datetime.now().isoformat(timespec='seconds'),
+            }
+        return 'downloaded'
+
+    def sync(self, kinds=('SED', 'KYI', 'BAC'), revalidate=False):
+        """
+        アーカイブを同期する
+        Args:
+            kinds (iterable): 同期するファイルの種類
+            revalidate (bool): 取得済みの日次アーカイブも条件付きGETで確認する
+        Returns:
+            dict: 結果ごとのアーカイブ数
+        """
+        counts = {'downloaded': 0, 'not_modified': 0, 'skipped': 0, 'failed': 0}
+        try:
+            for kind in kinds:
+                kind = kind.upper()
+                tasks = []
+                skipped = 0
+                for url in self.list_archives(kind):
+                    headers = self._needs_download(kind, url, revalidate)
+                    if headers is None:
+                        skipped += 1
+                    else:
+                        tasks.append((url, headers))
+                counts['skipped'] += skipped
+                logger.info(f"{kind}: {len(tasks)}件のアーカイブを確認・取得します（取得済み{skipped}件）")
+                for status in self.fetcher.map(lambda task, kind=kind: self._download(kind, *task), tasks):
+                    counts[status] += 1
+        finally:
+            self._save_manifest()
+        logger.info(f"同期が完了しました: {counts}")
+        return counts
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='JRDBのログイン確認とデータの同期')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('check', help='ログインの動作確認（既定）')
+    sync_parser = subparsers.add_parser('sync', help='アーカイブをダウンロードして固定長ファイルの置き場に展開する')
+    sync_parser.add_argument('--kinds', nargs='+', default=['SED', 'KYI', 'BAC'])
+    sync_parser.add_argument('--store', default='Datas/jrdb')
+    sync_parser.add_argument('--max-concurrency', type=int, default=4)
+    sync_parser.add_argument('--revalidate', action='store_true', help='取得済みの日次アーカイブも再確認する')
+    sync_parser.add_argument('--publish', action='store_true',
+                             help='SEDをParquetデータセットにも書き出す（ストレージは環境変数 KEIBA_STORAGE_BACKEND に従う）')
+    args = parser.parse_args()
+
     config = load_config()
-    login_success = login_and_check(config)
-    if login_success:
-        logger.info("ログインの動作確認が完了しました。")
+    if args.command == 'sync':
+        session = create_jrdb_session(config, pool_size=args.max_concurrency)
+        dataset = None
+        if args.publish:
+            dataset = ParquetDataset(create_storage(), RACE_RESULT_BUCKET, JRDB_RACE_RESULT_DATASET)
+        if login_and_check(config, session):
+            counts = JRDBSync(session, args.store, args.max_concurrency, dataset=dataset).sync(args.kinds, args.revalidate)
+            if counts['failed']:
+                raise SystemExit(1)
+        else:
+            raise SystemExit(1)
     else:
-        logger.error("ログインの動作確認に失敗しました。設定を確認してください。")
\ No newline at end of file
+        login_success = login_and_check(config)
+        if login_success:
+            logger.info("ログインの動作確認が完了しました。")
+        else:
+            logger.error("ログインの動作確認に失敗しました。設定を確認してください。")
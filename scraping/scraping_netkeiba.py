@@ -1,22 +1,169 @@
+import time
+
+# コールドスタートの計測用（このモジュールの読み込みを始めた時刻）
+_LOAD_STARTED = time.perf_counter()
+
 import functions_framework
-from google.cloud import storage
-import pandas as pd
-from bs4 import BeautifulSoup
 import requests
 from datetime import datetime, timezone, timedelta
 import os
 import re
-import time
-import tempfile
+import threading
+
+# pandas・BeautifulSoup・lxml・pyarrowを使うモジュールは、使う関数の中で読み込む
+# （Cloud Functionsのコールドスタートで、最初のリクエストを送るまでに読み込まないように）
+from scraping.crawl_state import FAILED, FETCHED, MISSING, PARSED, PENDING, SAVED, CrawlState
+from scraping.fetcher import ConcurrentFetcher
+from scraping.http_session import create_session
+from scraping.metrics import MetricsRegistry, log_event
+from scraping.page_cache import HtmlPageCache
+from scraping.race_calendar import RaceCalendar
+from scraping.schema import ENTITY_ID_COLUMNS, RACE_INFO_COLUMNS, RACE_INFO_KEY, RACE_RESULT_KEY, RACE_RESULT_STORE_COLUMNS
+from scraping.storage_backends import RACE_INFO_BUCKET, RACE_RESULT_BUCKET, StorageBackend, create_storage
+
+# 保存・パースで使う重いモジュール（コールドスタート時に別スレッドで先に読み込んでおく）
+HEAVY_MODULES = ('pandas', 'bs4', 'scraping.fast_parser', 'scraping.partitioned_store',
+                 'scraping.result_columns', 'scraping.race_index', 'scraping.parquet_dataset')
+
+IMPORT_SECONDS = time.perf_counter() - _LOAD_STARTED
 
 class NetkeibaRaceScraper:
-    def __init__(self):
+    RACE_URL = 'https://db.netkeiba.com/race/{race_id}'
+
+    def __init__(self, requests_per_second=1.0, burst=2, max_concurrency=4, max_retries=3,
+                 pool_size=10, connect_retries=3, connect_timeout=5.0, read_timeout=30.0,
+                 cache_dir=None, cache_max_bytes=2 * 1024 ** 3, cache_final_after_days=7,
+                 use_calendar=True, calendar_cache_path=None, storage=None, parser='bs4',
+                 parse_workers=0, result_format='rows', publish_parquet=True, track_history=False,
+                 crawl_state_path=None, fetch_profiles=False, profile_ttl_days=30):
+        """
+        Args:
+            requests_per_second (float): ホストごとの1秒あたりリクエスト数
+            burst (int): ホストごとのバースト数
+            max_concurrency (int): 同時に実行するリクエスト数の上限
+            max_retries (int): 429/5xx時のリトライ回数
+            pool_size (int): セッションが保持するコネクション数
+            connect_retries (int): 接続エラー・読み取りエラー時のリトライ回数
+            connect_timeout (float): 接続タイムアウト（秒）
+            read_timeout (float): 読み取りタイムアウト（秒）
+            cache_dir (str, optional): 生HTMLキャッシュのディレクトリ（省略時はキャッシュしない）
+            cache_max_bytes (int): キャッシュの合計サイズの上限
+            cache_final_after_days (int): レース日から何日経ったページを再検証なしで使うか
+            use_calendar (bool): 開催カレンダーからレースIDを特定するか（Falseなら総当たりで探索）
+            calendar_cache_path (str, optional): 開催カレンダーのキャッシュファイル
+            storage (StorageBackend or str, optional): 保存先のストレージ、または 'gcs' / 'local' / 'memory'
+                （省略時は環境変数 KEIBA_STORAGE_BACKEND に従う）
+            parser (str): HTMLパーサー。'bs4'（BeautifulSoup）または 'lxml'（高速版、同じ結果を返す）
+            parse_workers (int): 1以上なら取得とパースを分けたパイプラインで処理し、このプロセス数でパースする
+            result_format (str): レース結果の形式。'rows'（行ごとの辞書）または 'columns'
+                （生の文字列を列ごとに集め、保存時にまとめて型変換する）
+            publish_parquet (bool): 保存時にnk_race_result_schema.jsonのスキーマのParquetデータセットにも書き出すか
+            track_history (bool): 保存時に馬・騎手・調教師ごとの過去成績のインデックスも更新するか
+            crawl_state_path (str, optional): レースごとの処理状況を記録するローカルのSQLiteファイル
+                （省略時は一時ディレクトリ。内容は保存のたびにストレージへ書き戻す）
+            fetch_profiles (bool): 保存したレース結果に出てきた馬のプロフィール・血統も取得するか
+                （クロールの最後に重複を除いてまとめて取得し、horse_profileテーブルに保存する）
+            profile_ttl_days (float): 取得したプロフィールを取得し直さずに使う日数
+        """
+        if parser not in ('bs4', 'lxml'):
+            raise ValueError(f"Unknown parser: {parser}")
+        if result_format not in ('rows', 'columns'):
+            raise ValueError(f"Unknown result format: {result_format}")
+        self.parser = parser
+        self.result_format = result_format
+        self.parse_workers = parse_workers
+        # リクエスト・パース・保存の計測値（構造化ログ・Prometheus形式で出力する）
+        self.metrics = MetricsRegistry()
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
             'Cookie': 'uid=0; nkauth=0'
         }
-        # GCSクライアントの初期化
-        self.storage_client = storage.Client()
+        # keep-alive・圧縮転送に対応した永続セッション（全リクエストで使い回す）
+        self.session = create_session(
+            headers=self.headers,
+            pool_size=max(pool_size, max_concurrency),
+            max_retries=connect_retries
+        )
+        # フェッチエンジンの初期化（固定sleepの代わりにホスト単位のレート制限で待機する）
+        self.fetcher = ConcurrentFetcher(
+            session=self.session,
+            timeout=(connect_timeout, read_timeout),
+            requests_per_second=requests_per_second,
+            burst=burst,
+            max_concurrency=max_concurrency,
+            max_retries=max_retries,
+            metrics=self.metrics
+        )
+        # 生HTMLキャッシュ（パーサー修正後の再パースをネットワークなしで行うため）
+        self.page_cache = None
+        if cache_dir:
+            self.page_cache = HtmlPageCache(cache_dir, max_bytes=cache_max_bytes,
+                                            final_after_days=cache_final_after_days, metrics=self.metrics)
+        # 開催カレンダー（実在するレースIDだけをリクエストするため）
+        self.race_calendar = RaceCalendar(self.fetcher, calendar_cache_path) if use_calendar else None
+        # ストレージの初期化（GCS / ローカルディレクトリ / メモリ）
+        self.storage = storage if isinstance(storage, StorageBackend) else create_storage(storage)
+        # 年・競馬場で分割した追記専用ストアと分析用のParquetデータセット（最初に使うときに作る）
+        self.publish_parquet = publish_parquet
+        self._info_store = None
+        self._result_store = None
+        self._parquet_dataset = None
+        # 保存済みレースIDのインデックス（1回の実行で1度だけ読み込む）
+        self.race_index = None
+        # 馬・騎手・調教師ごとの過去成績のインデックス（track_historyの場合、最初の保存時に読み込む）
+        self.track_history = track_history
+        self.history_index = None
+        # レースごとの処理状況（最初に使うときにストレージから読み込む）
+        self.crawl_state_path = crawl_state_path
+        self.crawl_state = None
+        # 馬のプロフィールの取得（fetch_profilesの場合、最初に使うときに作る）
+        self.fetch_profiles = fetch_profiles
+        self.profile_ttl_days = profile_ttl_days
+        self._profile_fetcher = None
+
+    @property
+    def info_store(self):
+        """レース情報の年・競馬場で分割した追記専用ストア"""
+        if self._info_store is None:
+            from scraping.partitioned_store import PartitionedStore
+            self._info_store = PartitionedStore(self.storage, RACE_INFO_BUCKET, 'race_info',
+                                                RACE_INFO_KEY, RACE_INFO_COLUMNS)
+        return self._info_store
+
+    @property
+    def result_store(self):
+        """レース結果の年・競馬場で分割した追記専用ストア"""
+        if self._result_store is None:
+            from scraping.partitioned_store import PartitionedStore
+            self._result_store = PartitionedStore(self.storage, RACE_RESULT_BUCKET, 'race_result',
+                                                  RACE_RESULT_KEY, RACE_RESULT_STORE_COLUMNS,
+                                                  string_columns=['race_id'] + ENTITY_ID_COLUMNS)
+        return self._result_store
+
+    @property
+    def profile_fetcher(self):
+        """馬のプロフィールの取得（fetch_profilesでなければNone）"""
+        if self.fetch_profiles and self._profile_fetcher is None:
+            from scraping.entity_profiles import HorseProfileFetcher
+            self._profile_fetcher = HorseProfileFetcher(self, ttl_days=self.profile_ttl_days)
+        return self._profile_fetcher
+
+    @property
+    def parquet_dataset(self):
+        """分析用のParquetデータセット（結果にレース情報を付けた行。publish_parquetでなければNone）"""
+        if self.publish_parquet and self._parquet_dataset is None:
+            from scraping.parquet_dataset import ParquetDataset
+            self._parquet_dataset = ParquetDataset(self.storage, RACE_RESULT_BUCKET)
+        return self._parquet_dataset
+
+    def reset_run_state(self):
+        """
+        実行ごとに読み込み直すもの（インデックス・処理状況）を捨てる
+        セッションの接続・開催カレンダー・HTMLキャッシュ・計測値はそのまま使い回す
+        """
+        self.race_index = None
+        self.history_index = None
+        self.crawl_state = None
 
     def scrape_race_result(self, race_id):
         """
@@ -26,55 +173,160 @@ class NetkeibaRaceScraper:
         Returns:
             dict: レース情報と結果のデータ
         """
-        url = f'https://db.netkeiba.com/race/{race_id}'
-        
+        labels = {'year': race_id[:4], 'venue': race_id[4:6]}
         try:
-            response = requests.get(url, headers=self.headers)
-            response.encoding = 'EUC-JP'
-            response.raise_for_status()
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            race_data = {
-                'race_info': self._get_race_info(soup),
-                'race_details': self._get_race_details(soup),
-                'race_results': self._get_race_results(soup)
-            }
-            
+            html = self._fetch_race_page(race_id)
+            with self.metrics.timer('parse_seconds', **labels):
+                race_data = self._parse_race_page(html)
+            self.metrics.inc('races_processed_total', **labels)
+            self.record_parsed(race_id, race_data)
             return race_data
             
         except requests.exceptions.RequestException as e:
+            self.metrics.inc('scrape_errors_total', stage='fetch', **labels)
             print(f"Network error while scraping race {race_id}: {str(e)}")
             return None
         except Exception as e:
+            self.metrics.inc('scrape_errors_total', stage='parse', **labels)
+            self.get_crawl_state().mark([race_id], FAILED, f'parse: {e}')
             print(f"Error scraping race {race_id}: {str(e)}")
             return None
 
+    def record_parsed(self, race_id, race_data):
+        """
+        パースしたレースの処理状況を記録する（結果表の無いページは次回の実行で再試行する）
+        当日以降のレース（日付の分からないページを含む）の結果表が無いのは結果がまだ出ていないだけなので、
+        失敗として数えずに取得予定に戻す（再試行の上限で打ち切らない）
+        """
+        if race_data is None:
+            self.get_crawl_state().mark([race_id], FAILED, 'parse error')
+        elif not race_data['race_results']:
+            race_date = (race_data.get('race_info') or {}).get('race_date')
+            today = datetime.now(timezone(timedelta(hours=9))).strftime('%Y-%m-%d')
+            if not race_date or race_date >= today:
+                self.get_crawl_state().mark([race_id], PENDING, 'no result table yet')
+            else:
+                self.get_crawl_state().mark([race_id], FAILED, 'no result table')
+        else:
+            self.get_crawl_state().mark([race_id], PARSED)
+
+    def _parse_race_page(self, html, parser=None):
+        """
+        レースページのHTMLをパースする
+        Args:
+            html (str): レースページのHTML
+            parser (str, optional): 'bs4' または 'lxml'（省略時はコンストラクタの指定）
+        Returns:
+            dict: レース情報と結果のデータ
+        """
+        from scraping.result_columns import raw_result_columns
+        build_results = raw_result_columns if self.result_format == 'columns' else self._build_race_results
+        if (parser or self.parser) == 'lxml':
+            from scraping import fast_parser
+            tree = fast_parser.parse_document(html)
+            return {
+                'race_info': self._build_race_info(*fast_parser.extract_race_info_texts(tree)),
+                'race_details': fast_parser.extract_race_details(tree),
+                'race_results': build_results(*fast_parser.extract_result_table(tree))
+            }
+        
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(html, 'html.parser')
+        return {
+            'race_info': self._get_race_info(soup),
+            'race_details': self._get_race_details(soup),
+            'race_results': (raw_result_columns(*self._get_result_table_texts(soup))
+                             if self.result_format == 'columns' else self._get_race_results(soup))
+        }
+
+    def _has_result_table(self, html):
+        """結果表（.race_table_01）があるページか"""
+        if self.parser == 'lxml':
+            from scraping import fast_parser
+            return fast_parser.has_result_table(fast_parser.parse_document(html))
+        from bs4 import BeautifulSoup
+        return BeautifulSoup(html, 'html.parser').select_one('.race_table_01') is not None
+
+    def _fetch_race_page(self, race_id):
+        """
+        レースページのHTMLを取得する（キャッシュが有効な場合はキャッシュを経由）
+        Returns:
+            str: EUC-JPでデコードしたHTML
+        """
+        url = self.RACE_URL.format(race_id=race_id)
+        # リクエスト・キャッシュの計測値は年・競馬場ごとに記録する
+        with self.metrics.labels(year=race_id[:4], venue=race_id[4:6]):
+            try:
+                if self.page_cache:
+                    content = self.page_cache.fetch(self.fetcher, race_id, url)
+                else:
+                    response = self.fetcher.fetch(url)
+                    response.raise_for_status()
+                    content = response.content
+            except requests.exceptions.RequestException as e:
+                self.get_crawl_state().mark([race_id], FAILED, f'fetch: {e}')
+                raise
+        self.get_crawl_state().mark([race_id], FETCHED)
+        return content.decode('EUC-JP', errors='replace')
+
+    def scrape_race_results(self, race_ids):
+        """
+        複数レースの結果を並列にスクレイピングする
+        Args:
+            race_ids (list): レースIDのリスト
+        Returns:
+            dict: レースID → レース情報と結果のデータ（失敗したレースはNone）
+        """
+        race_ids = list(race_ids)
+        return dict(zip(race_ids, self.fetcher.map(self.scrape_race_result, race_ids)))
+
     def _get_race_info(self, soup):
         """レースの基本情報を取得"""
-        race_info = {}
-        
         # レース名の取得
+        race_name = None
         race_name_elem = soup.select_one('dl.racedata h1')
         if race_name_elem:
             # imgタグを削除
             for img in race_name_elem.find_all('img'):
                 img.decompose()
-            race_info['race_name'] = race_name_elem.text.strip()
+            race_name = race_name_elem.text
         
         # 基本情報の取得（日付、開催場所、ラウンド）
         race_details = soup.select_one('div.data_intro p.smalltxt')
-        if race_details:
-            details_text = race_details.text.strip()
+        details_text = race_details.text if race_details else None
+        
+        # レース詳細情報の取得
+        data_intro = soup.select_one('div.data_intro')
+        intro_text = data_intro.text if data_intro else None
+        
+        return self._build_race_info(race_name, details_text, intro_text)
+
+    def _build_race_info(self, race_name, details_text, intro_text):
+        """
+        ページから抜き出したテキストからレースの基本情報を組み立てる（パーサーの種類によらず共通）
+        Args:
+            race_name (str or None): dl.racedata h1 のテキスト
+            details_text (str or None): div.data_intro p.smalltxt のテキスト
+            intro_text (str or None): div.data_intro のテキスト
+        """
+        race_info = {}
+        
+        # レース名の取得
+        if race_name is not None:
+            race_info['race_name'] = race_name.strip()
+        
+        # 基本情報の取得（日付、開催場所、ラウンド）
+        if details_text is not None:
+            details_text = details_text.strip()
             parts = details_text.split()
             if len(parts) >= 2:
                 # 日付の処理を修正（YYYY-MM-DD形式に統一）
                 raw_date = parts[0]
-                race_info['race_date'] = (pd.to_datetime(raw_date
-                                        .replace('年', '-')
-                                        .replace('月', '-')
-                                        .replace('日', ''))
-                                        .strftime('%Y-%m-%d'))
+                race_info['race_date'] = (datetime.strptime(raw_date
+                                          .replace('年', '-')
+                                          .replace('月', '-')
+                                          .replace('日', ''), '%Y-%m-%d')
+                                          .strftime('%Y-%m-%d'))
                 
                 # kaisai_infoを分割（例：6回京都4日目 → 6, 京都, 4）
                 kaisai_info = parts[1]
@@ -87,9 +339,8 @@ class NetkeibaRaceScraper:
                 race_info['race_conditions'] = ' '.join(parts[2:])
         
         # レース詳細情報の取得
-        data_intro = soup.select_one('div.data_intro')
-        if data_intro:
-            data_lines = [line.strip() for line in data_intro.text.split('\n') if line.strip()]
+        if intro_text is not None:
+            data_lines = [line.strip() for line in intro_text.split('\n') if line.strip()]
             for line in data_lines:
                 # ダ右1000m / 天候 : 晴 / ダート : 良 / 発走 : 10:20 のような形式に対応
                 if ('芝' in line or 'ダ' in line) and 'm' in line and '天候' in line:
@@ -217,25 +468,51 @@ class NetkeibaRaceScraper:
 
     def _get_race_results(self, soup):
         """レース結果を取得"""
+        return self._build_race_results(*self._get_result_table_texts(soup))
+
+    def _get_result_table_texts(self, soup):
+        """
+        結果表の見出しと、tdを持つ行ごとのセルのテキスト・馬／騎手／調教師のIDを取得
+        （結果表が無い場合は([], [], [])）
+        """
+        from scraping.result_columns import entity_ids
         result_table = soup.select_one('.race_table_01')
         if not result_table:
             result_table = soup.select_one('.RaceTable01')
         
         if not result_table:
-            return []
+            return [], [], []
         
         headers = [th.text.strip() for th in result_table.select('tr th')]
+        if not headers:
+            return [], [], []
+        
+        rows = []
+        row_entity_ids = []
+        for row in result_table.select('tr'):
+            cells = row.select('td')
+            if cells:
+                rows.append([cell.text.strip() for cell in cells])
+                row_entity_ids.append(entity_ids(a['href'] for a in row.select('a[href]')))
+        
+        return headers, rows, row_entity_ids
+
+    def _build_race_results(self, headers, rows, row_entity_ids=None):
+        """
+        結果表のヘッダーとセルのテキストからレース結果を組み立てる（パーサーの種類によらず共通）
+        Args:
+            headers (list): 見出しセルのテキスト（前後の空白は除去済み）
+            rows (list): tdを持つ行ごとのセルのテキストのリスト（前後の空白は除去済み）
+            row_entity_ids (list, optional): 行ごとの馬・騎手・調教師のID（リンクが無いものは付けない）
+        """
         if not headers:
             return []
         
         results = []
-        for row in result_table.select('tr'):
-            if not row.select('td'):
-                continue
+        for row_index, cells in enumerate(rows):
             result = {}
-            for i, cell in enumerate(row.select('td')):
+            for i, value in enumerate(cells):
                 if i < len(headers):
-                    value = cell.text.strip()
                     header = headers[i]
                     
                     # 着順の処理（数値以外は-1に変換）
@@ -311,177 +588,207 @@ class NetkeibaRaceScraper:
                     else:
                         result[header] = value
             
+            # 馬・騎手・調教師のID（プロフィールのテーブルとの結合用）
+            if row_entity_ids:
+                result.update(row_entity_ids[row_index])
             results.append(result)
         
         return results
 
+    def get_race_index(self):
+        """保存済みレースIDのインデックスを取得（初回のみストレージから読み込む）"""
+        if self.race_index is None:
+            from scraping.race_index import RaceIdIndex
+            self.race_index = RaceIdIndex.load(self.storage, {
+                'race_info': self.info_store,
+                'race_result': self.result_store,
+            })
+        return self.race_index
+
+    def get_history_index(self):
+        """過去成績のインデックスを取得（初回のみストレージから読み込み、未反映のパートを読み足す）"""
+        if self.history_index is None:
+            from scraping.history_index import EntityHistoryIndex
+            self.history_index = EntityHistoryIndex.load(self.storage, self.result_store, self.info_store)
+        return self.history_index
+
+    def get_crawl_state(self):
+        """レースごとの処理状況を取得（初回のみストレージから読み込む）"""
+        if self.crawl_state is None:
+            self.crawl_state = CrawlState.load(self.storage, self.crawl_state_path)
+        return self.crawl_state
+
+    def persist_indexes(self):
+        """実行中に更新したインデックスと処理状況をまとめて書き戻す"""
+        if self.race_index is not None:
+            self.race_index.persist()
+        if self.history_index is not None:
+            self.history_index.persist()
+        if self.crawl_state is not None:
+            self.crawl_state.checkpoint()
+
     def get_existing_race_ids(self, target_year=None):
         """
-        GCSの既存のCSVファイルから取得済みのレースIDを取得
+        レースIDのインデックスから取得済みのレースIDを取得
         Args:
             target_year (int, optional): 指定された年のレースIDのみを取得
         """
         existing_ids = set()
         
         try:
-            # race_info_formatted.csvの確認
-            info_bucket = self.storage_client.bucket('nk_race_info')
-            info_blob = info_bucket.blob('race_info_formatted.csv')
-            
-            if info_blob.exists():
-                with tempfile.NamedTemporaryFile(mode='wb', delete=False) as temp_file:
-                    info_blob.download_to_file(temp_file)
-                df_info = pd.read_csv(temp_file.name)
-                if 'race_id' in df_info.columns:
-                    df_info['race_id'] = df_info['race_id'].astype(str)
-                    if target_year:
-                        df_info = df_info[df_info['race_id'].str[:4] == str(target_year)]
-                    existing_ids.update(df_info['race_id'])
-                os.unlink(temp_file.name)
-            
-            # race_result_formatted.csvの確認
-            result_bucket = self.storage_client.bucket('nk_race_result')
-            result_blob = result_bucket.blob('race_result_formatted.csv')
-            
-            if result_blob.exists():
-                with tempfile.NamedTemporaryFile(mode='wb', delete=False) as temp_file:
-                    result_blob.download_to_file(temp_file)
-                df_result = pd.read_csv(temp_file.name)
-                if 'race_id' in df_result.columns:
-                    df_result['race_id'] = df_result['race_id'].astype(str)
-                    if target_year:
-                        df_result = df_result[df_result['race_id'].str[:4] == str(target_year)]
-                    existing_ids.update(df_result['race_id'])
-                os.unlink(temp_file.name)
-            
+            race_index = self.get_race_index()
+            existing_ids.update(race_index.ids('race_info', target_year))
+            existing_ids.update(race_index.ids('race_result', target_year))
         except Exception as e:
-            print(f"Error reading existing race IDs from GCS: {e}")
+            print(f"Error reading existing race IDs from storage: {e}")
         
         return existing_ids
 
-    def get_last_processed_position(self):
+    def get_last_processed_position(self, year=None):
         """
-        GCSから最後に処理したレースの位置を特定（race_infoとrace_result両方に存在する最後のレースIDを取得）
+        処理状況から再開する位置を特定（途中で止まった・失敗したレースのうち最初のもの）
+        Args:
+            year (int, optional): 指定された年のレースのみ
         Returns:
-            tuple: (year, place_code, kai, day) または None
+            tuple: (year, place_code, kai, day) または None（未完了のレースが無い場合）
         """
-        info_race_ids = set()
-        result_race_ids = set()
-        
         try:
-            # race_info_formatted.csvの確認
-            info_bucket = self.storage_client.bucket('nk_race_info')
-            info_blob = info_bucket.blob('race_info_formatted.csv')
-            
-            if info_blob.exists():
-                with tempfile.NamedTemporaryFile(mode='wb', delete=False) as temp_file:
-                    info_blob.download_to_file(temp_file)
-                df_info = pd.read_csv(temp_file.name)
-                if 'race_id' in df_info.columns and not df_info['race_id'].empty:
-                    info_race_ids = set(df_info['race_id'].astype(str))
-                os.unlink(temp_file.name)
-            
-            # race_result_formatted.csvの確認
-            result_bucket = self.storage_client.bucket('nk_race_result')
-            result_blob = result_bucket.blob('race_result_formatted.csv')
-            
-            if result_blob.exists():
-                with tempfile.NamedTemporaryFile(mode='wb', delete=False) as temp_file:
-                    result_blob.download_to_file(temp_file)
-                df_result = pd.read_csv(temp_file.name)
-                if 'race_id' in df_result.columns and not df_result['race_id'].empty:
-                    result_race_ids = set(df_result['race_id'].astype(str))
-                os.unlink(temp_file.name)
-            
-            # 両方のファイルに存在するレースIDを取得
-            common_race_ids = info_race_ids.intersection(result_race_ids)
-            
-            if common_race_ids:
-                # 最大のレースIDを取得
-                last_race_id = max(common_race_ids)
-                
+            unfinished = self.get_crawl_state().unfinished(year)
+            if unfinished:
                 # レースIDを分解（例: 202401010102 → 2024, 01, 01, 01）
-                year = last_race_id[:4]
-                place = last_race_id[4:6]
-                kai = last_race_id[6:8]
-                day = last_race_id[8:10]
-                return int(year), place, int(kai), int(day)
+                first_race_id = unfinished[0]
+                return int(first_race_id[:4]), first_race_id[4:6], int(first_race_id[6:8]), int(first_race_id[8:10])
             
         except Exception as e:
-            print(f"Error getting last processed position from GCS: {e}")
+            print(f"Error getting last processed position from the crawl state: {e}")
         
         return None
 
     def save_consolidated_csv(self, race_infos, race_results):
         """
-        レース情報と結果をGCSに保存（既存データとマージ）
+        レース情報と結果をストレージに保存
+        新しい行だけを年・競馬場ごとのパートファイルとして追記する（既存データは読み込まない）
         """
         try:
-            # レース情報の保存
-            if race_infos:
-                info_bucket = self.storage_client.bucket('nk_race_info')
-                info_blob = info_bucket.blob('race_info_formatted.csv')
-                
-                df_info = pd.DataFrame(race_infos)
-                df_info['race_id'] = df_info['race_id'].astype(str)
-                
-                # 既存のファイルが存在する場合は読み込んでマージ
-                if info_blob.exists():
-                    with tempfile.NamedTemporaryFile(mode='wb', delete=False) as temp_file:
-                        info_blob.download_to_file(temp_file)
-                    existing_df = pd.read_csv(temp_file.name)
-                    existing_df['race_id'] = existing_df['race_id'].astype(str)
-                    
-                    # 既存のデータを削除して新しいデータで上書き
-                    existing_df = existing_df[~existing_df['race_id'].isin(df_info['race_id'])]
-                    df_info = pd.concat([existing_df, df_info], ignore_index=True)
-                    os.unlink(temp_file.name)
-                
-                # 一時ファイルに保存してアップロード
-                with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False) as temp_file:
-                    df_info.to_csv(temp_file.name, index=False)
-                    info_blob.upload_from_filename(temp_file.name)
-                    os.unlink(temp_file.name)
-                
-                print(f"Saved {len(race_infos)} race info records")
-            
-            # レース結果の保存
-            if race_results:
-                result_bucket = self.storage_client.bucket('nk_race_result')
-                result_blob = result_bucket.blob('race_result_formatted.csv')
-                
-                df_results = pd.DataFrame(race_results)
-                df_results['race_id'] = df_results['race_id'].astype(str)
-                
-                # 既存のファイルが存在する場合は読み込んでマージ
-                if result_blob.exists():
-                    with tempfile.NamedTemporaryFile(mode='wb', delete=False) as temp_file:
-                        result_blob.download_to_file(temp_file)
-                    existing_df = pd.read_csv(temp_file.name)
-                    existing_df['race_id'] = existing_df['race_id'].astype(str)
-                    
-                    # 既存のデータを削除して新しいデータで上書き
-                    if '馬番' in df_results.columns:
-                        existing_df = existing_df[~((existing_df['race_id'].isin(df_results['race_id'])) & 
-                                                  (existing_df['馬番'].isin(df_results['馬番'])))]
-                    else:
-                        existing_df = existing_df[~existing_df['race_id'].isin(df_results['race_id'])]
-                    
-                    df_results = pd.concat([existing_df, df_results], ignore_index=True)
-                    os.unlink(temp_file.name)
-                
-                # 一時ファイルに保存してアップロード
-                with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False) as temp_file:
-                    df_results.to_csv(temp_file.name, index=False)
-                    result_blob.upload_from_filename(temp_file.name)
-                    os.unlink(temp_file.name)
-                
-                print(f"Saved {len(race_results)} race result records")
-            
+            with self.metrics.timer('save_seconds'):
+                self._save_rows(race_infos, race_results)
         except Exception as e:
-            print(f"Error saving to GCS: {str(e)}")
+            print(f"Error saving to storage: {str(e)}")
             raise
 
+    def _save_rows(self, race_infos, race_results):
+        from scraping.result_columns import RawResultColumns, normalize_result_columns
+
+        # 過去成績のインデックスは書き込む前に読み込んでおく（今回のパートを読み足さないように）
+        history_index = self.get_history_index() if self.track_history else None
+        
+        # レース情報の保存（キーで既存の行とつき合わせ、追加・変更された行だけを書き出す）
+        info_parts = []
+        if race_infos:
+            upserted = self.info_store.upsert(race_infos)
+            info_parts = upserted['parts']
+            if self.race_index is not None:
+                self.race_index.add('race_info', [info['race_id'] for info in race_infos], upserted['parts'])
+            self._record_upsert('race_info', upserted)
+        
+        # レース結果の保存
+        result_parts = []
+        if race_results:
+            if isinstance(race_results[0], RawResultColumns):
+                # 列形式の結果はまとめて型変換する
+                race_results = normalize_result_columns(race_results)
+                result_race_ids = race_results['race_id'].unique()
+            else:
+                result_race_ids = [result['race_id'] for result in race_results]
+            upserted = self.result_store.upsert(race_results)
+            result_parts = upserted['parts']
+            if self.race_index is not None:
+                self.race_index.add('race_result', result_race_ids, result_parts)
+            self._record_upsert('race_result', upserted)
+        
+        # Parquetのデータセットへの書き出し（結果か情報のどちらかが変わったレース）
+        if self.parquet_dataset is not None and (info_parts or result_parts):
+            published_ids = set(map(str, result_race_ids)) if result_parts else set()
+            if info_parts:
+                published_ids.update(str(info['race_id']) for info in race_infos)
+            self._publish_parquet(published_ids, race_results if result_parts else [])
+        
+        # プロフィールを取得する馬を集める（取得はクロールの最後にまとめて行う）
+        # （列形式の結果はDataFrameになっているので、真偽値ではなく件数で判定する）
+        if len(race_results) and self.profile_fetcher is not None:
+            if isinstance(race_results, list):
+                self.profile_fetcher.add({result.get('horse_id') for result in race_results})
+            elif 'horse_id' in race_results:
+                self.profile_fetcher.add(race_results['horse_id'].dropna().unique())
+        
+        # 過去成績のインデックスの更新
+        if history_index is not None:
+            history_index.add(race_infos, race_results, result_parts)
+        
+        # 保存したレースを記録し、処理状況をストレージに書き戻す（ここまで済めば次回の実行は取得し直さない）
+        saved_ids = {str(info['race_id']) for info in race_infos}
+        if len(race_results):
+            saved_ids.update(map(str, result_race_ids))
+        crawl_state = self.get_crawl_state()
+        crawl_state.mark(sorted(saved_ids), SAVED)
+        crawl_state.checkpoint()
+
+    def _publish_parquet(self, race_ids, race_results):
+        """
+        保存したレースの行をParquetのデータセットに書き出す
+        レース情報は保存済みのものを使う（結果だけを保存し直したレースも情報の列を欠損にしない）
+        Args:
+            race_ids (set): 書き出すレースID
+            race_results (list or DataFrame): 今回保存した結果（これに無いレースは保存済みの結果を読み込む）
+        """
+        import pandas as pd
+
+        from scraping.parquet_dataset import race_result_frame
+
+        results = race_results if isinstance(race_results, pd.DataFrame) else pd.DataFrame(race_results)
+        if not results.empty:
+            results = results.assign(race_id=results['race_id'].astype(str))
+        missing_ids = race_ids - set(results['race_id']) if not results.empty else race_ids
+        if missing_ids:
+            # 情報だけが変わったレース
+            results = pd.concat([results, self.result_store.read_races(missing_ids)], ignore_index=True)
+        if results.empty:
+            return
+        infos = self.info_store.read_races(race_ids)
+        self.parquet_dataset.write(race_result_frame(infos.to_dict('records'), results))
+        print(f"Published {len(results)} race result records to the Parquet dataset")
+
+    def _record_upsert(self, table, upserted):
+        """upsertの件数（追加・変更・変更なし）をメトリクスとログに残す"""
+        for result in ('inserted', 'updated', 'unchanged'):
+            self.metrics.inc('saved_rows_total', upserted[result], table=table, result=result)
+        print(f"Saved {table} records: {upserted['inserted']} inserted, {upserted['updated']} updated, "
+              f"{upserted['unchanged']} unchanged")
+
+    def fetch_pending_profiles(self):
+        """保存したレース結果に出てきた馬のプロフィールを取得する（fetch_profilesでなければ何もしない）"""
+        if self.profile_fetcher is None:
+            return None
+        with self.metrics.span('fetch_profiles'):
+            return self.profile_fetcher.fetch()
+
+    def compact_storage(self, year=None):
+        """
+        パートファイルをパーティションごとに1ファイルにまとめる（定期実行用）
+        Args:
+            year (int, optional): 対象の年（省略時は全期間）
+        """
+        info_count = self.info_store.compact(year)
+        result_count = self.result_store.compact(year)
+        print(f"Compacted {info_count} race info partitions and {result_count} race result partitions")
+
+    def migrate_legacy_csv(self):
+        """従来の race_info_formatted.csv / race_result_formatted.csv をパートファイルに移行する"""
+        info_rows = self.info_store.import_legacy_csv('race_info_formatted.csv')
+        result_rows = self.result_store.import_legacy_csv('race_result_formatted.csv')
+        print(f"Migrated {info_rows} race info rows and {result_rows} race result rows")
+        self.compact_storage()
+
     def process_races(self, year=None, place=None, kai=None, day=None):
         """
         指定された条件でレースをスクレイピング
@@ -493,21 +800,20 @@ class NetkeibaRaceScraper:
         Returns:
             dict: スクレイピング結果のステータス
         """
-        start_time = time.time()
+        start_time = time.perf_counter()
         try:
             print("Starting race processing...")
             
             # 既存のレースIDを取得（指定された年のみ）
-            print("Fetching existing race IDs...")
-            fetch_start = time.time()
-            existing_race_ids = self.get_existing_race_ids(year)
-            print(f"Fetched existing race IDs in {time.time() - fetch_start:.2f} seconds")
+            with self.metrics.span('load_existing_race_ids', year=year) as span:
+                existing_race_ids = self.get_existing_race_ids(year)
+                span['race_ids'] = len(existing_race_ids)
             
-            # 最後に処理した位置を取得
-            last_position = self.get_last_processed_position()
+            # 前回の実行で未完了のまま残ったレースの位置を取得
+            last_position = self.get_last_processed_position(year)
             if last_position:
                 last_year, last_place, last_kai, last_day = last_position
-                print(f"Last processed position: Year={last_year}, Place={last_place}, Kai={last_kai}, Day={last_day}")
+                print(f"Resuming from the first unfinished race: Year={last_year}, Place={last_place}, Kai={last_kai}, Day={last_day}")
             
             # 年の設定
             current_year = datetime.now().year
@@ -529,14 +835,42 @@ class NetkeibaRaceScraper:
                     if result['status'] == 'error':
                         return result
             
-            total_time = time.time() - start_time
-            print(f"\nTotal processing time: {total_time:.2f} seconds")
+            # 今回保存したレースに出てきた馬のプロフィールをまとめて取得
+            self.fetch_pending_profiles()
+            
+            log_event('Race processing completed', start_year=start_year, end_year=end_year,
+                      duration_seconds=round(time.perf_counter() - start_time, 3))
             return {'status': 'success', 'message': f'Processed all races from {start_year} to {end_year}'}
             
         except Exception as e:
             error_message = str(e)
             print(f"Error in process_races: {error_message}")
             return {'status': 'error', 'message': error_message}
+        
+        finally:
+            # 実行中に追加したレースID・過去成績をまとめて書き戻す
+            self.persist_indexes()
+            log_event('Scrape metrics', metrics=self.metrics.snapshot())
+
+    def process_race_ids(self, race_ids, parse_workers=None):
+        """
+        指定したレースIDを取得・パースして保存する（キャッシュ済みシーズンの再パースなど）
+        取得とパースを分けたパイプラインで処理し、パースは全コアを使って並列に行う
+        Args:
+            race_ids (list): 処理するレースID
+            parse_workers (int, optional): パースに使うプロセス数（省略時はコンストラクタの指定、それも無ければCPUコア数）
+        Returns:
+            dict: ステージごとのカウンター
+        """
+        from scraping.pipeline import ScrapePipeline
+        pipeline = ScrapePipeline(self, parse_workers=parse_workers or self.parse_workers or None)
+        try:
+            stats = pipeline.run(race_ids)
+            self.fetch_pending_profiles()
+        finally:
+            self.persist_indexes()
+        log_event('Pipeline completed', stages=stats, metrics=self.metrics.snapshot())
+        return stats
 
     def _process_specific_date(self, year, place, kai, day, existing_race_ids):
         """特定の日付のレースを処理"""
@@ -544,24 +878,20 @@ class NetkeibaRaceScraper:
         race_infos = []
         race_results = []
         
-        for race_num in range(1, 13):
-            race_id = f"{base_race_id}{race_num:02d}"
-            
-            # 未取得のレースのみ処理
-            if race_id not in existing_race_ids:
-                race_data = self.scrape_race_result(race_id)
-                
-                if race_data:
-                    if race_data['race_info']:
-                        race_data['race_info']['race_id'] = race_id
-                        race_infos.append(race_data['race_info'])
-                    
-                    if race_data['race_results']:
-                        for result in race_data['race_results']:
-                            result['race_id'] = race_id
-                        race_results.extend(race_data['race_results'])
+        # 未取得のレースのみ処理
+        target_ids = [f"{base_race_id}{race_num:02d}" for race_num in range(1, 13)]
+        target_ids = [race_id for race_id in target_ids if race_id not in existing_race_ids]
+        
+        scraped = self.scrape_race_results(target_ids)
+        from scraping.result_columns import attach_race_id
+        for race_id, race_data in scraped.items():
+            if race_data:
+                if race_data['race_info']:
+                    race_data['race_info']['race_id'] = race_id
+                    race_infos.append(race_data['race_info'])
                 
-                time.sleep(1)  # レート制限対策
+                if race_data['race_results']:
+                    race_results.extend(attach_race_id(race_data['race_results'], race_id))
         
         if race_infos or race_results:
             self.save_consolidated_csv(race_infos, race_results)
@@ -570,51 +900,23 @@ class NetkeibaRaceScraper:
 
     def _process_yearly_data(self, year, existing_race_ids, last_position):
         """年間データを処理"""
-        year_start_time = time.time()
+        year_start_time = time.perf_counter()
         place_codes = ['01', '02', '03', '04', '05', '06', '07', '08', '09', '10']
         start_kai = 1
         start_day = 1
         start_race = 1
         
         # race_infoとrace_resultの既存データを個別に取得
-        print("\nFetching existing race data...")
-        fetch_start = time.time()
-        info_race_ids = set()
-        result_race_ids = set()
-        
-        try:
-            # race_info_formatted.csvの確認
-            info_bucket = self.storage_client.bucket('nk_race_info')
-            info_blob = info_bucket.blob('race_info_formatted.csv')
-            
-            if info_blob.exists():
-                with tempfile.NamedTemporaryFile(mode='wb', delete=False) as temp_file:
-                    info_blob.download_to_file(temp_file)
-                df_info = pd.read_csv(temp_file.name)
-                if 'race_id' in df_info.columns:
-                    df_info['race_id'] = df_info['race_id'].astype(str)
-                    info_race_ids = set(df_info[df_info['race_id'].str[:4] == str(year)]['race_id'])
-                os.unlink(temp_file.name)
-            
-            # race_result_formatted.csvの確認
-            result_bucket = self.storage_client.bucket('nk_race_result')
-            result_blob = result_bucket.blob('race_result_formatted.csv')
-            
-            if result_blob.exists():
-                with tempfile.NamedTemporaryFile(mode='wb', delete=False) as temp_file:
-                    result_blob.download_to_file(temp_file)
-                df_result = pd.read_csv(temp_file.name)
-                if 'race_id' in df_result.columns:
-                    df_result['race_id'] = df_result['race_id'].astype(str)
-                    result_race_ids = set(df_result[df_result['race_id'].str[:4] == str(year)]['race_id'])
-                os.unlink(temp_file.name)
-        
-        except Exception as e:
-            print(f"Error reading existing race IDs: {e}")
-            info_race_ids = set()
-            result_race_ids = set()
-        
-        print(f"Fetched existing race data in {time.time() - fetch_start:.2f} seconds")
+        with self.metrics.span('load_existing_race_data', year=year) as span:
+            try:
+                race_index = self.get_race_index()
+                info_race_ids = race_index.ids('race_info', year)
+                result_race_ids = race_index.ids('race_result', year)
+            except Exception as e:
+                print(f"Error reading existing race IDs: {e}")
+                info_race_ids = set()
+                result_race_ids = set()
+            span.update(race_info_ids=len(info_race_ids), race_result_ids=len(result_race_ids))
         
         # 片方にしか存在しないレースIDを特定
         info_only_ids = info_race_ids - result_race_ids
@@ -629,92 +931,199 @@ class NetkeibaRaceScraper:
         total_requests = 0
         total_races_processed = 0
         
-        for place in place_codes:
-            place_start_time = time.time()
+        # 開催カレンダーから実在する開催日・レースIDを取得（失敗した場合は総当たりで探索）
+        meeting_days = None
+        if self.race_calendar:
+            try:
+                with self.metrics.span('discover_meeting_days', year=year) as span:
+                    meeting_days = self.race_calendar.meeting_days(year)
+                    span['meeting_days'] = sum(len(days) for days in meeting_days.values())
+            except Exception as e:
+                print(f"Error discovering race IDs from the calendar, falling back to probing: {str(e)}")
+                meeting_days = None
+        
+        crawl_state = self.get_crawl_state()
+        if meeting_days is not None:
+            # 開催カレンダーのレースを取得予定として記録しておく（途中で止まっても残りが分かる）
+            crawl_state.plan(race_id for days in meeting_days.values() for race_ids in days.values() for race_id in race_ids)
+        
+        def needs_scraping(race_id):
+            # レースIDが存在しない場合、または片方のファイルにしか存在しない場合にスクレイピング
+            # （失敗を繰り返しているレースは再試行の上限で打ち切る）
+            missing = race_id not in existing_race_ids or race_id in info_only_ids or race_id in result_only_ids
+            return missing and not crawl_state.gave_up(race_id)
+        
+        def select_rows(race_id, race_data):
+            """取得したレースのうち、保存が必要なrace_info・race_resultの行を選ぶ"""
+            from scraping.result_columns import attach_race_id
             race_infos = []
             race_results = []
+            # race_infoの処理
+            if race_data['race_info'] and (race_id not in info_race_ids or race_id in result_only_ids):
+                race_info = race_data['race_info']
+                race_info['race_id'] = race_id
+                race_infos.append(race_info)
             
-            # 開始位置の設定
-            current_kai = start_kai
-            for kai in range(current_kai, 13):
-                current_day = start_day if kai == start_kai else 1
-                for day in range(current_day, 21):
-                    base_race_id = f"{year}{place}{kai:02d}{day:02d}"
-                    first_race_id = f"{base_race_id}01"
-                    
-                    try:
-                        request_start = time.time()
-                        response = requests.get(f'https://db.netkeiba.com/race/{first_race_id}', headers=self.headers)
-                        total_requests += 1
-                        time.sleep(1)
-                        
-                        if response.status_code == 200:
-                            soup = BeautifulSoup(response.text, 'html.parser')
-                            if soup.select_one('.race_table_01'):
-                                print(f"Processing races for {base_race_id} (Request took {time.time() - request_start:.2f}s)")
-                                
-                                current_race = start_race if kai == start_kai and day == start_day else 1
-                                for race_num in range(current_race, 13):
-                                    race_id = f"{base_race_id}{race_num:02d}"
-                                    
-                                    # レースIDが存在しない場合、または片方のファイルにしか存在しない場合にスクレイピング
-                                    if race_id not in existing_race_ids or race_id in info_only_ids or race_id in result_only_ids:
-                                        race_start = time.time()
-                                        race_data = self.scrape_race_result(race_id)
-                                        total_requests += 1
-                                        
-                                        if race_data:
-                                            total_races_processed += 1
-                                            # race_infoの処理
-                                            if race_data['race_info'] and (race_id not in info_race_ids or race_id in result_only_ids):
-                                                race_info = race_data['race_info']
-                                                race_info['race_id'] = race_id
-                                                race_infos.append(race_info)
-                                            
-                                            # race_resultの処理
-                                            if race_data['race_results'] and (race_id not in result_race_ids or race_id in info_only_ids):
-                                                for result in race_data['race_results']:
-                                                    result['race_id'] = race_id
-                                                race_results.extend(race_data['race_results'])
-                                            
-                                            # データを保存
-                                            if race_infos or race_results:
-                                                save_start = time.time()
-                                                self.save_consolidated_csv(race_infos, race_results)
-                                                print(f"Saved data in {time.time() - save_start:.2f} seconds")
-                                                race_infos = []
-                                                race_results = []
-                                        
-                                        print(f"Processed race {race_id} in {time.time() - race_start:.2f} seconds")
-                                        time.sleep(3)
+            # race_resultの処理
+            if race_data['race_results'] and (race_id not in result_race_ids or race_id in info_only_ids):
+                race_results.extend(attach_race_id(race_data['race_results'], race_id))
+            return race_infos, race_results
+        
+        def process_day(base_race_id, race_ids):
+            """開催日のレースのうち、未取得のものをまとめて取得・保存"""
+            nonlocal total_requests, total_races_processed
+            race_infos = []
+            race_results = []
+            
+            target_ids = [race_id for race_id in race_ids if needs_scraping(race_id)]
+            if not target_ids:
+                return
+            
+            with self.metrics.span('process_day', meeting=base_race_id, races=len(target_ids)) as span:
+                # 開催日の全レースを並列に取得（待機はフェッチエンジンのレート制限に任せる）
+                scraped = self.scrape_race_results(target_ids)
+                total_requests += len(target_ids)
                 
-                    except Exception as e:
-                        print(f"Error checking {first_race_id}: {str(e)}")
+                processed = 0
+                for race_id, race_data in scraped.items():
+                    if not race_data:
                         continue
+                    processed += 1
+                    infos, results = select_rows(race_id, race_data)
+                    race_infos.extend(infos)
+                    race_results.extend(results)
+                total_races_processed += processed
+                span['processed'] = processed
                 
-                # 最初の日以降は通常の開始位置から
-                start_day = 1
+                # データを保存（開催日単位）
+                if race_infos or race_results:
+                    self.save_consolidated_csv(race_infos, race_results)
+        
+        if self.parse_workers and meeting_days is not None:
+            # パイプラインモード：年間の未取得レースをまとめて流し、パースはプロセスプールで並列に行う
+            target_ids = [
+                race_id
+                for place in place_codes
+                for race_ids in meeting_days.get(place, {}).values()
+                for race_id in race_ids
+                if needs_scraping(race_id)
+            ]
+            from scraping.pipeline import ScrapePipeline
+            pipeline = ScrapePipeline(self, parse_workers=self.parse_workers)
+            stats = pipeline.run(target_ids, select_rows=select_rows)
+            total_requests += len(target_ids)
+            total_races_processed += stats['parse']['items'] - stats['parse']['errors']
+            log_event('Pipeline completed', year=year, stages=stats)
+            place_codes = []
+        
+        for place in place_codes:
+            with self.metrics.span('process_place', year=year, venue=place):
+                if meeting_days is not None:
+                    for base_race_id, race_ids in meeting_days.get(place, {}).items():
+                        try:
+                            process_day(base_race_id, race_ids)
+                        except Exception as e:
+                            print(f"Error processing {base_race_id}: {str(e)}")
+                            continue
+                else:
+                    # 開始位置の設定
+                    for kai in range(start_kai, 13):
+                        current_day = start_day if kai == start_kai else 1
+                        found_day = False
+                        for day in range(current_day, 21):
+                            base_race_id = f"{year}{place}{kai:02d}{day:02d}"
+                            first_race_id = f"{base_race_id}01"
+                        
+                            try:
+                                if crawl_state.status(first_race_id) != SAVED:
+                                    # 保存済みの開催日は、開催の有無を確かめるリクエストを省く
+                                    try:
+                                        html = self._fetch_race_page(first_race_id)
+                                    except requests.exceptions.HTTPError:
+                                        html = None
+                                    total_requests += 1
+                                
+                                    if not html or not self._has_result_table(html):
+                                        # 開催日は連番なので、N日目が無ければ以降の日も無い
+                                        crawl_state.mark([first_race_id], MISSING)
+                                        break
+                                found_day = True
+                            
+                                print(f"Processing races for {base_race_id}")
+                                current_race = start_race if kai == start_kai and day == start_day else 1
+                                process_day(base_race_id, [f"{base_race_id}{race_num:02d}" for race_num in range(current_race, 13)])
+                        
+                            except Exception as e:
+                                print(f"Error checking {first_race_id}: {str(e)}")
+                                continue
+                    
+                        # 開催回も連番なので、開催日が1日も無い開催回があれば以降の開催回も無い
+                        if not found_day:
+                            break
+                    
+                        # 最初の日以降は通常の開始位置から
+                        start_day = 1
             
             # 最初の開催回以降は通常の開始位置から
             start_kai = 1
             start_race = 1
-            
-            print(f"\nCompleted processing place {place} in {time.time() - place_start_time:.2f} seconds")
-            time.sleep(30)  # 競馬場間に30秒待機
         
-        total_time = time.time() - year_start_time
-        print(f"\nYear {year} processing completed:")
-        print(f"Total time: {total_time:.2f} seconds")
-        print(f"Total requests made: {total_requests}")
-        print(f"Total races processed: {total_races_processed}")
-        print(f"Average time per race: {total_time/total_races_processed:.2f} seconds (if races were processed)")
+        total_time = time.perf_counter() - year_start_time
+        summary = {
+            'year': year,
+            'duration_seconds': round(total_time, 3),
+            'requests': total_requests,
+            'races_processed': total_races_processed,
+            # 1レースも処理しなかった年は平均を出さない
+            'seconds_per_race': round(total_time / total_races_processed, 3) if total_races_processed else None,
+            'request_timing': self.fetcher.timing_summary(),
+        }
+        if self.page_cache:
+            summary['page_cache'] = self.page_cache.stats
+        log_event(f'Year {year} processing completed', **summary)
         
         return {'status': 'success', 'message': f'Processed all races for {year}'}
 
+# ウォームスタートで使い回すスクレイパー（セッションの接続・開催カレンダー・HTMLキャッシュを引き継ぐ）
+_shared_scraper = None
+_shared_scraper_lock = threading.Lock()
+# このインスタンスでまだ呼び出しを受けていないか（コールドスタートの計測用）
+_cold_start = True
+
+
+def _import_heavy_modules():
+    """パース・保存で使う重いモジュールを読み込む（コールドスタート時に最初のリクエストと並行して実行する）"""
+    import importlib
+    for name in HEAVY_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+
+def _get_shared_scraper():
+    """モジュールに残したスクレイパー（実行ごとのインデックス・処理状況は読み込み直す）"""
+    global _shared_scraper
+    if _shared_scraper is None:
+        _shared_scraper = NetkeibaRaceScraper()
+    else:
+        _shared_scraper.reset_run_state()
+    return _shared_scraper
+
+
 # Cloud Functions用のエントリーポイント
 @functions_framework.http
 def scrape_races(request):
-    """HTTP Cloud Functions用のエントリーポイント"""
+    """
+    HTTP Cloud Functions用のエントリーポイント
+    ウォームスタートではモジュールに残したスクレイパーを使い回す（同時に実行中の呼び出しがあれば新しく作る）
+    """
+    global _cold_start
+    cold_start, _cold_start = _cold_start, False
+    if cold_start:
+        # 最初のリクエストを送っている間に、パース・保存で使うモジュールを読み込んでおく
+        threading.Thread(target=_import_heavy_modules, daemon=True).start()
+    shared = _shared_scraper_lock.acquire(blocking=False)
     try:
         request_json = request.get_json(silent=True)
         
@@ -722,8 +1131,41 @@ def scrape_races(request):
         place = request_json.get('place') if request_json else None
         kai = request_json.get('kai') if request_json else None
         day = request_json.get('day') if request_json else None
+        compact = request_json.get('compact') if request_json else False
+        
+        # コーディネーターから振り分けられたシャードだけを処理する
+        if request_json and request_json.get('shard'):
+            from scraping.sharding import run_shard
+            return run_shard(request_json['shard'], scraper_options=request_json.get('scraper_options'))
+        
+        init_start = time.perf_counter()
+        scraper = _get_shared_scraper() if shared else NetkeibaRaceScraper()
+        if cold_start:
+            init_seconds = time.perf_counter() - init_start
+            scraper.metrics.observe('cold_start_seconds', IMPORT_SECONDS, phase='import')
+            scraper.metrics.observe('cold_start_seconds', init_seconds, phase='init')
+            log_event('Cold start', import_seconds=round(IMPORT_SECONDS, 3), init_seconds=round(init_seconds, 3),
+                      seconds_since_load=round(time.perf_counter() - _LOAD_STARTED, 3))
+        
+        # コーディネーター：未取得のレースをシャードに分け、この関数の別の呼び出しに並列に処理させる
+        if request_json and request_json.get('coordinate'):
+            worker_url = request_json.get('worker_url') or os.environ.get('KEIBA_SHARD_URL')
+            if not worker_url:
+                return {'status': 'error', 'message': 'worker_url or KEIBA_SHARD_URL is required'}, 400
+            from scraping.sharding import HttpDispatcher, run_sharded
+            # 1秒あたりのリクエスト数は全ワーカーの合計なので、ワーカー数で等分して渡す
+            workers = max(1, int(request_json.get('workers', 8)))
+            requests_per_second = float(request_json.get('requests_per_second', 1.0))
+            dispatcher = HttpDispatcher(worker_url, max_concurrency=workers,
+                                        scraper_options={'requests_per_second': requests_per_second / workers})
+            return run_sharded(scraper, year or datetime.now().year, dispatcher, place,
+                               request_json.get('granularity', 'day'))
+        
+        # パートファイルのコンパクションのみを実行（Cloud Schedulerなどから定期的に呼ぶ）
+        if compact:
+            scraper.compact_storage(year)
+            return {'status': 'success', 'message': f'Compacted partitions for {year or "all years"}'}
         
-        scraper = NetkeibaRaceScraper()
         result = scraper.process_races(year, place, kai, day)
         
         return result
@@ -732,10 +1174,17 @@ def scrape_races(request):
         error_message = str(e)
         print(f"Error in scrape_races: {error_message}")
         return {'status': 'error', 'message': error_message}, 500
+    finally:
+        if shared:
+            _shared_scraper_lock.release()
 
 # ローカル実行用のエントリーポイント
 if __name__ == "__main__":
     scraper = NetkeibaRaceScraper()
+    # KEIBA_METRICS_PORTを指定すると、実行中の計測値を http://localhost:{port}/metrics で公開する
+    metrics_port = os.environ.get('KEIBA_METRICS_PORT')
+    if metrics_port:
+        scraper.metrics.serve(int(metrics_port))
     result = scraper.process_races()
     print(f"Scraping completed with status: {result['status']}")
     if result['status'] == 'error':
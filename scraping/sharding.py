@@ -0,0 +1,327 @@
+import argparse
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from requests.exceptions import RequestException
+
+from scraping.crawl_state import CrawlState
+from scraping.http_session import create_session
+from scraping.metrics import log_event
+from scraping.race_calendar import RaceCalendar
+from scraping.result_columns import attach_race_id
+
+# シャードの単位（'day': 開催日ごと、'kai': 競馬場・開催回ごと）
+SHARD_GRANULARITIES = {'day': 10, 'kai': 8}
+SHARD_STATE_PREFIX = '_state/shards/'
+
+# ワーカープロセスごとに1つだけ作るスクレイパー（同じ設定のシャードで使い回す）
+_shard_scraper = None
+_shard_scraper_options = None
+# 使い回すスクレイパーを使用中か（同時に実行中のシャードがあれば新しく作り、処理状況を上書きしない）
+_shard_scraper_lock = threading.Lock()
+
+
+def shard_state_name(shard_id):
+    """シャードの処理状況のオブジェクト名"""
+    return f'{SHARD_STATE_PREFIX}{shard_id}.sqlite3'
+
+
+def plan_shards(scraper, year, place=None, granularity='day'):
+    """
+    開催カレンダーのレースのうち未取得のものを、独立に処理できるシャードに分ける
+    Args:
+        scraper (NetkeibaRaceScraper): コーディネーターのスクレイパー（インデックス・処理状況を読む）
+        year (int): 年
+        place (str, optional): 競馬場コード（省略時は全競馬場）
+        granularity (str): 'day'（開催日ごと）または 'kai'（競馬場・開催回ごと）
+    Returns:
+        list: {'shard_id': ..., 'year': ..., 'race_ids': [...]} のリスト（shard_id順）
+    """
+    if granularity not in SHARD_GRANULARITIES:
+        raise ValueError(f"Unknown shard granularity: {granularity}")
+    key_length = SHARD_GRANULARITIES[granularity]
+    calendar = scraper.race_calendar or RaceCalendar(scraper.fetcher)
+    meeting_days = calendar.meeting_days(year)
+
+    race_index = scraper.get_race_index()
+    info_race_ids = race_index.ids('race_info', year)
+    result_race_ids = race_index.ids('race_result', year)
+    crawl_state = scraper.get_crawl_state()
+    crawl_state.plan(race_id for days in meeting_days.values() for race_ids in days.values() for race_id in race_ids)
+
+    shards = {}
+    for venue, days in meeting_days.items():
+        if place is not None and venue != place:
+            continue
+        for race_ids in days.values():
+            for race_id in race_ids:
+                # 両方のテーブルに保存済み、または失敗を繰り返しているレースは除く
+                if (race_id in info_race_ids and race_id in result_race_ids) or crawl_state.gave_up(race_id):
+                    continue
+                shards.setdefault(race_id[:key_length], []).append(race_id)
+    return [{'shard_id': shard_id, 'year': year, 'race_ids': race_ids}
+            for shard_id, race_ids in sorted(shards.items())]
+
+
+def run_shard(shard, storage=None, storage_root=None, scraper_options=None):
+    """
+    1つのシャードのレースを取得して保存する（ワーカープロセス・Cloud Functionsのシャード実行）
+    - 行は通常の保存と同じく新しいパートファイルとして追記するので、ワーカー同士で書き込みが重ならない
+    - 処理状況はシャードごとのオブジェクトに記録する（全体の状況へはmerge_shardsで取り込む）
+    - 保存済みレースIDのインデックスは書き戻さない（コーディネーターがまとめて更新する）
+    - 同じインスタンスで同時に実行中のシャードがあれば、使い回すスクレイパーではなく新しく作ったものを使う
+    Args:
+        shard (dict): plan_shardsで作ったシャード
+        storage (str, optional): 'gcs' / 'local'（省略時は環境変数 KEIBA_STORAGE_BACKEND に従う）
+        storage_root (str, optional): localの場合のディレクトリ
+        scraper_options (dict, optional): NetkeibaRaceScraperに渡す引数（requests_per_secondなど）
+    Returns:
+        dict: シャードの処理結果
+    """
+    global _shard_scraper, _shard_scraper_options
+    from scraping.scraping_netkeiba import NetkeibaRaceScraper
+    from scraping.storage_backends import create_storage
+
+    def _new_scraper():
+        return NetkeibaRaceScraper(storage=create_storage(storage, storage_root), use_calendar=False,
+                                   **(scraper_options or {}))
+
+    shared = _shard_scraper_lock.acquire(blocking=False)
+    try:
+        if shared:
+            options = (storage, storage_root, sorted((scraper_options or {}).items()))
+            if _shard_scraper is None or _shard_scraper_options != options:
+                _shard_scraper = _new_scraper()
+                _shard_scraper_options = options
+            scraper = _shard_scraper
+        else:
+            scraper = _new_scraper()
+        scraper.crawl_state = CrawlState.load(scraper.storage, name=shard_state_name(shard['shard_id']))
+        return _scrape_shard(scraper, shard)
+    finally:
+        if shared:
+            _shard_scraper_lock.release()
+
+
+def _scrape_shard(scraper, shard):
+    start = time.perf_counter()
+    race_infos = []
+    race_results = []
+    scraped = 0
+    with scraper.metrics.span('run_shard', shard_id=shard['shard_id'], races=len(shard['race_ids'])) as span:
+        for race_id, race_data in scraper.scrape_race_results(shard['race_ids']).items():
+            if not race_data:
+                continue
+            scraped += 1
+            if race_data['race_info']:
+                race_data['race_info']['race_id'] = race_id
+                race_infos.append(race_data['race_info'])
+            if race_data['race_results']:
+                race_results.extend(attach_race_id(race_data['race_results'], race_id))
+        if race_infos or race_results:
+            scraper.save_consolidated_csv(race_infos, race_results)
+        scraper.crawl_state.checkpoint()
+        span['scraped'] = scraped
+    return {
+        'shard_id': shard['shard_id'],
+        'status': 'success',
+        'races': len(shard['race_ids']),
+        'scraped': scraped,
+        'seconds': round(time.perf_counter() - start, 3),
+    }
+
+
+def _run_shard_safely(shard, storage, storage_root, scraper_options):
+    # ワーカープロセスの例外をシャードの失敗として返す（プロセスプールの例外の送り返しに頼らない）
+    try:
+        return run_shard(shard, storage, storage_root, scraper_options)
+    except Exception as e:
+        return {'shard_id': shard['shard_id'], 'status': 'error', 'message': str(e)}
+
+
+class LocalDispatcher:
+    """
+    ローカルのプロセスプールでシャードを実行する（Cloud Functionsへの振り分けの代わり）
+    - シャードはメモリ上のキューに入れ、空いたワーカーから順に取り出して実行する
+    - 失敗したシャードはキューに戻し、max_attempts回まで実行し直す
+    - ワーカーのプロセス間でストレージを共有するので、storageは 'local' か 'gcs' にする
+    """
+
+    def __init__(self, workers=None, storage=None, storage_root=None, scraper_options=None, max_attempts=2):
+        """
+        Args:
+            workers (int, optional): ワーカープロセス数（省略時はCPUコア数）
+            storage (str, optional): ワーカーが使うストレージ（'local' / 'gcs'）
+            storage_root (str, optional): localの場合のディレクトリ
+            scraper_options (dict, optional): ワーカーのNetkeibaRaceScraperに渡す引数
+            max_attempts (int): 1つのシャードを実行する回数の上限
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.storage = storage
+        self.storage_root = storage_root
+        self.scraper_options = scraper_options or {}
+        self.max_attempts = max_attempts
+
+    def dispatch(self, shards):
+        """
+        シャードを並列に実行する
+        Returns:
+            list: シャードごとの処理結果（完了順）
+        """
+        tasks = queue.Queue()
+        for shard in shards:
+            tasks.put((shard, 1))
+        results = []
+        lock = threading.Lock()
+
+        # ワーカーの中で取得スレッドを使うので、forkではなくspawnで起動する
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as executor:
+            def consume():
+                while True:
+                    try:
+                        shard, attempt = tasks.get_nowait()
+                    except queue.Empty:
+                        return
+                    result = executor.submit(_run_shard_safely, shard, self.storage, self.storage_root,
+                                             self.scraper_options).result()
+                    if result['status'] != 'success' and attempt < self.max_attempts:
+                        print(f"Shard {shard['shard_id']} failed ({result.get('message')}), retrying")
+                        tasks.put((shard, attempt + 1))
+                        continue
+                    with lock:
+                        results.append(result)
+
+            threads = [threading.Thread(target=consume, daemon=True) for _ in range(self.workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return results
+
+
+class HttpDispatcher:
+    """
+    Cloud Functions（scrape_races）にシャードを1件ずつPOSTして並列に実行させる
+    各呼び出しは1シャードだけを処理するので、関数のタイムアウトに収まる
+    """
+
+    def __init__(self, url, max_concurrency=8, headers=None, timeout=(5, 540), scraper_options=None):
+        """
+        Args:
+            url (str): scrape_racesのURL
+            max_concurrency (int): 同時に実行するシャード数
+            headers (dict, optional): 認証ヘッダーなど
+            timeout (tuple): (接続, 読み取り) のタイムアウト秒数（読み取りは関数のタイムアウトに合わせる）
+            scraper_options (dict, optional): ワーカーのNetkeibaRaceScraperに渡す引数（requests_per_secondなど）
+        """
+        self.url = url
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.scraper_options = scraper_options or {}
+        self.session = create_session(headers=headers, pool_size=self.max_concurrency, max_retries=0)
+        self.timeout = timeout
+
+    def dispatch(self, shards):
+        def _post(shard):
+            try:
+                response = self.session.post(self.url, json={'shard': shard, 'scraper_options': self.scraper_options}, timeout=self.timeout)
+                response.raise_for_status()
+                return response.json()
+            except (RequestException, ValueError) as e:
+                return {'shard_id': shard['shard_id'], 'status': 'error', 'message': str(e)}
+
+        if not shards:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(shards))) as executor:
+            return list(executor.map(_post, shards))
+
+
+def merge_shards(scraper, shard_ids, year=None, compact=True):
+    """
+    シャードの処理結果を全体にまとめる
+    - シャードごとの処理状況を全体の処理状況に取り込む
+    - ワーカーが書いたパートファイルを保存済みレースIDのインデックスに反映する
+    - パーティションのパートファイルを1ファイルにまとめる
+    Args:
+        scraper (NetkeibaRaceScraper): コーディネーターのスクレイパー
+        shard_ids (list): まとめるシャードのID
+        year (int, optional): コンパクションの対象の年
+        compact (bool): パートファイルをまとめるか
+    """
+    crawl_state = scraper.get_crawl_state()
+    merged = []
+    for shard_id in shard_ids:
+        name = shard_state_name(shard_id)
+        if not scraper.storage.exists(crawl_state.bucket, name):
+            continue
+        crawl_state.merge(CrawlState.load(scraper.storage, bucket=crawl_state.bucket, name=name))
+        merged.append(name)
+    scraper.get_race_index().refresh()
+    if compact:
+        scraper.compact_storage(year)
+    scraper.persist_indexes()
+    # 全体の状況を書き戻してからシャードの状況を消す（途中で失敗しても次回取り込み直せる。
+    # 取り込み済みの失敗の回数は全体の状況に記録してあるので二重に足さない）
+    for name in merged:
+        scraper.storage.delete(crawl_state.bucket, name)
+
+
+def run_sharded(scraper, year, dispatcher, place=None, granularity='day', compact=True):
+    """
+    コーディネーター：未取得のレースをシャードに分けて並列に実行させ、最後に結果をまとめる
+    Args:
+        scraper (NetkeibaRaceScraper): コーディネーターのスクレイパー
+        year (int): 年
+        dispatcher (LocalDispatcher or HttpDispatcher): シャードの実行先
+        place (str, optional): 競馬場コード
+        granularity (str): 'day' または 'kai'
+        compact (bool): 最後にパートファイルをまとめるか
+    Returns:
+        dict: 処理結果
+    """
+    with scraper.metrics.span('run_sharded', year=year, place=place, granularity=granularity) as span:
+        shards = plan_shards(scraper, year, place, granularity)
+        span.update(shards=len(shards), races=sum(len(shard['race_ids']) for shard in shards))
+        log_event('Dispatching shards', year=year, shards=len(shards), races=span['races'])
+        results = dispatcher.dispatch(shards) if shards else []
+        merge_shards(scraper, [shard['shard_id'] for shard in shards], year, compact)
+        failed = sorted(result['shard_id'] for result in results if result.get('status') != 'success')
+        span['failed_shards'] = len(failed)
+    return {
+        'status': 'success' if not failed else 'partial',
+        'message': f'Processed {len(shards) - len(failed)} of {len(shards)} shards for {year}',
+        'failed_shards': failed,
+        'crawl_state': scraper.get_crawl_state().summary(year),
+    }
+
+
+if __name__ == "__main__":
+    from scraping.scraping_netkeiba import NetkeibaRaceScraper
+    from scraping.storage_backends import create_storage
+
+    parser = argparse.ArgumentParser(description='年間のレースをシャードに分けてローカルのプロセスプールで取得する')
+    parser.add_argument('--year', type=int, required=True)
+    parser.add_argument('--place', help='競馬場コード（省略時は全競馬場）')
+    parser.add_argument('--granularity', choices=sorted(SHARD_GRANULARITIES), default='day')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--storage', choices=['local', 'gcs'], default=os.environ.get('KEIBA_STORAGE_BACKEND', 'local'))
+    parser.add_argument('--storage-dir', default=os.environ.get('KEIBA_STORAGE_DIR', 'data'))
+    parser.add_argument('--requests-per-second', type=float, default=1.0,
+                        help='全ワーカー合計の1秒あたりリクエスト数（ワーカー数で等分する）')
+    parser.add_argument('--cache-dir', help='生HTMLキャッシュのディレクトリ')
+    parser.add_argument('--parser', choices=['bs4', 'lxml'], default='lxml')
+    args = parser.parse_args()
+
+    coordinator = NetkeibaRaceScraper(storage=create_storage(args.storage, args.storage_dir), parser=args.parser)
+    worker_options = {
+        'requests_per_second': args.requests_per_second / args.workers,
+        'cache_dir': args.cache_dir,
+        'parser': args.parser,
+    }
+    dispatcher = LocalDispatcher(args.workers, args.storage, args.storage_dir, worker_options)
+    result = run_sharded(coordinator, args.year, dispatcher, args.place, args.granularity)
+    print(f"Sharded scraping completed with status: {result['status']} ({result['message']})")
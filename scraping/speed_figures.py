@@ -0,0 +1,384 @@
+import argparse
+import io
+import json
+import posixpath
+import time
+
+import numpy as np
+import pandas as pd
+
+from scraping.partitioned_store import KEY_INDEX_PREFIX, PartitionedStore, unread_parts
+from scraping.storage_backends import RACE_RESULT_BUCKET, create_storage
+
+# スピード指数の尺度：走破タイムが基準タイムと同じなら80、1000mあたり1秒速ければ+20
+BASE_FIGURE = 80.0
+POINTS_PER_SECOND_AT_1000M = 20.0
+# 勝ちタイムがこのレース数以上ある条件だけで基準タイムを出す
+MIN_PAR_RACES = 3
+# 馬場差は開催日のレース数が少ないほど0に寄せる（レース数 / (レース数 + この値) を掛ける）
+VARIANT_SHRINK_RACES = 2
+
+# 基準タイム（par）は競馬場・芝ダート・距離・クラスごと、クラスをまとめたものは競馬場・芝ダート・距離ごと
+PAR_KEY = ['venue', 'track_type', 'distance', 'race_class']
+COURSE_KEY = ['venue', 'track_type', 'distance']
+# 馬場差（track variant）は開催日・競馬場・芝ダートごと
+MEETING_KEY = ['venue', 'race_date', 'track_type']
+
+# クラス（race_conditionsの表記 → クラス。上から順に判定し、重賞はレース名の格付けを使う）
+CLASS_PATTERNS = (
+    ('新馬', r'新馬'),
+    ('未勝利', r'未勝利'),
+    ('1勝', r'1勝クラス|500万'),
+    ('2勝', r'2勝クラス|1000万'),
+    ('3勝', r'3勝クラス|1600万'),
+    ('OP', r'オープン|OP|\(L\)'),
+)
+GRADE_PATTERN = r'\((G(?:III|II|I|[1-3]))\)'
+
+INFO_COLUMNS = ['race_date', 'race_name', 'race_conditions', 'track_type', 'track_distance']
+WINNER_COLUMNS = ['race_id'] + PAR_KEY + ['finish_time']
+VARIANT_COLUMNS = MEETING_KEY + ['track_variant', 'variant_races']
+
+SPEED_FIGURE_KEY = ['race_id', '馬番']
+SPEED_FIGURE_COLUMNS = [
+    'race_id',
+    '馬番',
+    'race_date',
+    '馬名',
+    'horse_id',
+    'venue',
+    'track_type',
+    'distance',
+    'race_class',
+    'タイム',
+    'par_time',
+    'standard_time',
+    'track_variant',
+    'variant_races',
+    'adjusted_time',
+    'speed_figure',
+]
+
+
+def _empty_frame(columns):
+    """状態の空の表（数値の列はfloat。後から足す行と型をそろえて、キーで結合できるようにする）"""
+    numeric = ('distance', 'finish_time', 'track_variant', 'variant_races')
+    return pd.DataFrame({column: pd.Series(dtype=float if column in numeric else object) for column in columns})
+
+
+def race_class(race_names, race_conditions):
+    """
+    レース名・条件からクラスを判定する（重賞は'G1'〜'G3'、判定できなければ''）
+    Args:
+        race_names (Series): レース名（"有馬記念(G1)"など）
+        race_conditions (Series): 条件（"3歳以上2勝クラス (混)[指](定量)"など）
+    Returns:
+        Series: クラス
+    """
+    conditions = race_conditions.fillna('').astype(str)
+    classes = pd.Series(
+        np.select([conditions.str.contains(pattern) for _, pattern in CLASS_PATTERNS],
+                  [name for name, _ in CLASS_PATTERNS], default=''),
+        index=race_conditions.index)
+    grade = race_names.fillna('').astype(str).str.extract(GRADE_PATTERN, expand=False)
+    grade = grade.str.replace('III', '3', regex=False).str.replace('II', '2', regex=False).str.replace('I', '1', regex=False)
+    return grade.where(grade.notna(), classes)
+
+
+def figure_rows(race_infos, race_results):
+    """
+    レース情報と結果から、スピード指数の計算に使う列だけの行を作る
+    Args:
+        race_infos (DataFrame): レース情報（INFO_COLUMNS）
+        race_results (DataFrame): レース結果
+    Returns:
+        DataFrame: race_id・馬番・馬名・horse_id・競馬場・コース・クラス・着順・タイム
+            （レース日・コースが分からない行は除く）
+    """
+    results = race_results.assign(race_id=race_results['race_id'].astype(str))
+    infos = race_infos.assign(race_id=race_infos['race_id'].astype(str)).drop_duplicates('race_id', keep='last')
+    # クラスはレースごとに判定してから結合する（出走馬ごとに正規表現を当てない）
+    infos = infos.assign(race_class=race_class(
+        infos.get('race_name', pd.Series(np.nan, index=infos.index)),
+        infos.get('race_conditions', pd.Series(np.nan, index=infos.index))))
+    df = results.merge(infos, on='race_id', how='left')
+
+    def column(name):
+        return df[name] if name in df.columns else pd.Series(np.nan, index=df.index)
+
+    def number(name):
+        return pd.to_numeric(column(name), errors='coerce')
+
+    rows = pd.DataFrame({
+        'race_id': df['race_id'],
+        '馬番': number('馬番'),
+        'race_date': column('race_date').astype(object),
+        '馬名': column('馬名').astype(object),
+        'horse_id': column('horse_id').astype(object),
+        'venue': df['race_id'].str[4:6],
+        'track_type': column('track_type').astype(object),
+        'distance': number('track_distance'),
+        'race_class': column('race_class').fillna('').astype(object),
+        'rank': number('着順'),
+        'finish_time': number('タイム'),
+    })
+    valid = rows['race_date'].notna() & rows['track_type'].notna() & rows['distance'].gt(0)
+    return rows[valid].reset_index(drop=True)
+
+
+def par_times(winners):
+    """
+    勝ちタイムの中央値から基準タイムを出す
+    Args:
+        winners (DataFrame): WINNER_COLUMNSの行（1レース1行）
+    Returns:
+        tuple: (PAR_KEYごとの基準タイム, COURSE_KEYごとのクラスをまとめた基準タイム)（レース数が足りない条件は除く）
+    """
+    def median(keys):
+        grouped = winners.groupby(keys, sort=True)['finish_time'].agg(['median', 'count'])
+        return grouped.loc[grouped['count'] >= MIN_PAR_RACES, 'median']
+
+    return median(PAR_KEY).rename('par_time'), median(COURSE_KEY).rename('standard_time')
+
+
+def compute_figures(rows, winners):
+    """
+    全行の基準タイム・馬場差・スピード指数をまとめて計算する（レースごとのループはしない）
+    - 馬場差：開催日・競馬場・芝ダートごとに、勝ちタイムと基準タイムの差（1000mあたりの秒）の中央値
+      （プラスなら時計のかかる馬場）
+    - 補正タイム：タイムから馬場差の分を引いたもの
+    - スピード指数：クラスをまとめた基準タイムとの差を距離で換算した値（速いほど大きい）
+    Args:
+        rows (DataFrame): figure_rowsの行（馬場差を出す開催日のレースはすべて含めること）
+        winners (DataFrame): 基準タイムに使う勝ちタイム（WINNER_COLUMNS）
+    Returns:
+        DataFrame: SPEED_FIGURE_COLUMNSの行（タイムの無い行の指数は欠損）
+    """
+    par, standard = par_times(winners)
+    rows = rows.join(par, on=PAR_KEY).join(standard, on=COURSE_KEY)
+
+    timed = rows['rank'].ge(1) & rows['finish_time'].gt(0)
+    winner = timed & rows['rank'].eq(1)
+    per_km = 1000 / rows['distance']
+    deviation = ((rows['finish_time'] - rows['par_time']) * per_km).where(winner)
+    meeting = deviation.groupby([rows[key] for key in MEETING_KEY], sort=False)
+    races = meeting.transform('count')
+    variant = (meeting.transform('median') * races / (races + VARIANT_SHRINK_RACES)).fillna(0.0)
+    adjusted = (rows['finish_time'] - variant / per_km).where(timed)
+    figure = BASE_FIGURE + (rows['standard_time'] - adjusted) * POINTS_PER_SECOND_AT_1000M * per_km
+
+    return pd.DataFrame({
+        'race_id': rows['race_id'],
+        '馬番': rows['馬番'],
+        'race_date': rows['race_date'],
+        '馬名': rows['馬名'],
+        'horse_id': rows['horse_id'],
+        'venue': rows['venue'],
+        'track_type': rows['track_type'],
+        'distance': rows['distance'],
+        'race_class': rows['race_class'],
+        'タイム': rows['finish_time'].where(timed),
+        'par_time': rows['par_time'],
+        'standard_time': rows['standard_time'],
+        'track_variant': variant.round(3),
+        'variant_races': races.astype(int),
+        'adjusted_time': adjusted.round(2),
+        'speed_figure': figure.round(1),
+    })
+
+
+class SpeedFigureStore:
+    """
+    基準タイム・馬場差・スピード指数を、保存済みのレースからまとめて計算して保存する
+    - 状態はレースごとの勝ちタイム（1レース1行）と開催日ごとの馬場差だけ。基準タイムは勝ちタイムから毎回出す
+    - rebuild()は全期間の行をgroupby・transformで1度に計算する（全シーズン分でも数秒）
+    - refresh()は新しく保存されたパートファイルのレースの開催日だけを計算し直す
+      （馬場差はその日の全レースで決まるので、同じ日の保存済みのレースも読み直す）
+    - 取り込んだ最後のパートファイル名を記録しておき、それより新しいパートだけを読む
+    """
+
+    STATE_PREFIX = '_speed_figures/'
+
+    def __init__(self, storage, result_store, info_store, bucket=RACE_RESULT_BUCKET):
+        """
+        Args:
+            storage (StorageBackend): 状態とスピード指数の保存先
+            result_store (PartitionedStore): レース結果のストア
+            info_store (PartitionedStore): レース情報のストア
+            bucket (str): 状態とスピード指数を置くバケット
+        """
+        self.storage = storage
+        self.result_store = result_store
+        self.info_store = info_store
+        self.bucket = bucket
+        # スピード指数の表（レースのパーティションごと。変わった行だけを書き出す）
+        self.figure_table = PartitionedStore(storage, bucket, 'speed_figures', SPEED_FIGURE_KEY, SPEED_FIGURE_COLUMNS,
+                                             string_columns=('race_id', 'horse_id', 'venue'))
+        self._reset()
+
+    def _reset(self):
+        self.winners = _empty_frame(WINNER_COLUMNS)
+        self.variants = _empty_frame(VARIANT_COLUMNS)
+        self.parts = set()
+        self._dirty = False
+
+    def _state_name(self, name):
+        return f'{self.STATE_PREFIX}{name}'
+
+    def _read_frame(self, name):
+        return pd.read_parquet(io.BytesIO(self.storage.read_bytes(self.bucket, self._state_name(name))))
+
+    def _write_frame(self, name, df):
+        buffer = io.BytesIO()
+        df.to_parquet(buffer)
+        self.storage.write_bytes(self.bucket, self._state_name(name), buffer.getvalue(),
+                                 content_type='application/vnd.apache.parquet')
+
+    @classmethod
+    def load(cls, storage, result_store, info_store, bucket=RACE_RESULT_BUCKET):
+        """保存済みの状態を読み込む（無ければ空の状態）"""
+        store = cls(storage, result_store, info_store, bucket)
+        try:
+            meta = json.loads(storage.read_bytes(bucket, store._state_name('meta.json')))
+        except FileNotFoundError:
+            return store
+        if 'parts' in meta:
+            store.parts = set(meta['parts'])
+        else:
+            # 以前の形式（最後に取り込んだパート名）は、それ以前のパートを取り込み済みとして読む
+            store.parts = {posixpath.basename(name) for name in result_store.list_parts()
+                           if posixpath.basename(name) <= meta['last_part']}
+        store.winners = store._read_frame('winners.parquet')
+        store.variants = store._read_frame('variants.parquet')
+        return store
+
+    def update(self, rows, parts=()):
+        """
+        行の勝ちタイムを状態に反映し、それらの開催日の馬場差とスピード指数を計算して保存する
+        Args:
+            rows (DataFrame): figure_rowsで作った行（開催日のレースはすべて含めること）
+            parts (iterable): 行を読んだパートファイル名（次回読み直さないように記録）
+        Returns:
+            int: スピード指数が追加・変更された行数
+        """
+        figures = self._compute(rows, parts)
+        if figures.empty:
+            return 0
+        upserted = self.figure_table.upsert(figures)
+        return upserted['inserted'] + upserted['updated']
+
+    def _compute(self, rows, parts):
+        """勝ちタイムと馬場差の状態を更新し、行のスピード指数を返す"""
+        self.parts.update(posixpath.basename(name) for name in parts)
+        self._dirty = True
+        if rows.empty:
+            return pd.DataFrame(columns=SPEED_FIGURE_COLUMNS)
+
+        # 保存し直されたレースの勝ちタイムは新しい値で置き換える
+        won = rows['rank'].eq(1) & rows['finish_time'].gt(0)
+        winners = rows.loc[won, WINNER_COLUMNS].drop_duplicates('race_id', keep='last')
+        self.winners = pd.concat([self.winners[~self.winners['race_id'].isin(rows['race_id'])], winners],
+                                 ignore_index=True)
+
+        figures = compute_figures(rows, self.winners)
+        variants = figures.drop_duplicates(MEETING_KEY)[VARIANT_COLUMNS]
+        self.variants = (pd.concat([self.variants, variants], ignore_index=True)
+                         .drop_duplicates(MEETING_KEY, keep='last')
+                         .sort_values(['race_date', 'venue', 'track_type'], kind='stable')
+                         .reset_index(drop=True))
+        return figures
+
+    def refresh(self):
+        """
+        状態に未反映のパートファイルのレースがある開催日を計算し直す
+        （コンパクションでまとめたパートは、まとめた最後のパートを取り込み済みならパーティション全体を計算し直さない）
+        Returns:
+            int: スピード指数が追加・変更された行数
+        """
+        names = self.result_store.list_parts()
+        parts = unread_parts(names, self.parts, skip_compacted=True)
+        # 一覧のパートはすべて取り込み済みになる（コンパクションで消えたパートは記録から外す）
+        listed = {posixpath.basename(name) for name in names}
+        if listed != self.parts:
+            self.parts = listed - {posixpath.basename(name) for name in parts}
+            self._dirty = True
+        if not parts:
+            return 0
+        new_race_ids = pd.concat([self.result_store.read_part(name, ['race_id']) for name in parts],
+                                 ignore_index=True)['race_id'].astype(str)
+        partitions = sorted(set(zip(new_race_ids.str[:4], new_race_ids.str[4:6])))
+        infos = pd.concat([self.info_store.read(year, venue, columns=INFO_COLUMNS) for year, venue in partitions],
+                          ignore_index=True)
+        infos['race_id'] = infos['race_id'].astype(str)
+        # 新しいレースと同じ開催日のレース（同じ競馬場なので同じパーティションにある）
+        race_dates = set(infos.loc[infos['race_id'].isin(new_race_ids), 'race_date'])
+        infos = infos[infos['race_date'].isin(race_dates)]
+        results = pd.concat([self.result_store.read(year, venue) for year, venue in partitions], ignore_index=True)
+        results = results[results['race_id'].astype(str).isin(infos['race_id'])]
+        return self.update(figure_rows(infos, results), parts)
+
+    def rebuild(self):
+        """状態とスピード指数を全期間から作り直す（基準タイムの計算方法を変えた場合など）"""
+        figure_prefix = self.figure_table.partition_prefix()
+        for name in self.storage.list(self.bucket, figure_prefix) + \
+                self.storage.list(self.bucket, f'{KEY_INDEX_PREFIX}{figure_prefix}'):
+            self.storage.delete(self.bucket, name)
+        self._reset()
+        parts = self.result_store.list_parts()
+        if not parts:
+            return 0
+        infos = self.info_store.read(columns=INFO_COLUMNS)
+        results = self.result_store.read()
+        # 表は空なのでつき合わせずに追記する（キーのインデックスは次のupsertでパーティションごとに作られる）
+        figures = self._compute(figure_rows(infos, results), parts)
+        self.figure_table.append(figures)
+        return len(figures)
+
+    def figures(self, race_ids):
+        """
+        保存済みのレースのスピード指数を取得する
+        Args:
+            race_ids (list): レースID
+        Returns:
+            DataFrame: SPEED_FIGURE_COLUMNSの行
+        """
+        race_ids = sorted(set(map(str, race_ids)))
+        frames = [
+            self.figure_table.read(year, venue)
+            for year, venue in sorted({(race_id[:4], race_id[4:6]) for race_id in race_ids})
+        ]
+        if not frames:
+            return pd.DataFrame(columns=SPEED_FIGURE_COLUMNS)
+        df = pd.concat(frames, ignore_index=True)
+        return df[df['race_id'].astype(str).isin(race_ids)].reset_index(drop=True)
+
+    def persist(self):
+        """変更があれば状態を書き戻す（メタ情報は最後に書くので、途中で失敗すると前回の状態が使われる）"""
+        if not self._dirty:
+            return
+        self._write_frame('winners.parquet', self.winners)
+        self._write_frame('variants.parquet', self.variants)
+        meta = {'parts': sorted(self.parts)}
+        self.storage.write_bytes(self.bucket, self._state_name('meta.json'),
+                                 json.dumps(meta).encode('utf-8'), content_type='application/json')
+        self._dirty = False
+
+
+if __name__ == "__main__":
+    from scraping.schema import (ENTITY_ID_COLUMNS, RACE_INFO_COLUMNS, RACE_INFO_KEY, RACE_RESULT_KEY,
+                                 RACE_RESULT_STORE_COLUMNS)
+    from scraping.storage_backends import RACE_INFO_BUCKET
+
+    parser = argparse.ArgumentParser(description='新しく保存された開催日の馬場差とスピード指数を計算する')
+    parser.add_argument('--rebuild', action='store_true', help='基準タイム・馬場差・スピード指数を全期間から作り直す')
+    args = parser.parse_args()
+
+    storage = create_storage()
+    result_store = PartitionedStore(storage, RACE_RESULT_BUCKET, 'race_result', RACE_RESULT_KEY, RACE_RESULT_STORE_COLUMNS,
+                                    string_columns=['race_id'] + ENTITY_ID_COLUMNS)
+    info_store = PartitionedStore(storage, RACE_INFO_BUCKET, 'race_info', RACE_INFO_KEY, RACE_INFO_COLUMNS)
+    figure_store = SpeedFigureStore.load(storage, result_store, info_store)
+    start = time.perf_counter()
+    rows = figure_store.rebuild() if args.rebuild else figure_store.refresh()
+    figure_store.persist()
+    print(f"Saved speed figures for {rows} runners in {time.perf_counter() - start:.1f} s")
@@ -0,0 +1,198 @@
+import argparse
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# スクレイパーが使うバケット
+RACE_INFO_BUCKET = 'nk_race_info'
+RACE_RESULT_BUCKET = 'nk_race_result'
+
+
+class StorageBackend:
+    """
+    バケット＋オブジェクト名でバイト列を読み書きするストレージの共通インターフェース
+    存在しないオブジェクトを読むとFileNotFoundErrorを送出する
+    """
+
+    def read_bytes(self, bucket, name):
+        raise NotImplementedError
+
+    def write_bytes(self, bucket, name, data, content_type=None):
+        raise NotImplementedError
+
+    def exists(self, bucket, name):
+        raise NotImplementedError
+
+    def list(self, bucket, prefix=''):
+        """prefixで始まるオブジェクト名を昇順で返す"""
+        raise NotImplementedError
+
+    def delete(self, bucket, name):
+        raise NotImplementedError
+
+
+class GCSStorage(StorageBackend):
+    """Google Cloud Storage（クライアントは最初のアクセス時に作成）"""
+
+    def __init__(self, client=None):
+        self._client = client
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                from google.cloud import storage
+                self._client = storage.Client()
+        return self._client
+
+    def read_bytes(self, bucket, name):
+        from google.api_core.exceptions import NotFound
+        try:
+            return self.client.bucket(bucket).blob(name).download_as_bytes()
+        except NotFound:
+            raise FileNotFoundError(f'gs://{bucket}/{name}')
+
+    def write_bytes(self, bucket, name, data, content_type=None):
+        self.client.bucket(bucket).blob(name).upload_from_string(data, content_type=content_type)
+
+    def exists(self, bucket, name):
+        return self.client.bucket(bucket).blob(name).exists()
+
+    def list(self, bucket, prefix=''):
+        return sorted(blob.name for blob in self.client.list_blobs(bucket, prefix=prefix))
+
+    def delete(self, bucket, name):
+        from google.api_core.exceptions import NotFound
+        try:
+            self.client.bucket(bucket).blob(name).delete()
+        except NotFound:
+            pass
+
+
+class LocalStorage(StorageBackend):
+    """ローカルディレクトリ（root/バケット名/オブジェクト名）"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, bucket, name):
+        """オブジェクトのローカルパス（ファイルの一部だけを読む場合に使う）"""
+        return os.path.join(self.root, bucket, *name.split('/'))
+
+    def read_bytes(self, bucket, name):
+        with open(self.path(bucket, name), 'rb') as f:
+            return f.read()
+
+    def write_bytes(self, bucket, name, data, content_type=None):
+        path = self.path(bucket, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 書きかけのファイルが読まれないように、一時ファイルに書いてから置き換える
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def exists(self, bucket, name):
+        return os.path.isfile(self.path(bucket, name))
+
+    def list(self, bucket, prefix=''):
+        bucket_root = os.path.join(self.root, bucket)
+        names = []
+        for dirpath, _, filenames in os.walk(bucket_root):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                name = os.path.relpath(os.path.join(dirpath, filename), bucket_root).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    names.append(name)
+        return sorted(names)
+
+    def delete(self, bucket, name):
+        try:
+            os.remove(self.path(bucket, name))
+        except FileNotFoundError:
+            pass
+
+
+class MemoryStorage(StorageBackend):
+    """プロセス内のメモリ（テスト・ベンチマーク用）"""
+
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def read_bytes(self, bucket, name):
+        with self._lock:
+            if (bucket, name) not in self._objects:
+                raise FileNotFoundError(f'{bucket}/{name}')
+            return self._objects[(bucket, name)]
+
+    def write_bytes(self, bucket, name, data, content_type=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with self._lock:
+            self._objects[(bucket, name)] = bytes(data)
+
+    def exists(self, bucket, name):
+        with self._lock:
+            return (bucket, name) in self._objects
+
+    def list(self, bucket, prefix=''):
+        with self._lock:
+            return sorted(n for b, n in self._objects if b == bucket and n.startswith(prefix))
+
+    def delete(self, bucket, name):
+        with self._lock:
+            self._objects.pop((bucket, name), None)
+
+
+def create_storage(backend=None, root=None):
+    """
+    設定からストレージを作成する
+    Args:
+        backend (str, optional): 'gcs' / 'local' / 'memory'
+            （省略時は環境変数 KEIBA_STORAGE_BACKEND、未設定なら 'gcs'）
+        root (str, optional): localの場合のディレクトリ
+            （省略時は環境変数 KEIBA_STORAGE_DIR、未設定なら 'data'）
+    Returns:
+        StorageBackend: ストレージ
+    """
+    backend = backend or os.environ.get('KEIBA_STORAGE_BACKEND', 'gcs')
+    if backend == 'gcs':
+        return GCSStorage()
+    if backend == 'local':
+        return LocalStorage(root or os.environ.get('KEIBA_STORAGE_DIR', 'data'))
+    if backend == 'memory':
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def sync_storage(source, target, buckets=(RACE_INFO_BUCKET, RACE_RESULT_BUCKET), prefix='', max_workers=16):
+    """
+    sourceにあってtargetに無いオブジェクトをまとめてコピーする
+    （ローカルSSDでバックフィルした結果をGCSへ一括アップロードする用途）
+    Returns:
+        int: コピーしたオブジェクト数
+    """
+    copied = 0
+    for bucket in buckets:
+        existing = set(target.list(bucket, prefix))
+        names = [name for name in source.list(bucket, prefix) if name not in existing]
+
+        def _copy(name, bucket=bucket):
+            target.write_bytes(bucket, name, source.read_bytes(bucket, name))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(_copy, names))
+        copied += len(names)
+        print(f"Synced {len(names)} objects in {bucket}")
+    return copied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ローカルストレージの内容をGCSへ一括アップロードする')
+    parser.add_argument('--source-dir', default=os.environ.get('KEIBA_STORAGE_DIR', 'data'))
+    parser.add_argument('--prefix', default='')
+    args = parser.parse_args()
+    sync_storage(LocalStorage(args.source_dir), GCSStorage(), prefix=args.prefix)